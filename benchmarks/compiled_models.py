@@ -0,0 +1,100 @@
+""" Compares the compiled validate/serialize/changed methods against their field-by-field versions.
+
+Exits with status 1 when a compiled method is less than --min-speedup times faster, so it can guard
+against regressions.
+
+Run from the repository root: python -m benchmarks.compiled_models
+
+Usage:
+  compiled_models.py [--count=<n>] [--min-speedup=<x>] [--engine=<name>] [--uri=<uri>] [--port=<port>] [--database=<name>]
+
+Options:
+  -h --help          Show this help message
+  --count=<n>        Number of vertices and edges [default: 20000]
+  --min-speedup=<x>  Smallest acceptable compiled/dynamic speedup [default: 1.2]
+  --engine=<name>    Storage engine: mongo, or memory to run without a server [default: mongo]
+  --uri=<uri>        Mongo host [default: localhost]
+  --port=<port>      Mongo port [default: 27017]
+  --database=<name>  Mongo database used for index checks [default: ideagrapher_benchmark]
+"""
+
+from docopt import docopt
+from bson import ObjectId
+import sys
+import time
+
+
+def best_time(func, objs, repeat=3):
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    for obj in objs:
+      func(obj)
+    times.append(time.perf_counter() - start)
+
+  return min(times)
+
+
+def run(args):
+  from graphstore.models import MongoModel, ModelField, StringField, ListField, EnumField, DictField, NestedField, FloatField
+  MongoModel.connect_to_database(args['--database'], args['--uri'], int(args['--port']), engine=args['--engine'])
+
+  # shaped like webviz.models.Vertex and Edge
+  class BenchVertex(MongoModel):
+    screen = NestedField(dict(
+      x=FloatField(default=0),
+      y=FloatField(default=0),
+      xv=FloatField(default=0),
+      yv=FloatField(default=0),
+      size=FloatField(default=100),
+      color=StringField(default='gray'),
+    ))
+    data = DictField()
+
+  class BenchEdge(MongoModel):
+    kind = EnumField(['connected', 'related', 'directed'], default='connected')
+    start_vertices = ListField(ModelField(BenchVertex))
+    end_vertices = ListField(ModelField(BenchVertex))
+    screen = NestedField(dict(
+      color=StringField(default='black'),
+      thickness=FloatField(default=3),
+    ))
+    data = DictField()
+
+  count = int(args['--count'])
+  vertices = [BenchVertex.deserialize(dict(_id=ObjectId(), screen=dict(x=float(i), y=0.0, xv=0.0, yv=0.0, size=100.0, color='gray'), data={})) for i in range(count)]
+  edges = [BenchEdge(kind='directed', start_vertices=[vertices[i]], end_vertices=[vertices[i - 1]]) for i in range(count)]
+  for obj in vertices + edges:
+    obj._id = ObjectId()
+
+  for vertex in vertices:
+    vertex.screen = {'x': 1.0}
+
+  min_speedup = float(args['--min-speedup'])
+  failed = False
+
+  cases = [
+    ('validate', lambda obj: obj.validate(), lambda obj: obj.validate_dynamic()),
+    ('serialize', lambda obj: obj.serialize(include='all', cascade=False), lambda obj: obj.serialize_dynamic(obj.value_list(), dict(include='all', cascade=False))),
+    ('changed', lambda obj: obj.changed(cascade=False), lambda obj: obj.changed_dynamic(cascade=False)),
+  ]
+
+  for model_name, objs in [('Vertex', vertices), ('Edge', edges)]:
+    for case_name, compiled, dynamic in cases:
+      compiled_time = best_time(compiled, objs)
+      dynamic_time = best_time(dynamic, objs)
+      speedup = dynamic_time / compiled_time
+
+      print("{:<7} {:<10} compiled {:>8.0f}/s  dynamic {:>8.0f}/s  speedup {:.2f}x".format(
+        model_name, case_name, len(objs) / compiled_time, len(objs) / dynamic_time, speedup))
+
+      if speedup < min_speedup:
+        print("  REGRESSION: expected at least {:.2f}x".format(min_speedup))
+        failed = True
+
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  args = docopt(__doc__)
+  sys.exit(run(args))
@@ -0,0 +1,111 @@
+""" Rows per second of graphstore.importers on a generated link file, next to saving a model per row.
+
+Run from the repository root: python -m benchmarks.import_throughput
+
+Usage:
+  import_throughput.py [--rows=<n>] [--nodes=<n>] [--naive-rows=<n>] [--batch-size=<n>] [--engine=<name>] [--uri=<uri>] [--port=<port>] [--database=<name>]
+
+Options:
+  -h --help          Show this help message
+  --rows=<n>         Links in the generated CSV file [default: 200000]
+  --nodes=<n>        Distinct node names the links are drawn between [default: 20000]
+  --naive-rows=<n>   Rows imported a model at a time, for comparison [default: 2000]
+  --batch-size=<n>   Documents per insert [default: 5000]
+  --engine=<name>    Storage engine: mongo, or memory to run without a server [default: mongo]
+  --uri=<uri>        Mongo host [default: localhost]
+  --port=<port>      Mongo port [default: 27017]
+  --database=<name>  Mongo database to write to [default: ideagrapher_benchmark]
+"""
+
+from docopt import docopt
+import csv
+import os
+import random
+import tempfile
+import time
+
+
+def write_links(path, rows, nodes):
+  rng = random.Random(0)
+  with open(path, 'w', newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(['source', 'target', 'value'])
+    for i in range(rows):
+      writer.writerow(['node{}'.format(rng.randrange(nodes)), 'node{}'.format(rng.randrange(nodes)), rng.random()])
+
+
+def naive_import(path, limit):
+  # the old way: a query and a save per object, and a list scan per membership check
+  from graphstore.models import Graph, Node, Link
+  from graphstore.importers import read_links
+
+  graph = Graph()
+  graph.save()
+  nodes = {}
+
+  def get_node(name):
+    doc = Node.collection().find_one({'data.name': name})
+    if doc is not None:
+      return Node.get_by_id(doc['_id'])
+
+    node = Node(data={'name': name})
+    node.save()
+    return node
+
+  for i, (source, target, data) in enumerate(read_links(path)):
+    if i >= limit:
+      break
+
+    for name in (source, target):
+      nodes[name] = get_node(name)
+      if nodes[name] not in graph.nodes:
+        graph.nodes.append(nodes[name])
+
+    link = Link(sources=[nodes[source]], sinks=[nodes[target]], data=data)
+    link.save()
+    graph.links.append(link)
+
+  graph.save()
+
+
+def run(args):
+  from graphstore.models import MongoModel, Graph, Node, Link
+  from graphstore.importers import import_files
+  MongoModel.connect_to_database(args['--database'], args['--uri'], int(args['--port']), engine=args['--engine'])
+
+  def clear():
+    for model in (Graph, Node, Link):
+      model.collection().delete_many({})
+
+    MongoModel.identity_map.clear()
+
+  rows = int(args['--rows'])
+  naive_rows = min(int(args['--naive-rows']), rows)
+  fd, path = tempfile.mkstemp(suffix='.csv')
+  os.close(fd)
+
+  try:
+    write_links(path, rows, int(args['--nodes']))
+    clear()
+
+    start = time.perf_counter()
+    graph_id, counts = import_files(links_path=path, batch_size=int(args['--batch-size']))
+    elapsed = time.perf_counter() - start
+    print("{:<10} {:>8} rows  {:8.2f}s  {:10.0f} rows/s  ({nodes} nodes, {links} links)".format(
+      'importer', counts['rows'], elapsed, counts['rows'] / elapsed, **counts))
+
+    clear()
+    if naive_rows:
+      start = time.perf_counter()
+      naive_import(path, naive_rows)
+      elapsed = time.perf_counter() - start
+      print("{:<10} {:>8} rows  {:8.2f}s  {:10.0f} rows/s".format('per-model', naive_rows, elapsed, naive_rows / elapsed))
+
+  finally:
+    os.remove(path)
+    clear()
+
+
+if __name__ == '__main__':
+  args = docopt(__doc__)
+  run(args)
@@ -0,0 +1,61 @@
+""" Bytes sent and time taken to save one change to a long ListField, in place vs. reassigned.
+
+Run from the repository root: python -m benchmarks.list_updates
+
+Usage:
+  list_updates.py [--length=<n>] [--engine=<name>] [--uri=<uri>] [--port=<port>] [--database=<name>]
+
+Options:
+  -h --help          Show this help message
+  --length=<n>       Number of vertices in the list [default: 50000]
+  --engine=<name>    Storage engine: mongo, or memory to run without a server [default: mongo]
+  --uri=<uri>        Mongo host [default: localhost]
+  --port=<port>      Mongo port [default: 27017]
+  --database=<name>  Mongo database to write to [default: ideagrapher_benchmark]
+"""
+
+from docopt import docopt
+from bson import BSON, ObjectId
+import time
+
+
+def run(args):
+  from graphstore.models import MongoModel, ModelField, ListField
+  MongoModel.connect_to_database(args['--database'], args['--uri'], int(args['--port']), engine=args['--engine'])
+
+  class BenchItem(MongoModel):
+    pass
+
+  class BenchWeb(MongoModel):
+    vertices = ListField(ModelField(BenchItem, lazy=True))
+
+  length = int(args['--length'])
+  BenchWeb.collection().delete_many({})
+  web_id = BenchWeb.collection().insert_one({'vertices': [str(ObjectId()) for i in range(length)]}).inserted_id
+
+  def measure(name, change):
+    MongoModel.identity_map.clear()
+    web = BenchWeb.get_by_id(web_id)
+    change(web)
+
+    size = sum(len(BSON.encode(update)) for update in web.update_documents(web.changed(cascade=False)))
+    start = time.perf_counter()
+    web.save()
+    elapsed = time.perf_counter() - start
+
+    print("{:<10} {:>10} bytes  {:8.2f}ms".format(name, size, elapsed * 1000))
+
+  item = BenchItem()
+  item.save()
+
+  measure('append', lambda web: web.vertices.append(item))
+  measure('remove', lambda web: web.vertices.remove(item))
+  measure('reassign', lambda web: setattr(web, 'vertices', web.vertices + [item]))
+
+  BenchWeb.collection().delete_many({})
+  BenchItem.collection().delete_many({})
+
+
+if __name__ == '__main__':
+  args = docopt(__doc__)
+  run(args)
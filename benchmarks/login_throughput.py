@@ -0,0 +1,79 @@
+""" Logins per second under a burst of concurrent logins, and how long a cheap request waits meanwhile,
+with bcrypt run inline in every request thread or on webviz.passwords' worker pool.
+
+Run from the repository root: python -m benchmarks.login_throughput
+
+Usage:
+  login_throughput.py [--logins=<n>] [--threads=<n>] [--workers=<n>] [--rounds=<list>]
+
+Options:
+  -h --help         Show this help message
+  --logins=<n>      Password checks per run [default: 64]
+  --threads=<n>     Request threads logging in at once [default: 32]
+  --workers=<n>     Hashing threads in the pool [default: 4]
+  --rounds=<list>   Comma-separated bcrypt costs to try [default: 10,12]
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from docopt import docopt
+import statistics
+import threading
+import time
+
+
+def probe(stop, latencies, interval=0.01):
+  # a cheap request: a little pure-Python work every interval, timed from when it was due
+  while not stop.is_set():
+    due = time.perf_counter() + interval
+    time.sleep(interval)
+    sum(range(1000))
+    latencies.append(time.perf_counter() - due)
+
+
+def burst(check, password, hashed, logins, threads):
+  stop = threading.Event()
+  latencies = []
+  prober = threading.Thread(target=probe, args=(stop, latencies))
+  prober.start()
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=threads) as requests:
+    results = list(requests.map(lambda i: check(password, hashed), range(logins)))
+  elapsed = time.perf_counter() - start
+
+  stop.set()
+  prober.join()
+
+  assert all(results)
+  latencies.sort()
+  return logins / elapsed, statistics.median(latencies), latencies[int(len(latencies) * 0.99)]
+
+
+def run(args):
+  from webviz import app, passwords
+
+  app.config['PASSWORD_HASHING_WORKERS'] = int(args['--workers'])
+  logins = int(args['--logins'])
+  threads = int(args['--threads'])
+  password = 'correct horse battery staple'
+
+  print("{} logins from {} threads; the pool hashes on {}\n".format(logins, threads, args['--workers']))
+  print("{:>6} {:>8} {:>12} {:>14} {:>14}".format('rounds', 'mode', 'logins/s', 'probe p50 ms', 'probe p99 ms'))
+
+  for rounds in [int(r) for r in args['--rounds'].split(',')]:
+    hashed = passwords.hash_password_inline(password, rounds)
+
+    for mode, check in (('inline', passwords.check_password_inline), ('pool', passwords.check_password)):
+      rate, p50, p99 = burst(check, password, hashed, logins, threads)
+      print("{:>6} {:>8} {:>12.1f} {:>14.2f} {:>14.2f}".format(rounds, mode, rate, p50 * 1000, p99 * 1000))
+
+  # what a login with an outdated hash costs once: the check plus a new hash at the configured cost
+  hashed = passwords.hash_password_inline(password, 10)
+  start = time.perf_counter()
+  if passwords.check_password(password, hashed) and passwords.needs_rehash(hashed):
+    passwords.hash_password(password)
+  print("\nlogin with a rehash to cost {}: {:.1f} ms".format(passwords.configured_rounds(), (time.perf_counter() - start) * 1000))
+
+
+if __name__ == '__main__':
+  run(docopt(__doc__))
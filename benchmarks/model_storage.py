@@ -0,0 +1,76 @@
+""" Memory per instance and deserialize throughput of MongoModel instances.
+
+Run from the repository root: python -m benchmarks.model_storage
+
+Usage:
+  model_storage.py [--count=<n>] [--engine=<name>] [--uri=<uri>] [--port=<port>] [--database=<name>]
+
+Options:
+  -h --help          Show this help message
+  --count=<n>        Number of instances to deserialize [default: 100000]
+  --engine=<name>    Storage engine: mongo, or memory to run without a server [default: mongo]
+  --uri=<uri>        Mongo host [default: localhost]
+  --port=<port>      Mongo port [default: 27017]
+  --database=<name>  Mongo database used for index checks [default: ideagrapher_benchmark]
+"""
+
+from docopt import docopt
+from bson import ObjectId
+import gc
+import time
+import tracemalloc
+
+
+def run(args):
+  from graphstore.models import MongoModel, Node, ModelField, StringField, ListField, EnumField, DictField, NestedField, FloatField
+  MongoModel.connect_to_database(args['--database'], args['--uri'], int(args['--port']), engine=args['--engine'])
+
+  # shaped like webviz.models.Vertex, but without references so nothing needs to be fetched
+  class BenchVertex(MongoModel):
+    name = StringField(default='')
+    kind = EnumField(['connected', 'related', 'directed'], default='connected')
+    weight = FloatField(default=1)
+    screen = NestedField(dict(
+      x=FloatField(default=0),
+      y=FloatField(default=0),
+      xv=FloatField(default=0),
+      yv=FloatField(default=0),
+      size=FloatField(default=100),
+      color=StringField(default='gray'),
+    ))
+    labels = ListField(ModelField(Node))
+    data = DictField()
+
+  count = int(args['--count'])
+  docs = [dict(
+    _id=ObjectId(),
+    name='vertex {}'.format(i),
+    kind='connected',
+    weight=float(i),
+    screen=dict(x=float(i), y=float(-i), xv=0.0, yv=0.0, size=100.0, color='gray'),
+    labels=[],
+    data={},
+  ) for i in range(count)]
+
+  gc.collect()
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  instances = [BenchVertex.deserialize(doc) for doc in docs]
+  after = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+
+  print("memory per instance: {:.0f} bytes".format((after - before) / count))
+  del instances
+  gc.collect()
+
+  start = time.perf_counter()
+  instances = [BenchVertex.deserialize(doc) for doc in docs]
+  elapsed = time.perf_counter() - start
+
+  # the instances stay referenced until they are counted, so none are freed while being timed
+  print("deserialize: {:.0f} instances/s ({} in {:.2f}s)".format(len(instances) / elapsed, len(instances), elapsed))
+
+
+if __name__ == '__main__':
+  args = docopt(__doc__)
+  run(args)
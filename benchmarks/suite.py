@@ -0,0 +1,391 @@
+""" Times the hot paths of graphstore and webviz on synthetic documents of several sizes and on the bundled
+example data, and writes the results as JSON. With --baseline, or the compare command on two result files,
+every timing more than --threshold slower than the baseline is flagged, and the exit status is 1.
+
+Each dataset becomes a public Document with one Web over its Graph: a Vertex per Node and an Edge per
+Link. The default memory engine keeps everything in this process (see graphstore.memory), so runs are
+repeatable and time graphstore itself; --engine=mongo times a real server instead.
+
+Run it from the repository root, as a module so graphstore and webviz can be imported:
+  python -m benchmarks.suite --sizes=1000 --output=before.json
+  python -m benchmarks.suite compare before.json after.json
+
+Usage:
+  suite.py [--sizes=<list>] [--datasets=<list>] [--benchmarks=<list>] [--degree=<x>] [--repeat=<n>] [--save-count=<n>] [--output=<file>] [--baseline=<file>] [--threshold=<x>] [--engine=<name>] [--uri=<uri>] [--port=<port>] [--database=<name>]
+  suite.py compare <baseline> <results> [--threshold=<x>]
+
+Options:
+  -h --help            Show this help message
+  --sizes=<list>       Vertices in each synthetic document, comma-separated [default: 1000,10000,100000]
+  --datasets=<list>    Example data sets to add, comma-separated; "none" for none [default: stack-network,plant-pollinator]
+  --benchmarks=<list>  Benchmarks to run, comma-separated [default: all]
+  --degree=<x>         Edges per vertex in the synthetic documents [default: 1.5]
+  --repeat=<n>         Runs of each benchmark; the best and the median are kept [default: 3]
+  --save-count=<n>     Most vertices saved by the save benchmarks [default: 1000]
+  --output=<file>      Where to write the results [default: benchmark-results.json]
+  --baseline=<file>    Results to compare this run's against
+  --threshold=<x>      How much slower than the baseline counts as a regression [default: 0.2]
+  --engine=<name>      Storage engine: memory, or mongo for a server [default: memory]
+  --uri=<uri>          Mongo host [default: localhost]
+  --port=<port>        Mongo port [default: 27017]
+  --database=<name>    Mongo database to write to; its graphstore collections are dropped [default: ideagrapher_benchmark]
+"""
+
+from collections import OrderedDict
+from docopt import docopt
+import csv
+import datetime
+import json
+import logging
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+EXAMPLE_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example-data')
+
+
+# ## Datasets
+# Each makes a Graph with graphstore.importers and returns its id.
+def synthetic_graph(size, degree, seed=0):
+  from graphstore.importers import GraphImporter
+
+  rng = random.Random(seed)
+  importer = GraphImporter()
+  for i in range(size):
+    importer.add_node('v{}'.format(i), {'group': i % 12, 'weight': rng.random()})
+
+  for i in range(int(size * degree)):
+    importer.add_link('v{}'.format(rng.randrange(size)), 'v{}'.format(rng.randrange(size)), {'weight': rng.random()})
+
+  return importer.finish()
+
+
+def stack_network_graph():
+  from graphstore.importers import import_files
+
+  graph_id, counts = import_files(links_path=os.path.join(EXAMPLE_DATA, 'stack_network_links.csv'),
+                                  nodes_path=os.path.join(EXAMPLE_DATA, 'stack_network_nodes.csv'))
+  return graph_id
+
+
+def plant_pollinator_graph():
+  # the interaction matrix of example-data/plant_pollinator1_parser.py: plants across, pollinators down
+  from graphstore.importers import GraphImporter
+
+  importer = GraphImporter()
+  with open(os.path.join(EXAMPLE_DATA, 'arroyo_I plant-pollinator.csv')) as f:
+    reader = csv.reader(f)
+    genera, species = next(reader), next(reader)
+    next(reader)
+
+    plants = []
+    for genus, kind in zip(genera[3:], species[3:]):
+      plants.append(genus + '\n' + kind)
+      importer.add_node(plants[-1], {'blurb': 'plant'})
+
+    for row in reader:
+      pollinator = row[0] + '\n' + row[1]
+      importer.add_node(pollinator, {'blurb': 'pollinator'})
+      for plant, cell in zip(plants, row[3:]):
+        if cell == '1':
+          importer.add_link(plant, pollinator)
+
+  return importer.finish()
+
+
+EXAMPLE_DATASETS = OrderedDict([
+  ('stack-network', stack_network_graph),
+  ('plant-pollinator', plant_pollinator_graph),
+])
+
+
+def build_document(name, graph_id, seed=0):
+  # the Document, Web, Vertices and Edges webviz shows a graph with, saved in one session
+  from graphstore.models import Graph
+  from graphstore.session import Session
+  from webviz.models import Document, Web, Vertex, Edge
+
+  rng = random.Random(seed)
+  graph = Graph.get_by_id(graph_id)
+  vertices = {}
+  edges = []
+
+  with Session():
+    for node in graph.nodes:
+      vertices[node.id] = Vertex(node=node, screen={'x': rng.uniform(-500, 500), 'y': rng.uniform(-500, 500)})
+      vertices[node.id].save()
+
+    for link in graph.links:
+      edge = Edge(link=link, start_vertices=[vertices[node.id] for node in link.sources],
+                  end_vertices=[vertices[node.id] for node in link.sinks])
+      edge.save()
+      edges.append(edge)
+
+    web = Web(name=name, graph=graph, vertices=list(vertices.values()), edges=edges)
+    web.save()
+
+    doc = Document(name=name, owner='benchmark', visibility='public', webs=[web])
+    doc.save()
+
+  return {
+    'docid': doc.id,
+    'webid': web.id,
+    'vertex_ids': [vertex._id for vertex in vertices.values()],
+    'vertex_docs': list(Vertex.collection().find({'_id': {'$in': [vertex._id for vertex in vertices.values()]}})),
+    'objects': 2 + len(vertices) + len(edges),
+    'vertices': len(vertices),
+    'edges': len(edges),
+  }
+
+
+# ## Benchmarks
+# Each is (setup, step, ops): setup(ctx) makes what step(ctx, state) needs, outside the timing, and ops(ctx)
+# says how many things one step handles. Both run in a fresh identity map scope, like a request.
+def loaded_tree(ctx):
+  from webviz.models import Document
+
+  doc = Document.load_tree(ctx['docid'])
+  web = doc.webs[0]
+  return doc, list(web.vertices), list(web.edges)
+
+
+def loaded_vertices(ctx):
+  from webviz.models import Vertex
+
+  vertices = list(Vertex.find({'_id': {'$in': ctx['vertex_ids'][:ctx['save_count']]}}))
+  for i, vertex in enumerate(vertices):
+    vertex.data = {'benchmark': i}
+
+  return vertices
+
+
+def find_step(ctx, state):
+  from webviz.models import Vertex
+  list(Vertex.find({'_id': {'$in': ctx['vertex_ids']}}))
+
+
+def deserialize_step(ctx, state):
+  from webviz.models import Vertex
+  for doc in ctx['vertex_docs']:
+    Vertex.deserialize(doc)
+
+
+def list_resolve_step(ctx, state):
+  from webviz.models import Web
+  web = Web.get_by_id(ctx['webid'])
+  list(web.vertices)
+  list(web.edges)
+
+
+def load_tree_step(ctx, state):
+  from webviz.models import Document
+  Document.load_tree(ctx['docid'])
+
+
+def serialize_step(ctx, state):
+  doc, vertices, edges = state
+  for obj in vertices + edges:
+    obj.serialize()
+
+
+def json_step(ctx, state):
+  doc, vertices, edges = state
+  ''.join(doc.iter_json())
+
+
+def changed_setup(ctx):
+  doc, vertices, edges = loaded_tree(ctx)
+  for vertex in vertices:
+    vertex.screen = {'x': vertex.screen['x'] + 1}
+
+  return vertices + edges
+
+
+def changed_step(ctx, objs):
+  for obj in objs:
+    obj.changed()
+
+
+def save_step(ctx, vertices):
+  for vertex in vertices:
+    vertex.save()
+
+
+def session_save_step(ctx, vertices):
+  from graphstore.session import Session
+
+  with Session():
+    for vertex in vertices:
+      vertex.save()
+
+
+def request(ctx, method, url, **kwargs):
+  response = getattr(ctx['client'], method)(url, **kwargs)
+
+  if response.status_code != 200:
+    raise RuntimeError("{} {} returned {}.".format(method.upper(), url, response.status_code))
+
+  return response
+
+
+def update_data_setup(ctx):
+  # what the editor sends when vertices are dragged
+  rng = random.Random(0)
+  data = [{
+    '$model': 'Vertex',
+    '$id': str(vertex_id),
+    '$update': [{'$key': 'screen', '$action': 'overwrite', '$type': 'nested',
+                 '$value': {'x': rng.uniform(-500, 500), 'y': rng.uniform(-500, 500)}}],
+  } for vertex_id in ctx['vertex_ids'][:min(ctx['save_count'], 100)]]
+
+  return {'data': json.dumps(data), 'docid': str(ctx['docid'])}
+
+
+BENCHMARKS = OrderedDict([
+  ('find', (None, find_step, lambda ctx: ctx['vertices'])),
+  ('deserialize', (None, deserialize_step, lambda ctx: ctx['vertices'])),
+  ('list_resolve', (None, list_resolve_step, lambda ctx: ctx['vertices'] + ctx['edges'])),
+  ('load_tree', (None, load_tree_step, lambda ctx: ctx['objects'])),
+  ('serialize', (loaded_tree, serialize_step, lambda ctx: ctx['vertices'] + ctx['edges'])),
+  ('json', (loaded_tree, json_step, lambda ctx: ctx['objects'])),
+  ('changed', (changed_setup, changed_step, lambda ctx: ctx['vertices'] + ctx['edges'])),
+  ('save', (loaded_vertices, save_step, lambda ctx: min(ctx['vertices'], ctx['save_count']))),
+  ('session_save', (loaded_vertices, session_save_step, lambda ctx: min(ctx['vertices'], ctx['save_count']))),
+  ('render_view', (None, lambda ctx, state: request(ctx, 'get', '/render/{}'.format(ctx['docid'])), lambda ctx: 1)),
+  ('document_api', (None, lambda ctx, state: request(ctx, 'get', '/api/document/{}'.format(ctx['docid'])), lambda ctx: 1)),
+  ('update_data', (update_data_setup, lambda ctx, state: request(ctx, 'put', '/updatedata', data=state),
+                   lambda ctx: min(ctx['vertices'], ctx['save_count'], 100))),
+])
+
+
+def measure(ctx, setup, step, repeat):
+  from graphstore.models import MongoModel
+
+  times = []
+  for _ in range(repeat):
+    with MongoModel.identity_map.scope():
+      state = setup(ctx) if setup is not None else None
+      start = time.perf_counter()
+      step(ctx, state)
+      times.append(time.perf_counter() - start)
+
+  return min(times), statistics.median(times)
+
+
+# ## Results
+def git_revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                   cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def compare(baseline, results, threshold):
+  # prints every timing both have, and returns the keys of those that regressed
+  regressions = []
+  print("\n{:<40} {:>12} {:>12} {:>8}".format('benchmark', 'baseline ms', 'now ms', 'change'))
+
+  for key, result in results['results'].items():
+    before = baseline['results'].get(key)
+    if before is None:
+      continue
+
+    change = result['best'] / before['best'] - 1 if before['best'] else 0
+    flag = ''
+    if change > threshold:
+      regressions.append(key)
+      flag = '  REGRESSION'
+
+    print("{:<40} {:>12.2f} {:>12.2f} {:>+7.0%}{}".format(key, before['best'] * 1000, result['best'] * 1000, change, flag))
+
+  print("\n{} of {} timings regressed by more than {:.0%}".format(
+    len(regressions), sum(1 for key in results['results'] if key in baseline['results']), threshold))
+  return regressions
+
+
+def load_results(path):
+  with open(path) as f:
+    return json.load(f)
+
+
+def run(args):
+  os.environ.setdefault('WEBVIZ_SETTINGS', 'settings.py')
+  from webviz import app
+  from graphstore.models import MongoModel, Graph, Node, Link
+  from webviz.models import Document, Web, Vertex, Edge
+
+  # the views log every update in debug mode, which isn't what is being timed
+  app.logger.setLevel(logging.INFO)
+
+  # the app's connection is replaced with the benchmark's
+  MongoModel.connect_to_database(args['--database'], args['--uri'], int(args['--port']), engine=args['--engine'])
+  for model in (Graph, Node, Link, Document, Web, Vertex, Edge):
+    model.collection().drop()
+
+  names = list(BENCHMARKS) if args['--benchmarks'] == 'all' else args['--benchmarks'].split(',')
+  for name in names:
+    if name not in BENCHMARKS:
+      sys.exit("Unknown benchmark {}; they are {}.".format(name, ', '.join(BENCHMARKS)))
+
+  datasets = [('synthetic-{}'.format(size), lambda size=size: synthetic_graph(size, float(args['--degree'])))
+              for size in [int(size) for size in args['--sizes'].split(',') if size]]
+  if args['--datasets'] != 'none':
+    datasets += [(name, EXAMPLE_DATASETS[name]) for name in args['--datasets'].split(',')]
+
+  repeat = int(args['--repeat'])
+  results = OrderedDict()
+
+  print("{:<40} {:>8} {:>12} {:>12} {:>14}".format('benchmark', 'ops', 'best ms', 'median ms', 'ops/s'))
+  for dataset, make_graph in datasets:
+    start = time.perf_counter()
+    with MongoModel.identity_map.scope():
+      ctx = build_document(dataset, make_graph())
+
+    ctx.update(client=app.test_client(), save_count=int(args['--save-count']))
+    print("{}: {} vertices, {} edges, built in {:.1f}s".format(dataset, ctx['vertices'], ctx['edges'], time.perf_counter() - start))
+
+    for name in names:
+      setup, step, ops = BENCHMARKS[name]
+      best, median = measure(ctx, setup, step, repeat)
+      count = ops(ctx)
+
+      key = '{}/{}'.format(dataset, name)
+      results[key] = {'dataset': dataset, 'benchmark': name, 'ops': count, 'best': best, 'median': median,
+                      'ops_per_second': count / best if best else math.inf}
+      print("{:<40} {:>8} {:>12.2f} {:>12.2f} {:>14.1f}".format(key, count, best * 1000, median * 1000, count / best if best else 0))
+
+  output = {
+    'meta': {
+      'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+      'revision': git_revision(),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'engine': args['--engine'],
+      'repeat': repeat,
+      'degree': float(args['--degree']),
+    },
+    'results': results,
+  }
+
+  with open(args['--output'], 'w') as f:
+    json.dump(output, f, indent=2)
+  print("\nresults written to {}".format(args['--output']))
+
+  if args['--baseline'] and compare(load_results(args['--baseline']), output, float(args['--threshold'])):
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  args = docopt(__doc__)
+
+  if args['compare']:
+    if compare(load_results(args['<baseline>']), load_results(args['<results>']), float(args['--threshold'])):
+      sys.exit(1)
+  else:
+    run(args)
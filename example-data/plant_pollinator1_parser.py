@@ -1,17 +1,25 @@
-from graphstore.models import MongoModel, Graph, Node, Link, ObjectNotFound
+from pymongo import MongoClient
 import csv
-# from bson import ObjectId
 
-MongoModel.set_database("test")
-MongoModel.connect("localhost", 27017)
+import graphstore
+graphstore.MONGO_CLIENT = MongoClient("localhost", 27017)
+graphstore.MONGO_DATABASE = "test"
 
-try:
-    graph = Graph.find_one({'slug': 'plant-pollinator1'})
-    print("Graph found!", graph)
-except ObjectNotFound:
-    graph = Graph(slug='plant-pollinator1')
+from graphstore.models import Graph  # noqa
+from graphstore.importers import GraphImporter  # noqa
+
+doc = Graph.collection().find_one({'data.slug': 'plant-pollinator1'}, projection=[])
+if doc is not None:
+    graph_id = doc['_id']
+    print("Graph found!", graph_id)
+else:
+    graph = Graph(data={'slug': 'plant-pollinator1'})
     graph.save()
-    print("Graph created:", graph)
+    graph_id = graph.id
+    print("Graph created:", graph_id)
+
+# nodes and links already in the graph are recognized by name, so running this again adds nothing
+importer = GraphImporter(graph=graph_id, key='name')
 
 filepath = "example-data/arroyo_I plant-pollinator.csv"
 reader = csv.reader(open(filepath))
@@ -20,49 +28,19 @@ row1 = next(reader)
 row2 = next(reader)
 next(reader)
 
-plantN = len(row1) - 3
-plantNodes = []
-
-for i in range(plantN):
-    name = row1[i + 3] + '\n' + row2[i + 3]
-
-    try:
-        node = Node.find_one({'shortname': name})
-        print("Found node!", name, node)
-    except ObjectNotFound:
-        node = Node(shortname=name, blurb='plant')
-        node.save()
-        print("Node created:", name, node)
-
-    plantNodes.append(node)
-    if node not in graph.nodes:
-        graph.nodes.append(node)
+plantNames = []
+for genus, species in zip(row1[3:], row2[3:]):
+    name = genus + '\n' + species
+    importer.add_node(name, {'blurb': 'plant'})
+    plantNames.append(name)
 
 for row in reader:
     name = row[0] + '\n' + row[1]
-
-    try:
-        node = Node.find_one({'shortname': name})
-        print("Found node!", name, node)
-    except ObjectNotFound:
-        node = Node(shortname=name, blurb='pollinator')
-        node.save()
-        print("Node created:", name, node)
-
-    if node not in graph.nodes:
-        graph.nodes.append(node)
+    importer.add_node(name, {'blurb': 'pollinator'})
 
     for i, k in enumerate(row[3:]):
         if k == '1':  # there is a relationship
-            try:
-                link = Link.find_one({'sources': [plantNodes[i - 3].id], 'sinks': [node.id]})
-                print("Found link!", link)
-            except ObjectNotFound:
-                link = Link(kind="directed", sources=[plantNodes[i - 3]], sinks=[node], closeness=50)
-                link.save()
-                print("Link created:", link)
-
-            if link not in graph.links:
-                graph.links.append(link)
+            importer.add_link(plantNames[i], name)
 
-graph.save()
+importer.finish()
+print("Imported:", importer.counts)
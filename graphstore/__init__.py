@@ -0,0 +1,4 @@
+# The connection graphstore.models starts out with; set these before importing it, or connect later
+# with MongoModel.connect_to_database.
+MONGO_CLIENT = None
+MONGO_DATABASE = None
@@ -0,0 +1,235 @@
+from collections import OrderedDict
+
+from bson import ObjectId
+import numpy as np
+import threading
+
+from .models import Graph, Link, ObjectNotFound
+
+LINK_BATCH_SIZE = 50000  # link documents fetched per $in query while building a snapshot
+CACHE_SIZE = 8  # snapshots kept at once; the least recently used one goes first
+
+snapshots = OrderedDict()  # graph id -> GraphSnapshot
+lock = threading.Lock()  # request threads share snapshots
+
+
+def snapshot(graph):
+  # The GraphSnapshot of a stored Graph (or its id), rebuilt only when the graph's revision has moved on.
+  # It is built from the raw documents, so no Node or Link objects are made along the way.
+  graph_id = ObjectId(graph if isinstance(graph, str) else graph.id)
+
+  doc = Graph.collection().find_one({'_id': graph_id}, projection=['revision'])
+  if doc is None:
+    raise ObjectNotFound("No {} was found with id {}.".format(Graph, graph_id))
+
+  key = str(graph_id)
+  revision = doc.get('revision', 0)
+
+  with lock:
+    cached = snapshots.get(key)
+    if cached is not None and cached.revision == revision:
+      snapshots.move_to_end(key)
+      return cached
+
+  # loaded outside of the lock, so other graphs' snapshots aren't held up meanwhile
+  loaded = GraphSnapshot.load(graph_id)
+
+  with lock:
+    snapshots[key] = loaded
+    while len(snapshots) > CACHE_SIZE:
+      snapshots.popitem(last=False)
+
+  return loaded
+
+
+# ## CSR snapshots
+class GraphSnapshot(object):
+  # A Graph as compressed sparse row adjacency: node i's out-neighbors are out_indices[out_indptr[i]:out_indptr[i + 1]].
+  # A link with several sources or sinks contributes an edge for every (source, sink) pair.
+  # Results are NumPy arrays indexed like node_ids; index maps ids back to those positions.
+  def __init__(self, graph_id, revision, node_ids, sources, sinks):
+    self.graph_id = str(graph_id)
+    self.revision = revision
+    self.node_ids = list(node_ids)
+    self.index = {node_id: i for i, node_id in enumerate(self.node_ids)}
+
+    self.sources = np.asarray(sources, dtype=np.int64)
+    self.sinks = np.asarray(sinks, dtype=np.int64)
+
+    self.out_indptr, self.out_indices = self.csr(self.sources, self.sinks)
+    self.in_indptr, self.in_indices = self.csr(self.sinks, self.sources)
+    self.both = None  # undirected adjacency, built on first use
+
+  @classmethod
+  def load(cls, graph_id):
+    doc = Graph.collection().find_one({'_id': graph_id}, projection=['revision', 'nodes', 'links'])
+    if doc is None:
+      raise ObjectNotFound("No {} was found with id {}.".format(Graph, graph_id))
+
+    node_ids = [str(node_id) for node_id in doc.get('nodes', [])]
+    index = {node_id: i for i, node_id in enumerate(node_ids)}
+
+    def index_of(node_id):
+      # nodes only reachable through links still get a place, so no edge is dropped
+      i = index.get(node_id)
+      if i is None:
+        i = index[node_id] = len(node_ids)
+        node_ids.append(node_id)
+
+      return i
+
+    sources = []
+    sinks = []
+    link_ids = [ObjectId(link_id) if isinstance(link_id, str) else link_id for link_id in doc.get('links', [])]
+
+    for start in range(0, len(link_ids), LINK_BATCH_SIZE):
+      chunk = link_ids[start:start + LINK_BATCH_SIZE]
+
+      for link in Link.collection().find({'_id': {'$in': chunk}}, projection=['sources', 'sinks']):
+        link_sinks = [index_of(str(sink_id)) for sink_id in link.get('sinks', [])]
+
+        for source_id in link.get('sources', []):
+          source = index_of(str(source_id))
+          sources.extend([source] * len(link_sinks))
+          sinks.extend(link_sinks)
+
+    return cls(graph_id, doc.get('revision', 0), node_ids, sources, sinks)
+
+  def csr(self, rows, columns):
+    order = np.argsort(rows, kind='stable')
+    indptr = np.zeros(len(self.node_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=len(self.node_ids)), out=indptr[1:])
+
+    return indptr, columns[order]
+
+  @property
+  def node_count(self):
+    return len(self.node_ids)
+
+  @property
+  def edge_count(self):
+    return len(self.sources)
+
+  def node_index(self, node):
+    node_id = node if isinstance(node, str) else node.id
+    if node_id not in self.index:
+      raise ValueError("Node {} is not in graph {}.".format(node_id, self.graph_id))
+
+    return self.index[node_id]
+
+  def adjacency(self, direction):
+    if direction == 'out':
+      return self.out_indptr, self.out_indices
+    elif direction == 'in':
+      return self.in_indptr, self.in_indices
+    elif direction == 'both':
+      if self.both is None:
+        self.both = self.csr(np.concatenate([self.sources, self.sinks]), np.concatenate([self.sinks, self.sources]))
+
+      return self.both
+    else:
+      raise ValueError("Direction must be 'out', 'in' or 'both', not {}.".format(direction))
+
+  def expand(self, frontier, direction):
+    # every (node in frontier, neighbor) pair, as two aligned arrays, gathered without a Python loop
+    indptr, indices = self.adjacency(direction)
+    starts = indptr[frontier]
+    counts = indptr[frontier + 1] - starts
+
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(frontier, counts), indices[np.repeat(starts, counts) + offsets]
+
+  # ## Algorithms
+  def bfs(self, source, direction='out', max_depth=None):
+    # level-synchronous breadth-first search; returns (distances, parents), both -1 where unreachable
+    distances = np.full(self.node_count, -1, dtype=np.int64)
+    parents = np.full(self.node_count, -1, dtype=np.int64)
+
+    start = self.node_index(source)
+    distances[start] = 0
+    frontier = np.array([start], dtype=np.int64)
+    depth = 0
+
+    while len(frontier) and (max_depth is None or depth < max_depth):
+      origins, neighbors = self.expand(frontier, direction)
+
+      unseen = distances[neighbors] == -1
+      neighbors, first = np.unique(neighbors[unseen], return_index=True)
+
+      depth += 1
+      distances[neighbors] = depth
+      parents[neighbors] = origins[unseen][first]
+      frontier = neighbors
+
+    return distances, parents
+
+  def shortest_path_lengths(self, source, direction='out'):
+    return self.bfs(source, direction=direction)[0]
+
+  def shortest_path(self, source, target, direction='out'):
+    # node ids from source to target along the fewest links, or None if target can't be reached
+    distances, parents = self.bfs(source, direction=direction)
+
+    current = self.node_index(target)
+    if distances[current] == -1:
+      return None
+
+    path = [current]
+    while parents[current] != -1:
+      current = parents[current]
+      path.append(current)
+
+    return [self.node_ids[i] for i in reversed(path)]
+
+  def connected_components(self):
+    # weakly connected components by min-label propagation with pointer jumping;
+    # returns (component count, labels), where labels number the components from 0
+    labels = np.arange(self.node_count, dtype=np.int64)
+
+    while True:
+      previous = labels.copy()
+
+      np.minimum.at(labels, self.sources, labels[self.sinks])
+      np.minimum.at(labels, self.sinks, labels[self.sources])
+
+      while True:
+        jumped = labels[labels]
+        if np.array_equal(jumped, labels):
+          break
+        labels = jumped
+
+      if np.array_equal(labels, previous):
+        break
+
+    roots, labels = np.unique(labels, return_inverse=True)
+    return len(roots), labels
+
+  def pagerank(self, damping=0.85, tolerance=1e-6, max_iterations=100):
+    # power iteration; the rank of nodes without out-links is spread evenly over all nodes
+    n = self.node_count
+    if n == 0:
+      return np.zeros(0)
+
+    out_degrees = self.degrees('out').astype(np.float64)
+    dangling = out_degrees == 0
+    share = np.divide(1.0, out_degrees, out=np.zeros(n), where=~dangling)
+
+    ranks = np.full(n, 1.0 / n)
+    for iteration in range(max_iterations):
+      flow = np.bincount(self.sinks, weights=(ranks * share)[self.sources], minlength=n)
+      new_ranks = (1 - damping) / n + damping * (flow + ranks[dangling].sum() / n)
+
+      converged = np.abs(new_ranks - ranks).sum() < tolerance
+      ranks = new_ranks
+      if converged:
+        break
+
+    return ranks
+
+  def degrees(self, direction='out'):
+    indptr = self.adjacency(direction)[0]
+    return np.diff(indptr)
+
+  def degree_distribution(self, direction='out'):
+    # entry k is the number of nodes with degree k
+    return np.bincount(self.degrees(direction), minlength=1)
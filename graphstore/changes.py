@@ -0,0 +1,105 @@
+from collections import OrderedDict
+
+from bson import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+
+from .models import MongoModel, MongoIndex, ObjectNotFound, StringField, IntegerField, ListField, RawField
+from .session import current_change_log
+
+LOG_LENGTH = 1000  # revisions kept per owner; clients further behind than that have to load everything again
+TRIM_EVERY = 100  # revisions between trims of an owner's log
+
+
+class Change(MongoModel):
+  # one revision of an owner: [model name, id, deleted] for every object written in it
+  owner = StringField()
+  revision = IntegerField(default=0)
+  objects = ListField(RawField())
+
+  owner_revision_index = MongoIndex(['owner', 'revision'], unique=True)
+
+
+# ## Change logs
+# While a ChangeLog is active, every save and delete (direct, or through a Session) is noted. On exit what was
+# written becomes one revision of the owner, a model with a `revision` IntegerField like webviz's Document: the
+# revision goes up with $inc and a Change lists the objects, which changes_since() gathers for clients.
+class ChangeLog(object):
+  def __init__(self, owner_class, owner_id):
+    self.owner_class = owner_class
+    self.owner_id = ObjectId(owner_id)
+    self.objects = OrderedDict()  # (model name, id) -> deleted
+    self.revision = None
+    self.token = None
+
+  def __enter__(self):
+    self.token = current_change_log.set(self)
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    try:
+      # committed after errors too, since whatever was written before them is in the database
+      self.commit()
+    finally:
+      current_change_log.reset(self.token)
+      self.token = None
+
+  def record(self, obj, deleted=False):
+    if isinstance(obj, Change):
+      return
+
+    key = (obj.__class__.__name__, obj.id)
+    self.objects.pop(key, None)  # only the last write counts, and it moves to the end
+    self.objects[key] = deleted
+
+  def commit(self):
+    # returns the new revision, or None if nothing was written
+    if not self.objects:
+      return None
+
+    owner = self.owner_class.collection().find_one_and_update(
+      {'_id': self.owner_id}, {'$inc': {'revision': 1}}, projection=['revision'], return_document=ReturnDocument.AFTER)
+
+    objects = [[name, obj_id, deleted] for (name, obj_id), deleted in self.objects.items()]
+    self.objects.clear()
+
+    if owner is None:
+      return None  # the owner itself was deleted, so there is nobody left to ask for its changes
+
+    self.revision = owner['revision']
+    Change.collection().insert_one({'owner': str(self.owner_id), 'revision': self.revision, 'objects': objects})
+
+    if self.revision % TRIM_EVERY == 0:
+      Change.collection().delete_many({'owner': str(self.owner_id), 'revision': {'$lte': self.revision - LOG_LENGTH}})
+
+    return self.revision
+
+
+def changes_since(owner_class, owner_id, since):
+  # Returns (current revision, {(model name, id): deleted}) for every object written after revision since,
+  # or (current revision, None) if the log doesn't go back that far and the client has to start over.
+  owner = owner_class.collection().find_one({'_id': ObjectId(owner_id)}, projection=['revision'])
+  if owner is None:
+    raise ObjectNotFound("No {} was found with id {}.".format(owner_class, owner_id))
+
+  revision = owner.get('revision', 0)
+  if since == revision:
+    return revision, OrderedDict()
+  elif since > revision:
+    return revision, None
+
+  objects = OrderedDict()
+  expected = since + 1
+
+  for change in Change.collection().find({'owner': str(owner_id), 'revision': {'$gt': since}}, sort=[('revision', ASCENDING)]):
+    if change['revision'] != expected:
+      return revision, None  # trimmed away
+
+    expected += 1
+    for name, obj_id, deleted in change['objects']:
+      objects.pop((name, obj_id), None)
+      objects[(name, obj_id)] = deleted
+
+  if expected <= revision:
+    return revision, None  # a revision whose Change was never written, e.g. by a process that died in between
+
+  return revision, objects
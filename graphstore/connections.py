@@ -0,0 +1,279 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import os
+import threading
+
+from pymongo import MongoClient, AsyncMongoClient, ReadPreference, monitoring
+
+import graphstore
+from .memory import MemoryClient, AsyncMemoryClient
+from .metrics import command_metrics
+
+DEFAULT = 'default'
+
+ENGINES = ('mongo', 'memory')
+
+READ_PREFERENCES = {
+  'primary': ReadPreference.PRIMARY,
+  'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+  'secondary': ReadPreference.SECONDARY,
+  'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED,
+  'nearest': ReadPreference.NEAREST,
+}
+
+# read preference for the reads of MongoModel.find, find_one and load_tree in this context; see reading_from()
+current_read_preference = ContextVar('graphstore_read_preference', default=None)
+
+
+# ## Pool statistics
+class PoolStats(monitoring.ConnectionPoolListener):
+  # Counts the connection pool events of a client. pymongo calls these from its own threads, hence the lock.
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.created = 0
+    self.closed = 0
+    self.checked_out = 0
+    self.checkout_failures = 0
+    self.clears = 0
+    self.in_use = 0
+    self.most_in_use = 0
+
+  def count(self, name, in_use=0):
+    with self.lock:
+      setattr(self, name, getattr(self, name) + 1)
+      self.in_use += in_use
+      self.most_in_use = max(self.most_in_use, self.in_use)
+
+  def connection_created(self, event):
+    self.count('created')
+
+  def connection_closed(self, event):
+    self.count('closed')
+
+  def connection_checked_out(self, event):
+    self.count('checked_out', 1)
+
+  def connection_checked_in(self, event):
+    with self.lock:
+      self.in_use -= 1
+
+  def connection_check_out_failed(self, event):
+    self.count('checkout_failures')
+
+  def pool_cleared(self, event):
+    self.count('clears')
+
+  # the events nothing is counted for
+  def connection_ready(self, event):
+    pass
+
+  def connection_check_out_started(self, event):
+    pass
+
+  def pool_created(self, event):
+    pass
+
+  def pool_ready(self, event):
+    pass
+
+  def pool_closed(self, event):
+    pass
+
+  def snapshot(self):
+    with self.lock:
+      return {
+        'open': self.created - self.closed,
+        'in_use': self.in_use,
+        'most_in_use': self.most_in_use,
+        'created': self.created,
+        'closed': self.closed,
+        'checked_out': self.checked_out,
+        'checkout_failures': self.checkout_failures,
+        'clears': self.clears,
+      }
+
+
+# ## Connections
+class Connection(object):
+  # The settings of one Mongo deployment, and its clients. Clients are only made when first used, and made again
+  # in a process forked after that, since a MongoClient must not be shared across fork(): pre-fork servers can
+  # set connections up in the parent and every worker gets its own pool. Clients passed in as client and
+  # async_client are used as they are (e.g. mongomock in tests), and are never replaced. engine='memory' stores
+  # everything in this process instead (see graphstore.memory), with one store shared by both clients.
+  def __init__(self, database=None, uri='localhost', port=27017, max_pool_size=100, min_pool_size=0,
+               max_idle_time_ms=None, connect_timeout_ms=20000, server_selection_timeout_ms=30000,
+               socket_timeout_ms=None, wait_queue_timeout_ms=None, read_preference='primary',
+               client=None, async_client=None, engine='mongo', **client_kwargs):
+    if read_preference not in READ_PREFERENCES:
+      raise ValueError("Read preference must be one of {}, not {}.".format(', '.join(READ_PREFERENCES), read_preference))
+    if engine not in ENGINES:
+      raise ValueError("Storage engine must be one of {}, not {}.".format(', '.join(ENGINES), engine))
+
+    if engine == 'memory':
+      client = client or MemoryClient()
+      async_client = async_client or AsyncMemoryClient(client)
+
+    self.database = database
+    self.engine = engine
+    self.uri = uri
+    self.port = port
+    self.read_preference = read_preference
+    self.settings = dict(client_kwargs, maxPoolSize=max_pool_size, minPoolSize=min_pool_size,
+                         maxIdleTimeMS=max_idle_time_ms, connectTimeoutMS=connect_timeout_ms,
+                         serverSelectionTimeoutMS=server_selection_timeout_ms, socketTimeoutMS=socket_timeout_ms,
+                         waitQueueTimeoutMS=wait_queue_timeout_ms, readPreference=read_preference)
+
+    self.given_client = client
+    self.given_async_client = async_client
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    self.pid = os.getpid()
+    self._client = self.given_client
+    self._async_client = self.given_async_client
+    self.collections = {}  # (database, collection, read preference) -> Collection
+    self.stats = PoolStats()
+    self.async_stats = PoolStats()
+
+  def check_pid(self):
+    if self.pid != os.getpid():
+      # forked: the parent's clients are left alone, their sockets belong to it
+      with self.lock:
+        if self.pid != os.getpid():
+          self.reset()
+
+  def client_settings(self, stats):
+    settings = dict((name, value) for name, value in self.settings.items() if value is not None)
+    settings['event_listeners'] = list(settings.get('event_listeners', [])) + [stats, command_metrics]
+    return settings
+
+  def client(self):
+    self.check_pid()
+    if self._client is None:
+      with self.lock:
+        if self._client is None:
+          self._client = MongoClient(self.uri, self.port, **self.client_settings(self.stats))
+
+    return self._client
+
+  def async_client(self):
+    self.check_pid()
+    if self._async_client is None:
+      with self.lock:
+        if self._async_client is None:
+          self._async_client = AsyncMongoClient(self.uri, self.port, **self.client_settings(self.async_stats))
+
+    return self._async_client
+
+  def database_name(self, database=None):
+    database = database or self.database
+    if not database:
+      raise ValueError("Must be connected to Mongo: no database was given, and the connection has none.")
+
+    return database
+
+  def collection(self, name, database=None, read_preference=None):
+    key = (self.database_name(database), name, read_preference)
+    collection = self.collections.get(key)
+
+    if collection is None or self.pid != os.getpid():
+      collection = self.client()[key[0]][name]
+      if read_preference is not None and read_preference != self.read_preference:
+        collection = collection.with_options(read_preference=READ_PREFERENCES[read_preference])
+
+      self.collections[key] = collection
+
+    return collection
+
+  def async_collection(self, name, database=None, read_preference=None):
+    collection = self.async_client()[self.database_name(database)][name]
+    if read_preference is not None and read_preference != self.read_preference:
+      collection = collection.with_options(read_preference=READ_PREFERENCES[read_preference])
+
+    return collection
+
+  def pool_stats(self):
+    # pool statistics of the clients made in this process so far
+    return {'sync': self.stats.snapshot(), 'async': self.async_stats.snapshot()}
+
+  def close(self):
+    if self._client is not None and self._client is not self.given_client and self.pid == os.getpid():
+      self._client.close()
+
+    self._client = self.given_client
+    self.collections = {}
+
+  async def aclose(self):
+    if self._async_client is not None and self._async_client is not self.given_async_client and self.pid == os.getpid():
+      await self._async_client.close()
+
+    self._async_client = self.given_async_client
+
+
+# ## Registry
+# Connections by alias. MongoModel.CONNECTION names the one a model uses ('default' unless a model is routed
+# elsewhere); without any registered, 'default' falls back to graphstore.MONGO_CLIENT and MONGO_DATABASE.
+connections = {}
+registry_lock = threading.Lock()
+
+
+def register_connection(alias=DEFAULT, **settings):
+  # Adds or replaces the connection alias, with the settings of Connection. Returns the Connection.
+  connection = Connection(**settings)
+
+  with registry_lock:
+    old = connections.get(alias)
+    connections[alias] = connection
+
+  if old is not None:
+    old.close()
+
+  return connection
+
+
+def get_connection(alias=DEFAULT):
+  connection = connections.get(alias)
+  if connection is not None:
+    return connection
+
+  if alias == DEFAULT and graphstore.MONGO_CLIENT is not None:
+    with registry_lock:
+      if alias not in connections:
+        connections[alias] = Connection(database=graphstore.MONGO_DATABASE, client=graphstore.MONGO_CLIENT)
+
+      return connections[alias]
+
+  raise ValueError("Must be connected to Mongo: no connection {} is registered. Use register_connection.".format(alias))
+
+
+def disconnect(alias=None):
+  # closes the clients of one connection, or all of them; they are made again when next used
+  for name, connection in list(connections.items()):
+    if alias is None or name == alias:
+      connection.close()
+
+
+async def adisconnect(alias=None):
+  for name, connection in list(connections.items()):
+    if alias is None or name == alias:
+      await connection.aclose()
+
+
+def pool_stats():
+  # alias -> Connection.pool_stats()
+  return dict((alias, connection.pool_stats()) for alias, connection in connections.items())
+
+
+@contextmanager
+def reading_from(read_preference):
+  # Sends the find, find_one and load_tree reads made in the block to read_preference, e.g. 'secondaryPreferred'
+  # for a read-only page that can show slightly old data. None keeps every model's own READ_PREFERENCE.
+  if read_preference is not None and read_preference not in READ_PREFERENCES:
+    raise ValueError("Read preference must be one of {}, not {}.".format(', '.join(READ_PREFERENCES), read_preference))
+
+  token = current_read_preference.set(read_preference)
+  try:
+    yield
+  finally:
+    current_read_preference.reset(token)
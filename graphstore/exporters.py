@@ -0,0 +1,305 @@
+from xml.sax.saxutils import escape, quoteattr
+import csv
+import io
+import json
+
+from bson import ObjectId
+
+from .models import Graph
+
+BATCH_SIZE = 1000  # ids per $in query, and documents per cursor batch
+CHUNK_SIZE = 65536  # characters per yielded chunk
+
+
+# ## Sources
+class ExportSource(object):
+  # The elements of a stored model's node and edge lists (Graph.nodes and links, or a Web's vertices and edges),
+  # read through cursors a batch at a time: the list itself is streamed with $unwind and its ids are looked up
+  # BATCH_SIZE at a time. nodes() and edges() query again on every call, so writers can make more than one pass
+  # without anything proportional to the graph's size being held.
+  def __init__(self, owner_class, owner_id, nodes='nodes', edges='links', sources='sources', sinks='sinks'):
+    self.owner_class = owner_class
+    self.owner_id = ObjectId(owner_id)
+    self.node_list = nodes
+    self.edge_list = edges
+    self.node_class = owner_class.fields[nodes].field_class.model_class
+    self.edge_class = owner_class.fields[edges].field_class.model_class
+    self.sources = sources
+    self.sinks = sinks
+
+  def element_ids(self, list_name):
+    cursor = self.owner_class.collection().aggregate([
+      {'$match': {'_id': self.owner_id}},
+      {'$project': {list_name: 1}},
+      {'$unwind': '$' + list_name},
+    ], batchSize=BATCH_SIZE)
+
+    batch = []
+    for doc in cursor:
+      batch.append(ObjectId(doc[list_name]))
+      if len(batch) >= BATCH_SIZE:
+        yield batch
+        batch = []
+
+    if batch:
+      yield batch
+
+  def documents(self, model_class, list_name):
+    for ids in self.element_ids(list_name):
+      yield from model_class.collection().find({'_id': {'$in': ids}}, batch_size=BATCH_SIZE)
+
+  def nodes(self):
+    # (id, data, screen or None)
+    for doc in self.documents(self.node_class, self.node_list):
+      yield str(doc['_id']), doc.get('data') or {}, doc.get('screen')
+
+  def edges(self):
+    # (id, source id, sink id, data, screen or None); a link with several sources or sinks becomes an edge per pair
+    for doc in self.documents(self.edge_class, self.edge_list):
+      pairs = [(source, sink) for source in doc.get(self.sources, []) for sink in doc.get(self.sinks, [])]
+
+      for i, (source, sink) in enumerate(pairs):
+        edge_id = str(doc['_id']) if len(pairs) == 1 else '{}-{}'.format(doc['_id'], i)
+        yield edge_id, str(source), str(sink), doc.get('data') or {}, doc.get('screen')
+
+
+def graph_source(graph_id):
+  return ExportSource(Graph, graph_id)
+
+
+# ## Attributes
+def value_type(value):
+  if isinstance(value, bool):
+    return 'boolean'
+  elif isinstance(value, int):
+    return 'long'
+  elif isinstance(value, float):
+    return 'double'
+
+  return 'string'
+
+
+def attribute_types(attribute_dicts):
+  # name -> 'boolean', 'long', 'double' or 'string', over every dict; names keep their first-seen order
+  types = {}
+  for attributes in attribute_dicts:
+    for name, value in attributes.items():
+      if value is None:
+        continue
+
+      kind = value_type(value)
+      seen = types.get(name)
+      if seen is None:
+        types[name] = kind
+      elif seen != kind:
+        types[name] = 'double' if {seen, kind} == {'long', 'double'} else 'string'
+
+  return types
+
+
+def flat_attributes(data, screen):
+  # data plus the screen fields as screen.x, screen.y, ..., for formats without a place for positions
+  attributes = dict(data)
+  for name, value in (screen or {}).items():
+    attributes['screen.' + name] = value
+
+  return attributes
+
+
+def text(value):
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  elif isinstance(value, (dict, list)):
+    return json.dumps(value)
+
+  return str(value)
+
+
+def chunked(pieces, chunk_size=CHUNK_SIZE):
+  buffer = []
+  size = 0
+
+  for piece in pieces:
+    buffer.append(piece)
+    size += len(piece)
+
+    if size >= chunk_size:
+      yield ''.join(buffer)
+      buffer = []
+      size = 0
+
+  if buffer:
+    yield ''.join(buffer)
+
+
+# ## Formats
+# Each iter_* function yields the file a chunk of about CHUNK_SIZE characters at a time. GraphML, GEXF and CSV
+# declare their attributes up front, so they read the elements once for the attribute names and once to write.
+def iter_graphml(source):
+  return chunked(graphml_pieces(source))
+
+
+def graphml_pieces(source):
+  node_types = attribute_types(flat_attributes(data, screen) for _, data, screen in source.nodes())
+  edge_types = attribute_types(flat_attributes(data, screen) for _, _, _, data, screen in source.edges())
+  node_keys = {name: 'n{}'.format(i) for i, name in enumerate(node_types)}
+  edge_keys = {name: 'e{}'.format(i) for i, name in enumerate(edge_types)}
+
+  yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+  yield '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+
+  for kind, types, keys in (('node', node_types, node_keys), ('edge', edge_types, edge_keys)):
+    for name, attr_type in types.items():
+      yield '  <key id="{}" for="{}" attr.name={} attr.type="{}"/>\n'.format(keys[name], kind, quoteattr(name), attr_type)
+
+  yield '  <graph id={} edgedefault="directed">\n'.format(quoteattr(str(source.owner_id)))
+
+  def data_elements(attributes, keys):
+    return ''.join('<data key="{}">{}</data>'.format(keys[name], escape(text(value)))
+                   for name, value in attributes.items() if value is not None)
+
+  for node_id, data, screen in source.nodes():
+    yield '    <node id={}>{}</node>\n'.format(quoteattr(node_id), data_elements(flat_attributes(data, screen), node_keys))
+
+  for edge_id, source_id, sink_id, data, screen in source.edges():
+    yield '    <edge id={} source={} target={}>{}</edge>\n'.format(
+      quoteattr(edge_id), quoteattr(source_id), quoteattr(sink_id), data_elements(flat_attributes(data, screen), edge_keys))
+
+  yield '  </graph>\n'
+  yield '</graphml>\n'
+
+
+def iter_gexf(source):
+  return chunked(gexf_pieces(source))
+
+
+def gexf_pieces(source):
+  # screen positions, sizes, hex colors and thicknesses become GEXF viz elements instead of attributes
+  node_types = attribute_types(data for _, data, _ in source.nodes())
+  edge_types = attribute_types(data for _, _, _, data, _ in source.edges())
+  node_keys = {name: str(i) for i, name in enumerate(node_types)}
+  edge_keys = {name: str(i) for i, name in enumerate(edge_types)}
+
+  yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+  yield '<gexf xmlns="http://gexf.net/1.3" xmlns:viz="http://gexf.net/1.3/viz" version="1.3">\n'
+  yield '  <graph defaultedgetype="directed">\n'
+
+  for kind, types, keys in (('node', node_types, node_keys), ('edge', edge_types, edge_keys)):
+    if types:
+      yield '    <attributes class="{}">\n'.format(kind)
+      for name, attr_type in types.items():
+        yield '      <attribute id="{}" title={} type="{}"/>\n'.format(keys[name], quoteattr(name), attr_type)
+      yield '    </attributes>\n'
+
+  def attvalues(data, keys):
+    values = ''.join('<attvalue for="{}" value={}/>'.format(keys[name], quoteattr(text(value)))
+                     for name, value in data.items() if value is not None)
+    return '<attvalues>{}</attvalues>'.format(values) if values else ''
+
+  yield '    <nodes>\n'
+  for node_id, data, screen in source.nodes():
+    label = data.get('name', node_id)
+    yield '      <node id={} label={}>{}{}</node>\n'.format(
+      quoteattr(node_id), quoteattr(text(label)), attvalues(data, node_keys), gexf_viz(screen))
+  yield '    </nodes>\n'
+
+  yield '    <edges>\n'
+  for edge_id, source_id, sink_id, data, screen in source.edges():
+    yield '      <edge id={} source={} target={}>{}{}</edge>\n'.format(
+      quoteattr(edge_id), quoteattr(source_id), quoteattr(sink_id), attvalues(data, edge_keys), gexf_viz(screen))
+  yield '    </edges>\n'
+
+  yield '  </graph>\n'
+  yield '</gexf>\n'
+
+
+def gexf_viz(screen):
+  if not screen:
+    return ''
+
+  pieces = []
+  if 'x' in screen and 'y' in screen:
+    pieces.append('<viz:position x="{}" y="{}" z="0.0"/>'.format(float(screen['x']), float(screen['y'])))
+  if 'size' in screen:
+    pieces.append('<viz:size value="{}"/>'.format(float(screen['size'])))
+  if 'thickness' in screen:
+    pieces.append('<viz:thickness value="{}"/>'.format(float(screen['thickness'])))
+
+  color = screen.get('color')
+  if isinstance(color, str) and len(color) == 7 and color.startswith('#'):
+    try:
+      r, g, b = (int(color[i:i + 2], 16) for i in (1, 3, 5))
+      pieces.append('<viz:color r="{}" g="{}" b="{}"/>'.format(r, g, b))
+    except ValueError:
+      pass  # named colors have no GEXF form
+
+  return ''.join(pieces)
+
+
+def iter_edge_csv(source):
+  return chunked(edge_csv_pieces(source))
+
+
+def edge_csv_pieces(source):
+  # source,target and then a column per edge attribute
+  types = attribute_types(flat_attributes(data, screen) for _, _, _, data, screen in source.edges())
+  names = list(types)
+
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+
+  def line(row):
+    writer.writerow(row)
+    value = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return value
+
+  yield line(['source', 'target'] + names)
+
+  for _, source_id, sink_id, data, screen in source.edges():
+    attributes = flat_attributes(data, screen)
+    yield line([source_id, sink_id] + ['' if attributes.get(name) is None else text(attributes[name]) for name in names])
+
+
+def iter_ndjson(source):
+  return chunked(ndjson_pieces(source))
+
+
+def ndjson_pieces(source):
+  # one JSON object per line, nodes first; nothing is declared up front, so this reads the elements only once
+  for node_id, data, screen in source.nodes():
+    node = {'type': 'node', 'id': node_id, 'data': data}
+    if screen is not None:
+      node['screen'] = screen
+
+    yield json.dumps(node, default=str) + '\n'
+
+  for edge_id, source_id, sink_id, data, screen in source.edges():
+    edge = {'type': 'edge', 'id': edge_id, 'source': source_id, 'target': sink_id, 'data': data}
+    if screen is not None:
+      edge['screen'] = screen
+
+    yield json.dumps(edge, default=str) + '\n'
+
+
+FORMATS = {
+  # name -> (chunk iterator, mimetype, file extension)
+  'graphml': (iter_graphml, 'application/graphml+xml', 'graphml'),
+  'gexf': (iter_gexf, 'application/gexf+xml', 'gexf'),
+  'csv': (iter_edge_csv, 'text/csv', 'csv'),
+  'ndjson': (iter_ndjson, 'application/x-ndjson', 'ndjson'),
+}
+
+
+def iter_export(source, format):
+  if format not in FORMATS:
+    raise ValueError("Export format must be one of {}, not {}.".format(', '.join(FORMATS), format))
+
+  return FORMATS[format][0](source)
+
+
+def export(source, format, f):
+  # writes to an open text file, or anything else with a write method
+  for chunk in iter_export(source, format):
+    f.write(chunk)
@@ -0,0 +1,216 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import time
+import weakref
+
+
+# ## Identity map policies
+# MongoModel.get_or_make_ref keeps exactly one object per (model class, id) in an identity map.
+# Every policy counts hits, misses and evictions so the cache can be sized from real numbers.
+class IdentityMap(object):
+  def __init__(self):
+    self.refs = {}
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  # scopes only mean something for ScopedIdentityMap; other policies accept them so they can be swapped in freely
+  def begin(self):
+    return None
+
+  def end(self, token):
+    pass
+
+  @contextmanager
+  def scope(self):
+    yield self
+
+  def get(self, model_class, key):
+    obj = self.lookup(model_class, key)
+    self.count(obj)
+    return obj
+
+  def count(self, obj):
+    if obj is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+
+  def lookup(self, model_class, key):
+    return self.refs.get((model_class, key))
+
+  def add(self, model_class, key, obj):
+    return self.refs.setdefault((model_class, key), obj)
+
+  def discard(self, model_class, key):
+    self.refs.pop((model_class, key), None)
+
+  def clear(self):
+    self.refs.clear()
+
+  def __len__(self):
+    return len(self.refs)
+
+  def stats(self):
+    return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, size=len(self))
+
+
+class LRUIdentityMap(IdentityMap):
+  # Safe to share between threads, like the process-wide fallback of a ScopedIdentityMap: every read
+  # reorders the OrderedDict, so all access goes through the lock.
+  def __init__(self, max_size=10000, ttl=None, weak=False):
+    super().__init__()
+    self.refs = OrderedDict()
+    self.lock = threading.Lock()
+    self.max_size = max_size
+    self.ttl = ttl  # seconds an object may be served from the map before it is reloaded
+
+    # evicted objects that are still referenced elsewhere keep their identity while they live
+    self.weak_refs = weakref.WeakValueDictionary() if weak else None
+
+  def get(self, model_class, key):
+    # counted under the lock too, or threads sharing the map lose each other's counts
+    with self.lock:
+      obj = self.locked_lookup(model_class, key)
+      self.count(obj)
+
+    return obj
+
+  def lookup(self, model_class, key):
+    with self.lock:
+      return self.locked_lookup(model_class, key)
+
+  def locked_lookup(self, model_class, key):
+    ref_key = (model_class, key)
+    entry = self.refs.get(ref_key)
+
+    if entry is None:
+      if self.weak_refs is not None:
+        obj = self.weak_refs.pop(ref_key, None)
+        if obj is not None:
+          return self.locked_add(model_class, key, obj)
+
+      return None
+
+    obj, added = entry
+    if self.ttl is not None and time.monotonic() - added > self.ttl:
+      del self.refs[ref_key]
+      self.evictions += 1
+      return None
+
+    self.refs.move_to_end(ref_key)
+    return obj
+
+  def add(self, model_class, key, obj):
+    with self.lock:
+      return self.locked_add(model_class, key, obj)
+
+  def locked_add(self, model_class, key, obj):
+    ref_key = (model_class, key)
+    entry = self.refs.get(ref_key)
+
+    if entry is not None:
+      self.refs.move_to_end(ref_key)
+      return entry[0]
+
+    self.refs[ref_key] = (obj, time.monotonic())
+
+    while self.max_size and len(self.refs) > self.max_size:
+      evicted_key, (evicted, _) = self.refs.popitem(last=False)
+      self.evictions += 1
+
+      if self.weak_refs is not None:
+        self.weak_refs[evicted_key] = evicted
+
+    return obj
+
+  def discard(self, model_class, key):
+    with self.lock:
+      super().discard(model_class, key)
+
+      if self.weak_refs is not None:
+        self.weak_refs.pop((model_class, key), None)
+
+  def clear(self):
+    with self.lock:
+      super().clear()
+
+      if self.weak_refs is not None:
+        self.weak_refs.clear()
+
+
+class ScopedIdentityMap(IdentityMap):
+  # Gives each scope (e.g. a web request) its own map, so objects never leak between scopes.
+  # Outside of a scope, the fallback map is used; without one, nothing is cached.
+  def __init__(self, factory=IdentityMap, fallback=None):
+    super().__init__()
+    self.factory = factory
+    self.fallback = fallback
+    self.current = ContextVar('identity_map_scope', default=None)
+    self.lock = threading.Lock()  # for the counts, which every thread's scope adds to
+
+  def begin(self):
+    return self.current.set(self.factory())
+
+  def end(self, token):
+    if token is None:
+      return
+
+    scope_map = self.current.get()
+    if scope_map is not None:
+      with self.lock:
+        self.evictions += scope_map.evictions
+
+    self.current.reset(token)
+
+  @contextmanager
+  def scope(self):
+    token = self.begin()
+    try:
+      yield self.current.get()
+    finally:
+      self.end(token)
+
+  def active_map(self):
+    scope_map = self.current.get()
+    return scope_map if scope_map is not None else self.fallback
+
+  def get(self, model_class, key):
+    obj = self.lookup(model_class, key)
+    with self.lock:
+      self.count(obj)
+
+    return obj
+
+  def lookup(self, model_class, key):
+    active = self.active_map()
+    return None if active is None else active.lookup(model_class, key)
+
+  def add(self, model_class, key, obj):
+    active = self.active_map()
+    return obj if active is None else active.add(model_class, key, obj)
+
+  def discard(self, model_class, key):
+    active = self.active_map()
+    if active is not None:
+      active.discard(model_class, key)
+
+  def clear(self):
+    active = self.active_map()
+    if active is not None:
+      active.clear()
+
+  def __len__(self):
+    active = self.active_map()
+    return 0 if active is None else len(active)
+
+  def stats(self):
+    stats = super().stats()
+
+    active = self.active_map()
+    if active is not None:
+      stats['evictions'] += active.evictions
+
+    return stats
@@ -0,0 +1,4 @@
+from .readers import read_rows, read_links, read_nodes
+from .graph import GraphImporter, import_files
+
+__all__ = ['read_rows', 'read_links', 'read_nodes', 'GraphImporter', 'import_files']
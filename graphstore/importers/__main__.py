@@ -0,0 +1,49 @@
+""" Imports a link file and/or a node attribute file (CSV, TSV or whitespace separated edge list) into a Graph.
+Also runs as python -m graphstore.importers.
+
+Usage:
+  graphstore-import [--links=<file>] [--nodes=<file>] [options]
+
+Options:
+  -h --help            Show this help message
+  --links=<file>       Links, one per row: source, target and any other columns as data
+  --nodes=<file>       Node attributes, one node per row
+  --graph=<id>         Add to this Graph instead of making a new one
+  --key=<name>         Node data field that identifies a node [default: name]
+  --source=<column>    Name or number of the links' source column [default: 0]
+  --target=<column>    Name or number of the links' target column [default: 1]
+  --node-key=<column>  Name or number of the nodes' key column [default: 0]
+  --delimiter=<char>   Column separator, instead of going by the file extension
+  --batch-size=<n>     Documents per insert [default: 5000]
+  --uri=<uri>          Mongo host [default: localhost]
+  --port=<port>        Mongo port [default: 27017]
+  --database=<name>    Mongo database [default: ideagrapher]
+"""
+
+from docopt import docopt
+import time
+
+from ..models import MongoModel
+from . import import_files
+
+
+def main():
+  args = docopt(__doc__)
+
+  MongoModel.connect_to_database(args['--database'], args['--uri'], int(args['--port']))
+
+  start = time.perf_counter()
+  graph_id, counts = import_files(
+    links_path=args['--links'], nodes_path=args['--nodes'], graph=args['--graph'], key=args['--key'],
+    source=args['--source'], target=args['--target'], node_key=args['--node-key'],
+    delimiter=args['--delimiter'], batch_size=int(args['--batch-size']),
+  )
+  elapsed = time.perf_counter() - start
+
+  print("Graph {}: {rows} rows, {nodes} new nodes, {links} new links, {duplicate_links} duplicate links".format(
+    graph_id, **counts))
+  print("{:.2f}s, {:.0f} rows/s".format(elapsed, counts['rows'] / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,174 @@
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from ..models import Graph, Node, Link
+from .readers import read_links, read_nodes
+
+BATCH_SIZE = 5000  # documents per insert_many
+ID_BATCH_SIZE = 50000  # ids per $in query when loading what a graph already holds
+
+
+# ## Importing
+# Rows are turned straight into Node and Link documents, without making model objects. Nodes are
+# deduplicated by their key (stored in data) and links by their (source, sink) pair, in dicts and sets;
+# documents are written with insert_many a batch at a time, and the graph's lists in one update at the end.
+class GraphImporter(object):
+  def __init__(self, graph=None, key='name', batch_size=BATCH_SIZE):
+    self.graph_id = None if graph is None else ObjectId(graph if isinstance(graph, (str, ObjectId)) else graph.id)
+    self.key = key
+    self.batch_size = batch_size
+
+    self.node_ids = {}  # key -> node ObjectId
+    self.link_pairs = set()  # (source ObjectId, sink ObjectId)
+    self.new_nodes = []  # ids for the graph's lists, in the order they were made
+    self.new_links = []
+
+    self.pending_nodes = {}  # node ObjectId -> document not inserted yet
+    self.pending_links = []
+    self.node_updates = []  # attributes for nodes that were already written
+
+    self.counts = {'rows': 0, 'nodes': 0, 'links': 0, 'duplicate_links': 0}
+
+    # every new document starts from the models' own defaults
+    self.node_template = Node().serialize(include='all', cascade=False)
+    self.link_template = Link().serialize(include='all', cascade=False)
+
+    if self.graph_id is not None:
+      self.load_graph()
+
+  def load_graph(self):
+    # what the graph holds already, so importing into it again only adds what is missing
+    doc = Graph.collection().find_one({'_id': self.graph_id}, projection=['nodes', 'links'])
+    if doc is None:
+      raise ValueError("No {} was found with id {}.".format(Graph, self.graph_id))
+
+    key_path = 'data.{}'.format(self.key)
+    for chunk in chunks([ObjectId(node_id) for node_id in doc.get('nodes', [])], ID_BATCH_SIZE):
+      for node in Node.collection().find({'_id': {'$in': chunk}}, projection=[key_path]):
+        key = node.get('data', {}).get(self.key)
+        if key is not None:
+          self.node_ids.setdefault(str(key), node['_id'])
+
+    for chunk in chunks([ObjectId(link_id) for link_id in doc.get('links', [])], ID_BATCH_SIZE):
+      for link in Link.collection().find({'_id': {'$in': chunk}}, projection=['sources', 'sinks']):
+        for source in link.get('sources', []):
+          for sink in link.get('sinks', []):
+            self.link_pairs.add((ObjectId(source), ObjectId(sink)))
+
+  def add_node(self, key, data=None):
+    # the id of the node with this key, made if there isn't one; data is merged into its attributes
+    key = str(key)
+    node_id = self.node_ids.get(key)
+
+    if node_id is None:
+      node_id = self.node_ids[key] = ObjectId()
+      node_data = dict(data or {})
+      node_data[self.key] = key
+
+      self.pending_nodes[node_id] = dict(self.node_template, _id=node_id, data=node_data)
+      self.new_nodes.append(str(node_id))
+      self.counts['nodes'] += 1
+
+      if len(self.pending_nodes) >= self.batch_size:
+        self.flush()
+
+    elif data:
+      pending = self.pending_nodes.get(node_id)
+      if pending is not None:
+        pending['data'].update(data)
+        pending['data'][self.key] = key
+      else:
+        changes = {'data.{}'.format(name): value for name, value in data.items() if name != self.key}
+        if changes:  # a row with nothing but the key has nothing to update, and an empty $set is an error
+          self.node_updates.append(UpdateOne({'_id': node_id}, {'$set': changes}))
+
+    return node_id
+
+  def add_link(self, source_key, sink_key, data=None):
+    # the id of the new link, or None if the graph already links source to sink
+    source = self.add_node(source_key)
+    sink = self.add_node(sink_key)
+
+    if (source, sink) in self.link_pairs:
+      self.counts['duplicate_links'] += 1
+      return None
+
+    self.link_pairs.add((source, sink))
+    link_id = ObjectId()
+
+    self.pending_links.append(dict(self.link_template, _id=link_id, sources=[str(source)], sinks=[str(sink)],
+                                   data=dict(data or {})))
+    self.new_links.append(str(link_id))
+    self.counts['links'] += 1
+
+    if len(self.pending_links) >= self.batch_size:
+      self.flush()
+
+    return link_id
+
+  def import_nodes(self, rows):
+    for key, data in rows:
+      self.counts['rows'] += 1
+      self.add_node(key, data)
+
+  def import_links(self, rows):
+    for source_key, sink_key, data in rows:
+      self.counts['rows'] += 1
+      self.add_link(source_key, sink_key, data)
+
+  def flush(self):
+    # nodes first, so links never point at nodes that aren't there yet
+    if self.pending_nodes:
+      Node.collection().insert_many(list(self.pending_nodes.values()), ordered=False)
+      self.pending_nodes = {}
+
+    if self.node_updates:
+      Node.collection().bulk_write(self.node_updates, ordered=False)
+      self.node_updates = []
+
+    if self.pending_links:
+      Link.collection().insert_many(self.pending_links, ordered=False)
+      self.pending_links = []
+
+  def finish(self):
+    # writes what is left and then the graph; returns the graph's id
+    self.flush()
+
+    if self.graph_id is None:
+      self.graph_id = ObjectId()
+      graph = dict(Graph().serialize(include='all', cascade=False), _id=self.graph_id,
+                   nodes=self.new_nodes, links=self.new_links, revision=1)
+      Graph.collection().insert_one(graph)
+
+    elif self.new_nodes or self.new_links:
+      Graph.collection().update_one({'_id': self.graph_id}, {
+        '$push': {'nodes': {'$each': self.new_nodes}, 'links': {'$each': self.new_links}},
+        '$inc': {'revision': 1},
+      })
+
+    # a Graph object loaded before the import is out of date now
+    Graph.identity_map.discard(Graph, str(self.graph_id))
+
+    self.new_nodes = []
+    self.new_links = []
+    return str(self.graph_id)
+
+
+def chunks(items, size):
+  for start in range(0, len(items), size):
+    yield items[start:start + size]
+
+
+def import_files(links_path=None, nodes_path=None, graph=None, key='name', source=None, target=None, node_key=None,
+                 delimiter=None, batch_size=BATCH_SIZE):
+  # Imports a node attribute file and/or a link file into graph (a new one if None).
+  # Returns (graph id, counts).
+  importer = GraphImporter(graph=graph, key=key, batch_size=batch_size)
+
+  if nodes_path is not None:
+    importer.import_nodes(read_nodes(nodes_path, key=node_key, delimiter=delimiter))
+
+  if links_path is not None:
+    importer.import_links(read_links(links_path, source=source, target=target, delimiter=delimiter))
+
+  return importer.finish(), importer.counts
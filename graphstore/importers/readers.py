@@ -0,0 +1,92 @@
+import csv
+import os
+
+EDGE_LIST_EXTENSIONS = ('.txt', '.edges', '.el', '.edgelist')  # whitespace separated, no header, # or % comments
+
+
+def convert(value):
+  # numbers in text files become numbers in the database
+  for kind in (int, float):
+    try:
+      return kind(value)
+    except ValueError:
+      pass
+
+  return value
+
+
+def read_rows(path, delimiter=None):
+  # Yields each row of a CSV, TSV or edge list file as a list of strings, one line in memory at a time.
+  # The format comes from delimiter if given, or the file extension; edge lists have no header row.
+  extension = os.path.splitext(path)[1].lower()
+
+  with open(path, newline='') as f:
+    if delimiter is None and extension in EDGE_LIST_EXTENSIONS:
+      for line in f:
+        line = line.strip()
+        if line and line[0] not in '#%':
+          yield line.split()
+
+      return
+
+    if delimiter is None:
+      delimiter = '\t' if extension in ('.tsv', '.tab') else ','
+
+    for row in csv.reader(f, delimiter=delimiter):
+      if row:
+        yield row
+
+
+def has_header(path, delimiter=None):
+  return delimiter is not None or os.path.splitext(path)[1].lower() not in EDGE_LIST_EXTENSIONS
+
+
+def column_index(header, column, default):
+  if column is None:
+    return default
+
+  if column in header:
+    return header.index(column)
+
+  try:
+    return int(column)
+  except ValueError:
+    raise ValueError("No column {} in {}.".format(column, header))
+
+
+def read_links(path, source=None, target=None, delimiter=None):
+  # Yields (source key, target key, data) per row. source and target name (or number) the columns holding
+  # the two ends, the first two by default; any other columns go into data, so a weight column is kept.
+  rows = read_rows(path, delimiter=delimiter)
+
+  if has_header(path, delimiter):
+    header = next(rows, [])
+  else:
+    header = ['source', 'target', 'weight']
+
+  source_index = column_index(header, source, 0)
+  target_index = column_index(header, target, 1)
+
+  for row in rows:
+    data = {}
+    for i, value in enumerate(row):
+      if i != source_index and i != target_index:
+        data[header[i] if i < len(header) else str(i)] = convert(value)
+
+    yield row[source_index], row[target_index], data
+
+
+def read_nodes(path, key=None, delimiter=None):
+  # Yields (key, data) per row of a node attribute file; key names (or numbers) the column identifying
+  # the node, the first by default, and data holds every column.
+  rows = read_rows(path, delimiter=delimiter)
+
+  if has_header(path, delimiter):
+    header = next(rows, [])
+  else:
+    header = ['name']
+
+  key_index = column_index(header, key, 0)
+
+  for row in rows:
+    yield row[key_index], {(header[i] if i < len(header) else str(i)): convert(value) for i, value in enumerate(row)}
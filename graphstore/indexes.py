@@ -0,0 +1,64 @@
+""" Creates the indexes declared on MongoModels (MongoIndex attributes) that the database doesn't have yet,
+or with --check only reports them. Models are found by importing the modules that define them.
+
+Usage:
+  graphstore-sync-indexes [--models=<modules>] [--check] [--uri=<uri>] [--port=<port>] [--database=<name>]
+
+Options:
+  -h --help            Show this help message
+  --models=<modules>   Comma-separated modules defining the models [default: graphstore.models]
+  --check              Report missing indexes without creating them; exits with 1 if any are missing
+  --uri=<uri>          Mongo host [default: localhost]
+  --port=<port>        Mongo port [default: 27017]
+  --database=<name>    Mongo database [default: ideagrapher]
+"""
+
+from docopt import docopt
+import importlib
+import sys
+
+from .models import MongoModel
+
+
+def sync_indexes(models=None, create=True):
+  # Syncs the indexes of models (every model class defined so far if None), see MongoModel.sync_indexes,
+  # and returns all their report rows. Models sharing a collection are checked once.
+  if models is None:
+    models = list(MongoModel.model_name_map.values())
+
+  report = []
+  seen = set()
+
+  for model in models:
+    if not model.indexes or (model.CONNECTION, model.DATABASE, model.COLLECTION) in seen:
+      continue
+
+    seen.add((model.CONNECTION, model.DATABASE, model.COLLECTION))
+    report.extend(model.sync_indexes(create=create))
+
+  return report
+
+
+def main():
+  args = docopt(__doc__)
+
+  # the modules first: importing one can register a connection of its own (webviz does), which the options replace
+  for module in args['--models'].split(','):
+    importlib.import_module(module.strip())
+
+  MongoModel.connect_to_database(args['--database'], args['--uri'], int(args['--port']))
+
+  report = sync_indexes(create=not args['--check'])
+  for row in report:
+    print("{status:>9}  {collection}.{name} {keys}".format(**row))
+
+  counts = dict((status, sum(1 for row in report if row['status'] == status))
+                for status in ('present', 'created', 'missing', 'different'))
+  print("{present} present, {created} created, {missing} missing, {different} different".format(**counts))
+
+  if counts['missing'] or counts['different']:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,5 +1,6 @@
-from graphstore.models import MongoModel, Node, Link, ObjectNotFound
+from graphstore.models import MongoModel, Node, Link, Graph, ObjectNotFound
 from bson import ObjectId
+from pymongo import monitoring
 MongoModel.connect_to_database("test", "localhost", 27017)
 
 n1_shortname = "testnode1"
@@ -34,3 +35,77 @@ except ObjectNotFound:
   except AssertionError:
     # import ipdb; ipdb.set_trace()
     pass
+
+
+# batched reference resolution: a Graph's nodes should load with one $in query per REF_BATCH_SIZE ids
+class FindCounter(monitoring.CommandListener):
+  def __init__(self):
+    self.count = 0
+
+  def started(self, event):
+    if event.command_name == 'find':
+      self.count += 1
+
+  def succeeded(self, event):
+    pass
+
+  def failed(self, event):
+    pass
+
+
+# the counter only listens to this connection's client, which is replaced again once the counting is done
+find_counter = FindCounter()
+MongoModel.connect_to_database("test", "localhost", 27017, event_listeners=[find_counter])
+
+batch_nodes = [Node(data={'index': i}) for i in range(2 * MongoModel.REF_BATCH_SIZE + 1)]
+for node in batch_nodes:
+  node.save()
+
+batch_graph = Graph(nodes=batch_nodes)
+batch_graph.save()
+
+MongoModel.identity_map.clear()
+
+find_counter.count = 0
+loaded_graph = Graph.get_by_id(batch_graph.id)
+assert len(loaded_graph.nodes) == len(batch_nodes)
+assert find_counter.count == 1 + 3, find_counter.count  # the graph itself, then three chunks of nodes
+
+# nested references are batched across the whole list too: every link's sources and sinks come in one $in query
+nested_links = [Link(sources=[batch_nodes[i]], sinks=[batch_nodes[i + 1]]) for i in range(100)]
+for link in nested_links:
+  link.save()
+
+nested_graph = Graph(links=nested_links)
+nested_graph.save()
+
+MongoModel.identity_map.clear()
+
+find_counter.count = 0
+loaded_graph = Graph.get_by_id(nested_graph.id)
+assert [link.sinks[0].data['index'] for link in loaded_graph.links] == list(range(1, 101))
+assert find_counter.count == 1 + 1 + 1, find_counter.count  # the graph, its links, then all of their nodes
+
+MongoModel.connect_to_database("test", "localhost", 27017)
+
+
+# adjacency lookups should be answered from Link's multikey indexes, not by scanning the collection
+def uses_index(plan, index_name):
+  if isinstance(plan, dict):
+    return plan.get('indexName') == index_name or any(uses_index(value, index_name) for value in plan.values())
+  elif isinstance(plan, list):
+    return any(uses_index(value, index_name) for value in plan)
+
+  return False
+
+
+for query, index_name in [({'sources': n1.id}, 'sources_index'), ({'sinks': n2.id}, 'sinks_index')]:
+  explain = Link.collection().find(query).explain()
+  assert uses_index(explain['queryPlanner']['winningPlan'], index_name), explain['queryPlanner']['winningPlan']
+
+adjacency_graph = Graph(nodes=[n1, n2], links=[l1])
+adjacency_graph.save()
+
+assert l1 in list(n1.out_links()) and l1 in list(n2.in_links())
+assert adjacency_graph.neighbors(n1) == [n2] and adjacency_graph.neighbors(n1, direction='in') == []
+assert adjacency_graph.degree(n2) == 1 and adjacency_graph.degree(n2, direction='out') == 0
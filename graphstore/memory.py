@@ -0,0 +1,960 @@
+import re
+import threading
+
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany, ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from pymongo.results import InsertOneResult, InsertManyResult, UpdateResult, DeleteResult, BulkWriteResult
+
+
+# ## In-memory storage engine
+# The part of pymongo's client, database and collection API that graphstore and webviz use, over dicts in
+# this process: register_connection(engine='memory') puts a model on it with nothing else changed, so tests
+# and benchmarks run without a server, and profiles show the ORM's own time. Stored documents are never
+# modified in place: writes replace them with changed copies, so a cursor can hold on to what matched
+# and copy it out only as it is iterated. Queries support equality (which matches list elements, like
+# Mongo's), dotted paths, $in, $nin, $ne, $eq, $gt, $gte, $lt, $lte, $exists, $all, $size, $elemMatch,
+# $regex, $not, $and, $or and $nor; updates $set, $unset, $inc, $min, $max, $push (with $each and
+# $position), $addToSet, $pop, $pull and $setOnInsert; unique indexes are enforced.
+def clone(value):
+  # a deep copy of a document, much faster than copy.deepcopy for the types BSON has
+  if isinstance(value, dict):
+    return {key: clone(item) for key, item in value.items()}
+  elif isinstance(value, list):
+    return [clone(item) for item in value]
+
+  return value
+
+
+# ## Queries
+def resolve(value, parts):
+  # the values at a dotted path; through a list, the path continues into each of its documents
+  if not parts:
+    return [value]
+
+  head, rest = parts[0], parts[1:]
+  if isinstance(value, dict):
+    return resolve(value[head], rest) if head in value else []
+
+  if isinstance(value, list):
+    found = []
+    if head.isdigit():
+      index = int(head)
+      if index < len(value):
+        found.extend(resolve(value[index], rest))
+
+    for item in value:
+      if isinstance(item, dict):
+        found.extend(resolve(item, parts))
+
+    return found
+
+  return []
+
+
+def values_at(doc, path):
+  return resolve(doc, path.split('.'))
+
+
+def equals(values, expected):
+  if not values:
+    return expected is None  # a missing field matches null
+
+  for value in values:
+    if value == expected and isinstance(value, bool) == isinstance(expected, bool):
+      return True
+    if isinstance(value, list) and not isinstance(expected, list) and any(item == expected for item in value):
+      return True
+
+  return False
+
+
+def compare(values, expected, test):
+  for value in values:
+    for item in (value if isinstance(value, list) else [value]):
+      try:
+        if test(item, expected):
+          return True
+      except TypeError:
+        pass  # different types don't compare
+
+  return False
+
+
+def is_operator_dict(condition):
+  return isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition)
+
+
+def matches_condition(values, condition):
+  if not is_operator_dict(condition):
+    return equals(values, condition)
+
+  for operator, argument in condition.items():
+    if operator == '$eq':
+      ok = equals(values, argument)
+    elif operator == '$ne':
+      ok = not equals(values, argument)
+    elif operator == '$in':
+      ok = any(equals(values, item) for item in argument)
+    elif operator == '$nin':
+      ok = not any(equals(values, item) for item in argument)
+    elif operator == '$gt':
+      ok = compare(values, argument, lambda a, b: a > b)
+    elif operator == '$gte':
+      ok = compare(values, argument, lambda a, b: a >= b)
+    elif operator == '$lt':
+      ok = compare(values, argument, lambda a, b: a < b)
+    elif operator == '$lte':
+      ok = compare(values, argument, lambda a, b: a <= b)
+    elif operator == '$exists':
+      ok = bool(values) == bool(argument)
+    elif operator == '$all':
+      ok = all(equals(values, item) for item in argument)
+    elif operator == '$size':
+      ok = any(isinstance(value, list) and len(value) == argument for value in values)
+    elif operator == '$elemMatch':
+      ok = any(isinstance(value, list) and any(matches_element(item, argument) for item in value) for value in values)
+    elif operator == '$regex':
+      pattern = re.compile(argument, regex_flags(condition.get('$options', '')))
+      ok = compare(values, pattern, lambda a, b: isinstance(a, str) and b.search(a) is not None)
+    elif operator == '$options':
+      ok = True
+    elif operator == '$not':
+      ok = not matches_condition(values, argument)
+    else:
+      raise ValueError("The in-memory engine doesn't support the query operator {}.".format(operator))
+
+    if not ok:
+      return False
+
+  return True
+
+
+def regex_flags(options):
+  flags = 0
+  for option, flag in (('i', re.IGNORECASE), ('m', re.MULTILINE), ('s', re.DOTALL), ('x', re.VERBOSE)):
+    if option in options:
+      flags |= flag
+
+  return flags
+
+
+def matches_element(item, condition):
+  # $elemMatch and $pull: operators apply to the element itself, anything else is a query on it
+  if is_operator_dict(condition):
+    return matches_condition([item], condition)
+
+  return isinstance(item, dict) and matches(item, condition)
+
+
+def matches(doc, query):
+  for key, condition in query.items():
+    if key == '$and':
+      ok = all(matches(doc, subquery) for subquery in condition)
+    elif key == '$or':
+      ok = any(matches(doc, subquery) for subquery in condition)
+    elif key == '$nor':
+      ok = not any(matches(doc, subquery) for subquery in condition)
+    elif key.startswith('$'):
+      raise ValueError("The in-memory engine doesn't support the query operator {}.".format(key))
+    else:
+      ok = matches_condition(values_at(doc, key), condition)
+
+    if not ok:
+      return False
+
+  return True
+
+
+# ## Sorting and projection
+TYPE_ORDER = [(type(None), 0), (bool, 8), ((int, float), 1), (str, 2), (dict, 3), (list, 4), (ObjectId, 7)]
+
+
+def sort_key(value):
+  # Mongo orders values of different types by type first
+  for types, rank in TYPE_ORDER:
+    if isinstance(value, types):
+      return (rank, value) if rank in (1, 2, 7, 8) else (rank, repr(value))
+
+  return (9, repr(value))
+
+
+def sort_value(doc, path, descending):
+  # Mongo sorts a document by the smallest of the values at path, or the largest in a descending sort,
+  # counting an array's elements; an empty array comes before null, which missing fields sort as
+  keys = []
+  for value in values_at(doc, path):
+    if isinstance(value, list):
+      keys.extend([sort_key(item) for item in value] or [(-1, '')])
+    else:
+      keys.append(sort_key(value))
+
+  if not keys:
+    return sort_key(None)
+
+  return max(keys) if descending else min(keys)
+
+
+def sort_documents(docs, sort):
+  if isinstance(sort, str):
+    sort = [(sort, ASCENDING)]
+
+  for path, direction in reversed(list(sort.items() if isinstance(sort, dict) else sort)):
+    docs.sort(key=lambda doc: sort_value(doc, path, direction < 0), reverse=direction < 0)
+
+  return docs
+
+
+def project(doc, projection):
+  if projection is None:
+    return clone(doc)
+
+  if not isinstance(projection, dict):
+    projection = dict((path, 1) for path in projection)
+
+  include_id = projection.get('_id', True)
+  fields = dict((path, value) for path, value in projection.items() if path != '_id')
+
+  if fields and all(fields.values()):
+    result = {}
+    for path in fields:
+      copy_path(doc, result, path.split('.'))
+  else:
+    result = clone(doc)
+    for path in fields:
+      remove_path(result, path.split('.'))
+
+  if include_id and '_id' in doc:
+    result['_id'] = doc['_id']
+  elif not include_id:
+    result.pop('_id', None)
+
+  return result
+
+
+def copy_path(source, target, parts):
+  head, rest = parts[0], parts[1:]
+  if head not in source:
+    return
+
+  value = source[head]
+  if not rest:
+    target[head] = clone(value)
+  elif isinstance(value, dict):
+    copy_path(value, target.setdefault(head, {}), rest)
+  elif isinstance(value, list):
+    items = target.setdefault(head, [{} for item in value if isinstance(item, dict)])
+    for item, projected in zip([item for item in value if isinstance(item, dict)], items):
+      copy_path(item, projected, rest)
+
+
+def remove_path(doc, parts):
+  head, rest = parts[0], parts[1:]
+  if not rest:
+    doc.pop(head, None)
+  elif isinstance(doc.get(head), dict):
+    remove_path(doc[head], rest)
+  elif isinstance(doc.get(head), list):
+    for item in doc[head]:
+      if isinstance(item, dict):
+        remove_path(item, rest)
+
+
+# ## Updates
+def container(doc, path, create=True):
+  # (the dict or list holding the last part of path, that part); None if there's no such place
+  parts = path.split('.')
+  target = doc
+
+  for part in parts[:-1]:
+    if isinstance(target, list) and part.isdigit():
+      index = int(part)
+      if index >= len(target):
+        if not create:
+          return None, None
+        target.extend([None] * (index + 1 - len(target)))
+      if target[index] is None and create:
+        target[index] = {}
+      target = target[index]
+    elif isinstance(target, dict):
+      if part not in target:
+        if not create:
+          return None, None
+        target[part] = {}
+      target = target[part]
+    else:
+      return None, None
+
+    if not isinstance(target, (dict, list)):
+      if create:
+        raise ValueError("Can't create field {} inside a {}.".format(path, type(target).__name__))
+      return None, None
+
+  return target, parts[-1]
+
+
+def get_value(doc, path, default=None):
+  target, key = container(doc, path, create=False)
+  if isinstance(target, dict):
+    return target.get(key, default)
+  elif isinstance(target, list) and key.isdigit() and int(key) < len(target):
+    return target[int(key)]
+
+  return default
+
+
+def set_value(doc, path, value):
+  target, key = container(doc, path)
+  if isinstance(target, list):
+    if not key.isdigit():
+      raise ValueError("Can't set field {} of a list.".format(path))
+    index = int(key)
+    target.extend([None] * (index + 1 - len(target)))
+    target[index] = value
+  elif target is None:
+    raise ValueError("Can't set field {}.".format(path))
+  else:
+    target[key] = value
+
+
+def unset_value(doc, path):
+  target, key = container(doc, path, create=False)
+  if isinstance(target, dict):
+    target.pop(key, None)
+  elif isinstance(target, list) and key.isdigit() and int(key) < len(target):
+    target[int(key)] = None  # like Mongo, unsetting an element leaves a null in its place
+
+
+def list_value(doc, path, operator):
+  value = get_value(doc, path)
+  if value is None:
+    value = []
+    set_value(doc, path, value)
+  elif not isinstance(value, list):
+    raise ValueError("{} needs an array at {}, not a {}.".format(operator, path, type(value).__name__))
+
+  return value
+
+
+def apply_update(doc, update, inserting=False):
+  # applies an update document to doc in place
+  if not update or not all(key.startswith('$') for key in update):
+    raise ValueError("Update documents need update operators; use replace_one to replace a document.")
+
+  for operator, fields in update.items():
+    for path, argument in fields.items():
+      if path == '_id' or path.startswith('_id.'):
+        if operator != '$setOnInsert' or not inserting:
+          raise ValueError("Performing an update on the path '_id' would modify the immutable field '_id'.")
+
+      if operator == '$set':
+        set_value(doc, path, clone(argument))
+      elif operator == '$setOnInsert':
+        if inserting:
+          set_value(doc, path, clone(argument))
+      elif operator == '$unset':
+        unset_value(doc, path)
+      elif operator == '$inc':
+        set_value(doc, path, get_value(doc, path, 0) + argument)
+      elif operator == '$min':
+        current = get_value(doc, path)
+        if current is None or argument < current:
+          set_value(doc, path, clone(argument))
+      elif operator == '$max':
+        current = get_value(doc, path)
+        if current is None or argument > current:
+          set_value(doc, path, clone(argument))
+      elif operator == '$push':
+        items = list_value(doc, path, operator)
+        if isinstance(argument, dict) and '$each' in argument:
+          position = argument.get('$position', len(items))
+          if position < 0:
+            position = max(len(items) + position, 0)
+          items[position:position] = clone(argument['$each'])
+        else:
+          items.append(clone(argument))
+      elif operator == '$addToSet':
+        items = list_value(doc, path, operator)
+        for item in (argument['$each'] if isinstance(argument, dict) and '$each' in argument else [argument]):
+          if item not in items:
+            items.append(clone(item))
+      elif operator == '$pop':
+        items = list_value(doc, path, operator)
+        if items:
+          items.pop(-1 if argument > 0 else 0)
+      elif operator == '$pull':
+        items = list_value(doc, path, operator)
+        if isinstance(argument, dict):
+          items[:] = [item for item in items if not matches_element(item, argument)]
+        else:
+          items[:] = [item for item in items if item != argument]
+      else:
+        raise ValueError("The in-memory engine doesn't support the update operator {}.".format(operator))
+
+
+def upsert_document(query, update=None, replacement=None):
+  # the document an upsert inserts: the query's equality conditions, then the update applied to them
+  doc = {}
+  for path, condition in query.items():
+    if path.startswith('$'):
+      continue
+    if is_operator_dict(condition):
+      if '$eq' in condition:
+        set_value(doc, path, clone(condition['$eq']))
+    else:
+      set_value(doc, path, clone(condition))
+
+  if replacement is not None:
+    doc = dict(clone(replacement), _id=doc.get('_id', replacement.get('_id')))
+  else:
+    apply_update(doc, update, inserting=True)
+
+  if doc.get('_id') is None:
+    doc['_id'] = ObjectId()
+
+  return doc
+
+
+# ## Collections
+def index_name(keys):
+  return '_'.join('{}_{}'.format(key, direction) for key, direction in keys)
+
+
+def index_keys(keys):
+  if isinstance(keys, str):
+    return [(keys, ASCENDING)]
+  elif isinstance(keys, dict):
+    return list(keys.items())  # like IndexModel's document['key']
+
+  return [(key, ASCENDING) if isinstance(key, str) else tuple(key) for key in keys]
+
+
+def frozen(value):
+  if isinstance(value, dict):
+    return tuple((key, frozen(item)) for key, item in value.items())
+  elif isinstance(value, list):
+    return tuple(frozen(item) for item in value)
+
+  return value
+
+
+class MemoryCollection(object):
+  def __init__(self, database, name):
+    self.database = database
+    self.name = name
+    self.full_name = '{}.{}'.format(database.name, name)
+    self.lock = threading.RLock()
+    self.clear()
+
+  def clear(self):
+    # empties the collection in place: like pymongo's Collection objects, this one outlives a drop
+    with self.lock:
+      self.documents = {}  # _id -> document; never changed in place, see above
+      self.indexes = {'_id_': {'key': [('_id', ASCENDING)], 'v': 2}}
+      self.unique = {}  # index name -> {key values: _id}
+
+  def with_options(self, **kwargs):
+    return self  # read preferences and write concerns mean nothing here
+
+  # ### Indexes
+  def create_index(self, keys, **kwargs):
+    keys = index_keys(keys)
+    name = kwargs.get('name') or index_name(keys)
+
+    with self.lock:
+      self.indexes[name] = dict((key, value) for key, value in kwargs.items() if key != 'name')
+      self.indexes[name].update(key=keys, v=2)
+
+      if kwargs.get('unique'):
+        entries = {}
+        for doc in self.documents.values():
+          key = self.unique_key(keys, doc)
+          if key in entries:
+            del self.indexes[name]
+            raise DuplicateKeyError("E11000 duplicate key error collection: {} index: {}".format(self.full_name, name), 11000)
+          entries[key] = doc['_id']
+        self.unique[name] = entries
+
+    return name
+
+  def create_indexes(self, models):
+    return [self.create_index(model.document['key'], **dict((k, v) for k, v in model.document.items() if k != 'key'))
+            for model in models]
+
+  def index_information(self):
+    with self.lock:
+      return dict((name, dict(info, key=list(info['key']))) for name, info in self.indexes.items())
+
+  def drop_index(self, index_or_name):
+    name = index_or_name if isinstance(index_or_name, str) else index_name(index_keys(index_or_name))
+    with self.lock:
+      if name == '_id_' or name not in self.indexes:
+        raise ValueError("Index {} can't be dropped: it doesn't exist.".format(name))
+      del self.indexes[name]
+      self.unique.pop(name, None)
+
+  def drop_indexes(self):
+    with self.lock:
+      for name in [name for name in self.indexes if name != '_id_']:
+        self.drop_index(name)
+
+  def unique_key(self, keys, doc):
+    return tuple(frozen((values_at(doc, key) or [None])[0]) for key, direction in keys)
+
+  def check_unique(self, doc):
+    # raises DuplicateKeyError if doc would share a unique index key with another document
+    for name, entries in self.unique.items():
+      key = self.unique_key(self.indexes[name]['key'], doc)
+      owner = entries.get(key)
+      if owner is not None and owner != doc['_id']:
+        raise DuplicateKeyError("E11000 duplicate key error collection: {} index: {} dup key: {}".format(
+          self.full_name, name, key), 11000, {'keyValue': dict(zip([k for k, d in self.indexes[name]['key']], key))})
+
+  def store(self, doc, old=None):
+    # puts doc in place of old (None to add it), keeping the unique indexes up to date
+    self.check_unique(doc)
+    if old is not None:
+      for name, entries in self.unique.items():
+        entries.pop(self.unique_key(self.indexes[name]['key'], old), None)
+
+    for name, entries in self.unique.items():
+      entries[self.unique_key(self.indexes[name]['key'], doc)] = doc['_id']
+
+    self.documents[doc['_id']] = doc
+
+  def remove(self, doc):
+    for name, entries in self.unique.items():
+      entries.pop(self.unique_key(self.indexes[name]['key'], doc), None)
+
+    del self.documents[doc['_id']]
+
+  # ### Reads
+  def candidates(self, query):
+    # (the documents query can match, the rest of query to check them with): a query on _id alone (or $in
+    # or $eq one) looks them up directly instead of scanning everything, and needn't be checked again
+    condition = query.get('_id')
+    if condition is None or (isinstance(condition, dict) and (len(condition) != 1 or set(condition) - {'$in', '$eq'})):
+      return list(self.documents.values()), query
+
+    if isinstance(condition, dict) and '$in' in condition:
+      ids = condition['$in']
+    elif isinstance(condition, dict):
+      ids = [condition['$eq']]
+    else:
+      ids = [condition]
+
+    found = []
+    seen = set()
+    for doc_id in ids:
+      try:
+        doc = self.documents.get(doc_id)
+      except TypeError:
+        continue  # unhashable, so no document has it as its id
+      if doc is not None and doc_id not in seen:
+        seen.add(doc_id)
+        found.append(doc)
+
+    return found, dict((key, value) for key, value in query.items() if key != '_id')
+
+  def matching(self, query, sort=None, skip=0, limit=0):
+    with self.lock:
+      docs, rest = self.candidates(query or {})
+      if rest:
+        docs = [doc for doc in docs if matches(doc, rest)]
+
+    if sort:
+      sort_documents(docs, sort)
+    if skip:
+      docs = docs[skip:]
+    if limit:
+      docs = docs[:abs(limit)]
+
+    return docs
+
+  def find(self, filter=None, projection=None, skip=0, limit=0, sort=None, batch_size=0, **kwargs):
+    return MemoryCursor(self, filter or {}, projection, skip=skip, limit=limit, sort=sort)
+
+  def find_one(self, filter=None, *args, **kwargs):
+    if filter is not None and not isinstance(filter, dict):
+      filter = {'_id': filter}
+
+    for doc in self.find(filter, *args, **dict(kwargs, limit=1)):
+      return doc
+
+    return None
+
+  def count_documents(self, filter, **kwargs):
+    return len(self.matching(filter, skip=kwargs.get('skip', 0), limit=kwargs.get('limit', 0)))
+
+  def estimated_document_count(self, **kwargs):
+    return len(self.documents)
+
+  def distinct(self, key, filter=None, **kwargs):
+    found = []
+    for doc in self.matching(filter or {}):
+      for value in values_at(doc, key):
+        for item in (value if isinstance(value, list) else [value]):
+          if item not in found:
+            found.append(clone(item))
+
+    return found
+
+  def aggregate(self, pipeline, **kwargs):
+    docs = None
+    for stage in pipeline:
+      (name, argument), = stage.items()
+
+      if name == '$match':
+        docs = self.matching(argument) if docs is None else [doc for doc in docs if matches(doc, argument)]
+        continue
+
+      if docs is None:
+        docs = self.matching({})
+
+      if name == '$project':
+        docs = [project(doc, argument) for doc in docs]
+      elif name == '$unwind':
+        path = (argument['path'] if isinstance(argument, dict) else argument)[1:]
+        unwound = []
+        for doc in docs:
+          items = get_value(doc, path)
+          for item in (items if isinstance(items, list) else [] if items is None else [items]):
+            copy = clone(doc)
+            set_value(copy, path, item)
+            unwound.append(copy)
+        docs = unwound
+      elif name == '$sort':
+        docs = sort_documents(list(docs), argument)
+      elif name == '$skip':
+        docs = docs[argument:]
+      elif name == '$limit':
+        docs = docs[:argument]
+      elif name == '$count':
+        docs = [{argument: len(docs)}] if docs else []
+      else:
+        raise ValueError("The in-memory engine doesn't support the aggregation stage {}.".format(name))
+
+    return MemoryCursor(self, None, None, docs=docs if docs is not None else self.matching({}))
+
+  # ### Writes
+  def insert_one(self, document, **kwargs):
+    if '_id' not in document:
+      document['_id'] = ObjectId()  # like pymongo, the caller's document gets its id
+
+    with self.lock:
+      if document['_id'] in self.documents:
+        raise DuplicateKeyError("E11000 duplicate key error collection: {} index: _id_ dup key: {}".format(
+          self.full_name, document['_id']), 11000)
+      self.store(clone(document))
+
+    return InsertOneResult(document['_id'], True)
+
+  def insert_many(self, documents, ordered=True, **kwargs):
+    result = self.bulk_write([InsertOne(document) for document in documents], ordered=ordered)
+    return InsertManyResult([document['_id'] for document in documents][:result.inserted_count], True)
+
+  def update(self, filter, update, upsert=False, many=False, replacement=None):
+    # returns (matched, modified, upserted id)
+    with self.lock:
+      docs = self.matching(filter) if many else self.matching(filter, limit=1)
+
+      if not docs:
+        if not upsert:
+          return 0, 0, None
+        doc = upsert_document(filter, update, replacement)
+        if doc['_id'] in self.documents:
+          raise DuplicateKeyError("E11000 duplicate key error collection: {} index: _id_ dup key: {}".format(
+            self.full_name, doc['_id']), 11000)
+        self.store(doc)
+        return 0, 0, doc['_id']
+
+      modified = 0
+      for old in docs:
+        if replacement is not None:
+          doc = dict(clone(replacement), _id=old['_id'])
+        else:
+          doc = clone(old)
+          apply_update(doc, update)
+
+        if doc != old:
+          self.store(doc, old)
+          modified += 1
+
+      return len(docs), modified, None
+
+  def update_result(self, matched, modified, upserted_id):
+    raw = {'n': matched if upserted_id is None else 1, 'nModified': modified, 'updatedExisting': bool(matched), 'ok': 1.0}
+    if upserted_id is not None:
+      raw['upserted'] = upserted_id
+
+    return UpdateResult(raw, True)
+
+  def update_one(self, filter, update, upsert=False, **kwargs):
+    return self.update_result(*self.update(filter, update, upsert=upsert))
+
+  def update_many(self, filter, update, upsert=False, **kwargs):
+    return self.update_result(*self.update(filter, update, upsert=upsert, many=True))
+
+  def replace_one(self, filter, replacement, upsert=False, **kwargs):
+    return self.update_result(*self.update(filter, None, upsert=upsert, replacement=replacement))
+
+  def delete(self, filter, many=False):
+    with self.lock:
+      docs = self.matching(filter) if many else self.matching(filter, limit=1)
+      for doc in docs:
+        self.remove(doc)
+
+    return len(docs)
+
+  def delete_one(self, filter, **kwargs):
+    return DeleteResult({'n': self.delete(filter), 'ok': 1.0}, True)
+
+  def delete_many(self, filter, **kwargs):
+    return DeleteResult({'n': self.delete(filter, many=True), 'ok': 1.0}, True)
+
+  def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                          return_document=ReturnDocument.BEFORE, **kwargs):
+    with self.lock:
+      docs = self.matching(filter, sort=sort, limit=1)
+      if not docs and not upsert:
+        return None
+
+      before = docs[0] if docs else None
+      matched, modified, upserted_id = self.update({'_id': before['_id']} if before else filter, update, upsert=upsert)
+      after = self.documents[before['_id'] if before else upserted_id]
+
+    doc = after if return_document == ReturnDocument.AFTER else before
+    return None if doc is None else project(doc, projection)
+
+  def find_one_and_delete(self, filter, projection=None, sort=None, **kwargs):
+    with self.lock:
+      docs = self.matching(filter, sort=sort, limit=1)
+      if not docs:
+        return None
+      self.remove(docs[0])
+
+    return project(docs[0], projection)
+
+  def bulk_write(self, requests, ordered=True, **kwargs):
+    counts = {'nInserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'nUpserted': 0}
+    upserted = []
+    errors = []
+
+    for index, request in enumerate(requests):
+      try:
+        if isinstance(request, InsertOne):
+          self.insert_one(request._doc)
+          counts['nInserted'] += 1
+        elif isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+          replacement = request._doc if isinstance(request, ReplaceOne) else None
+          matched, modified, upserted_id = self.update(request._filter, None if replacement else request._doc,
+                                                       upsert=request._upsert, many=isinstance(request, UpdateMany),
+                                                       replacement=replacement)
+          counts['nMatched'] += matched
+          counts['nModified'] += modified
+          if upserted_id is not None:
+            counts['nUpserted'] += 1
+            upserted.append({'index': index, '_id': upserted_id})
+        elif isinstance(request, (DeleteOne, DeleteMany)):
+          counts['nRemoved'] += self.delete(request._filter, many=isinstance(request, DeleteMany))
+        else:
+          raise TypeError("{} is not a write operation.".format(request))
+
+      except DuplicateKeyError as e:
+        errors.append({'index': index, 'code': 11000, 'errmsg': str(e), 'op': request})
+        if ordered:
+          break
+
+    result = dict(counts, upserted=upserted, writeErrors=errors, writeConcernErrors=[])
+    if errors:
+      raise BulkWriteError(result)
+
+    return BulkWriteResult(result, True)
+
+  def drop(self, **kwargs):
+    self.database.drop_collection(self.name)
+
+
+class MemoryCursor(object):
+  # matches when made, and copies each document out (through the projection) as it is reached
+  def __init__(self, collection, filter, projection, skip=0, limit=0, sort=None, docs=None):
+    self.collection = collection
+    self.filter = filter
+    self.projection = projection
+    self.skip_count = skip
+    self.limit_count = limit
+    self.sort_spec = sort
+    self.docs = docs
+    self.position = 0
+
+  def evaluate(self):
+    if self.docs is None:
+      self.docs = self.collection.matching(self.filter, sort=self.sort_spec, skip=self.skip_count, limit=self.limit_count)
+
+    return self.docs
+
+  def sort(self, key_or_list, direction=None):
+    self.sort_spec = [(key_or_list, direction or ASCENDING)] if isinstance(key_or_list, str) else key_or_list
+    return self
+
+  def skip(self, count):
+    self.skip_count = count
+    return self
+
+  def limit(self, count):
+    self.limit_count = count
+    return self
+
+  def batch_size(self, size):
+    return self
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    docs = self.evaluate()
+    if self.position >= len(docs):
+      raise StopIteration
+
+    doc = docs[self.position]
+    self.position += 1
+    return project(doc, self.projection)
+
+  def to_list(self, length=None):
+    docs = []
+    for doc in self:
+      docs.append(doc)
+      if length and len(docs) >= length:
+        break
+
+    return docs
+
+  def close(self):
+    self.docs = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+class MemoryDatabase(object):
+  def __init__(self, client, name):
+    self.client = client
+    self.name = name
+    self.collections = {}
+    self.lock = threading.Lock()
+
+  def __getitem__(self, name):
+    collection = self.collections.get(name)
+    if collection is None:
+      with self.lock:
+        collection = self.collections.setdefault(name, MemoryCollection(self, name))
+
+    return collection
+
+  def get_collection(self, name, **kwargs):
+    return self[name]
+
+  def list_collection_names(self, **kwargs):
+    return [name for name, collection in self.collections.items() if collection.documents or len(collection.indexes) > 1]
+
+  def drop_collection(self, name, **kwargs):
+    self[name if isinstance(name, str) else name.name].clear()
+
+
+class MemoryClient(object):
+  def __init__(self, *args, **kwargs):
+    self.databases = {}
+    self.lock = threading.Lock()
+
+  def __getitem__(self, name):
+    database = self.databases.get(name)
+    if database is None:
+      with self.lock:
+        database = self.databases.setdefault(name, MemoryDatabase(self, name))
+
+    return database
+
+  def get_database(self, name, **kwargs):
+    return self[name]
+
+  def list_database_names(self):
+    return list(self.databases)
+
+  def drop_database(self, name):
+    for collection in self[name if isinstance(name, str) else name.name].collections.values():
+      collection.clear()
+
+  def close(self):
+    pass
+
+
+# ## Asyncio
+# The same store behind the shape of pymongo's AsyncMongoClient: everything runs right away, in the caller.
+class AsyncMemoryCursor(object):
+  def __init__(self, cursor):
+    self.cursor = cursor
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    try:
+      return next(self.cursor)
+    except StopIteration:
+      raise StopAsyncIteration
+
+  async def to_list(self, length=None):
+    return self.cursor.to_list(length)
+
+  async def close(self):
+    self.cursor.close()
+
+
+class AsyncMemoryCollection(object):
+  def __init__(self, collection):
+    self.collection = collection
+
+  def find(self, *args, **kwargs):
+    return AsyncMemoryCursor(self.collection.find(*args, **kwargs))
+
+  async def aggregate(self, *args, **kwargs):
+    return AsyncMemoryCursor(self.collection.aggregate(*args, **kwargs))
+
+  def with_options(self, **kwargs):
+    return self
+
+  def __getattr__(self, name):
+    method = getattr(self.collection, name)
+
+    async def call(*args, **kwargs):
+      return method(*args, **kwargs)
+
+    return call
+
+
+class AsyncMemoryDatabase(object):
+  def __init__(self, database):
+    self.database = database
+
+  def __getitem__(self, name):
+    return AsyncMemoryCollection(self.database[name])
+
+  def get_collection(self, name, **kwargs):
+    return self[name]
+
+
+class AsyncMemoryClient(object):
+  def __init__(self, client=None):
+    self.client = client or MemoryClient()
+
+  def __getitem__(self, name):
+    return AsyncMemoryDatabase(self.client[name])
+
+  def get_database(self, name, **kwargs):
+    return self[name]
+
+  async def close(self):
+    pass
@@ -0,0 +1,664 @@
+from bson import ObjectId
+from contextlib import contextmanager
+from pymongo import IndexModel, InsertOne, UpdateOne, DeleteOne, ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from graphstore import analytics
+from graphstore.changes import ChangeLog, Change, changes_since
+from graphstore.identity import IdentityMap, LRUIdentityMap, ScopedIdentityMap
+from graphstore.importers.graph import GraphImporter
+from graphstore.indexes import sync_indexes
+from graphstore.memory import MemoryClient, MemoryCollection
+from graphstore.models import MongoModel, MongoIndex, Node, Link, Graph, IntegerField, StringField, ListField, ListDelta, VersionField, ConflictError
+from graphstore.session import Session
+import random
+import sys
+import threading
+
+# like local_test.py, but on the in-memory engine (see graphstore.memory), so it needs no Mongo server
+MongoModel.connect_to_database("test", "localhost", 27017, engine='memory')
+
+# ## Identity maps
+# one object per id: loading a node twice gives the object already in the map
+node = Node(data={'name': 'identity'})
+node.save()
+assert Node.get_by_id(node.id) is node
+
+MongoModel.identity_map.clear()
+reloaded = Node.get_by_id(node.id)
+assert reloaded is not node and reloaded.data == {'name': 'identity'}
+assert Node.get_by_id(node.id) is reloaded
+
+# LRU maps evict the least recently used object once they are full, and count it
+lru = LRUIdentityMap(max_size=2)
+lru.add(Node, 'a', 'A')
+lru.add(Node, 'b', 'B')
+assert lru.get(Node, 'a') == 'A'  # now b is the least recently used
+lru.add(Node, 'c', 'C')
+assert lru.get(Node, 'b') is None and lru.get(Node, 'a') == 'A' and lru.get(Node, 'c') == 'C'
+assert lru.stats() == {'hits': 3, 'misses': 1, 'evictions': 1, 'size': 2}
+
+# with weak, an evicted object that is still referenced elsewhere comes back as the same object
+weak_lru = LRUIdentityMap(max_size=1, weak=True)
+kept = Node()
+weak_lru.add(Node, 'kept', kept)
+weak_lru.add(Node, 'other', Node())
+assert weak_lru.get(Node, 'kept') is kept
+
+# the ttl makes old entries miss, so they are loaded again
+expiring = LRUIdentityMap(ttl=0)
+expiring.add(Node, 'a', 'A')
+assert expiring.get(Node, 'a') is None
+
+# a scope gets its own map; outside of one, the fallback map is used
+scoped = ScopedIdentityMap(fallback=IdentityMap())
+scoped.add(Node, 'outside', 'O')
+with scoped.scope():
+  assert scoped.get(Node, 'outside') is None
+  scoped.add(Node, 'inside', 'I')
+  assert scoped.get(Node, 'inside') == 'I'
+
+assert scoped.get(Node, 'inside') is None and scoped.get(Node, 'outside') == 'O'
+
+# without a fallback, nothing is cached outside of scopes
+uncached = ScopedIdentityMap()
+uncached.add(Node, 'a', 'A')
+assert uncached.get(Node, 'a') is None and len(uncached) == 0
+
+# an LRU map shared by threads, like a ScopedIdentityMap's fallback, stays consistent, and so do the counts
+shared = LRUIdentityMap(max_size=50, ttl=0.001)
+shared_scoped = ScopedIdentityMap(fallback=IdentityMap())
+failures = []
+
+
+def hammer(offset):
+  try:
+    for i in range(20000):
+      key = str((offset + i) % 200)
+      if shared.get(Node, key) is None:
+        shared.add(Node, key, key)
+      shared_scoped.get(Node, key)
+      if i % 7 == 0:
+        shared.discard(Node, key)
+  except Exception as e:
+    failures.append(e)
+
+
+switch_interval = sys.getswitchinterval()
+sys.setswitchinterval(1e-6)  # switch threads as often as possible, so they interleave inside the map's methods
+
+threads = [threading.Thread(target=hammer, args=(n * 13,)) for n in range(8)]
+for thread in threads:
+  thread.start()
+for thread in threads:
+  thread.join()
+
+sys.setswitchinterval(switch_interval)
+
+assert not failures, failures
+assert len(shared) <= 50
+assert shared.hits + shared.misses == shared_scoped.hits + shared_scoped.misses == 8 * 20000
+
+
+# ## Reference batching
+# references load with one $in query per REF_BATCH_SIZE ids, so a query count doesn't grow with a list's length
+@contextmanager
+def counting_finds():
+  # the collection names of the queries the memory engine answers in the block
+  finds = []
+  find = MemoryCollection.find
+
+  def counted_find(collection, *args, **kwargs):
+    finds.append(collection.name)
+    return find(collection, *args, **kwargs)
+
+  MemoryCollection.find = counted_find
+  try:
+    yield finds
+  finally:
+    MemoryCollection.find = find
+
+
+batch_nodes = [Node(data={'index': i}) for i in range(2 * MongoModel.REF_BATCH_SIZE + 1)]
+for batch_node in batch_nodes:
+  batch_node.save()
+
+batch_graph = Graph(nodes=batch_nodes)
+batch_graph.save()
+MongoModel.identity_map.clear()
+
+with counting_finds() as finds:
+  loaded_graph = Graph.get_by_id(batch_graph.id)
+  assert len(loaded_graph.nodes) == len(batch_nodes)
+
+assert finds == [Graph.COLLECTION] + [Node.COLLECTION] * 3, finds  # the graph itself, then three chunks of nodes
+
+# nested references are batched across the whole list too: every link's sources and sinks come in one $in query
+nested_links = [Link(sources=[batch_nodes[i]], sinks=[batch_nodes[i + 1]]) for i in range(100)]
+for nested_link in nested_links:
+  nested_link.save()
+
+nested_graph = Graph(links=nested_links)
+nested_graph.save()
+MongoModel.identity_map.clear()
+
+with counting_finds() as finds:
+  loaded_graph = Graph.get_by_id(nested_graph.id)
+  assert [link.sinks[0].data['index'] for link in loaded_graph.links] == list(range(1, 101))
+
+assert finds == [Graph.COLLECTION, Link.COLLECTION, Node.COLLECTION], finds  # the graph, its links, then their nodes
+
+# find() makes its objects a batch at a time, with one query for the references of the whole batch
+for batch_size, node_finds in [(0, 1), (30, 4)]:
+  MongoModel.identity_map.clear()
+  with counting_finds() as finds:
+    found = list(Link.find({'_id': {'$in': [link._id for link in nested_links]}}, batch_size=batch_size))
+    assert [link.sinks[0].data['index'] for link in found] == list(range(1, 101))
+
+  assert finds == [Link.COLLECTION] + [Node.COLLECTION] * node_finds, finds
+
+
+# ## Sessions
+class Counted(MongoModel):
+  count = IntegerField(min_value=1)
+
+
+with Session() as session:
+  first = Counted(count=1)
+  first.save()
+  link = Link(sources=[node], sinks=[node])
+  link.save()
+  assert first._id is not None and Counted.collection().find_one({'_id': first._id}) is None  # not written yet
+
+assert session.round_trips == 2  # one bulk_write per collection
+assert Counted.get_by_id(first.id).count == 1
+
+# invalid objects are refused by save() itself, so the rest of the session still commits
+with Session() as session:
+  try:
+    Counted(count=0).save()
+    assert False, "saved an invalid object"
+  except ValueError:
+    pass
+
+  Counted(count=2).save()
+
+assert Counted.collection().count_documents({}) == 2
+
+# a commit that fails drops what it had queued, and leaving the block doesn't try it again
+with Session() as session:
+  Counted(count=3).save()
+  Counted.collection().create_index('count', unique=True, name='count_index')
+  Counted(count=3).save()
+
+  try:
+    session.commit()
+    assert False, "committed a duplicate key"
+  except Exception:
+    pass
+
+  assert session.failed and not session.pending
+
+Counted.collection().drop_index('count_index')
+
+# objects that were never inserted get their old id back, so saving them afterwards inserts them
+with Session() as session:
+  unsaved = Counted(count=4)
+  unsaved.save()
+  session.rollback()
+
+assert unsaved._id is None
+unsaved.save()
+assert Counted.get_by_id(unsaved.id).count == 4
+
+with Session() as session:
+  Counted(count=5).save()
+  Counted.collection().create_index('count', unique=True, name='count_index')
+  stored, duplicate = Counted(count=6), Counted(count=5)
+  stored.save()
+  duplicate.save()
+
+  try:
+    session.commit()
+    assert False, "committed a duplicate key"
+  except Exception:
+    pass
+
+  assert isinstance(stored._id, ObjectId) and duplicate._id is None  # stored was inserted before the error
+
+Counted.collection().drop_index('count_index')
+duplicate.count = 7
+duplicate.save()
+assert Counted.get_by_id(duplicate.id).count == 7 and Counted.get_by_id(stored.id).count == 6
+
+
+# ## List deltas
+# lists changed in place are saved as $push, $pop, $pull and positional $set updates of just the change
+class Numbers(MongoModel):
+  items = ListField(IntegerField())
+
+
+numbers = Numbers(items=list(range(10)))
+numbers.save()
+
+numbers.items.append(10)
+assert numbers.changed() == {'items': ListDelta([('$push', {'items': {'$each': [10]}})])}
+numbers.items.insert(0, -1)
+numbers.items[5] = 50
+numbers.items.pop()
+assert numbers.update_documents(numbers.changed()) == [
+  {'$push': {'items': {'$each': [10]}}},
+  {'$push': {'items': {'$each': [-1], '$position': 0}}},
+  {'$set': {'items.5': 50}},
+  {'$pop': {'items': 1}},
+]  # the n-th update of a list goes into the n-th update document, since they would conflict in one
+
+numbers.save()
+assert Numbers.collection().find_one({'_id': numbers._id})['items'] == [-1, 0, 1, 2, 3, 50, 5, 6, 7, 8, 9]
+
+# a list that is sorted or assigned can't be replayed, so it is written whole
+numbers.items.sort()
+assert numbers.changed() == {'items': sorted([-1, 0, 1, 2, 3, 50, 5, 6, 7, 8, 9])}
+numbers.items = [1, 2]
+assert numbers.changed() == {'items': [1, 2]}
+numbers.save()
+
+# whatever is done to a list, the stored one ends up the same as the one in memory
+random.seed(11)
+for trial in range(200):
+  items = numbers.items
+  for step in range(random.randint(1, 4)):
+    action = random.choice(['append', 'insert', 'remove', 'pop', 'pop0', 'set', 'del', 'extend'])
+    if action == 'append':
+      items.append(random.randint(0, 20))
+    elif action == 'insert':
+      items.insert(random.randint(-3, len(items) + 2), random.randint(0, 20))
+    elif action == 'extend':
+      items.extend([1, 2])
+    elif not items:
+      continue
+    elif action == 'remove':
+      items.remove(random.choice(list(items)))
+    elif action == 'pop':
+      items.pop()
+    elif action == 'pop0':
+      items.pop(0)
+    elif action == 'set':
+      items[random.randrange(len(items))] = random.randint(0, 20)
+    elif action == 'del':
+      del items[random.randrange(len(items))]
+
+  numbers.save()
+  assert Numbers.collection().find_one({'_id': numbers._id})['items'] == list(numbers.items), trial
+
+# ## Adjacency
+# lookups by node only see the graph's own links, also when a link is in several graphs
+
+a, b, c = Node(), Node(), Node()
+for adjacent in (a, b, c):
+  adjacent.save()
+
+ab, bc, ca = Link(sources=[a], sinks=[b]), Link(sources=[b], sinks=[c]), Link(sources=[c], sinks=[a])
+ab.save()
+bc.save()
+ca.save()
+
+with Session():
+  cycle = Graph(nodes=[a, b, c], links=[ab, bc])
+  cycle.save()
+
+cycle.links.append(ca)
+cycle.save()
+other = Graph(nodes=[a, b], links=[ab, Link(sources=[b], sinks=[a])])
+other.links[1].save()
+other.save()
+
+assert cycle.neighbors(b) == [a, c] and cycle.neighbors(b, direction='out') == [c]
+assert cycle.degree(a) == 2 and cycle.degree(a, direction='in') == 1
+assert other.neighbors(a) == [b] and other.degree(b, direction='out') == 1
+assert other.degree(a) == 2 and other.degree(a, direction='out') == 1  # ab is shared with cycle
+
+# a link removed from a graph is gone from its lookups, and only from that graph's
+other.links.remove(ab)
+other.save()
+assert other.degree(a) == 1 and other.neighbors(a, direction='out') == []
+assert cycle.degree(a) == 2 and cycle.neighbors(a, direction='out') == [b]
+
+# the set of link ids the lookups are checked against is kept until the links change
+assert cycle.link_ids() is cycle.link_ids() and other.link_ids() == {other.links[0].id}
+other.links.append(ab)
+assert other.link_ids() == {ab.id, other.links[0].id} and other.degree(a) == 2
+other.save()
+assert other.link_ids() is other.link_ids() and other.degree(a) == 2
+other.links.remove(ab)
+other.save()
+assert other.link_ids() == {other.links[0].id} and other.degree(a) == 1
+
+
+# a graph's revision goes up with $inc on every write that changes its links or nodes, also through a link
+def stored_revision(graph):
+  return Graph.collection().find_one({'_id': graph._id})['revision']
+
+
+revision = stored_revision(cycle)
+stale = Graph(nodes=[a])
+stale._id, stale.revision = cycle._id, 0  # a copy of the graph that is behind; its save still adds one
+stale.mark_clean()
+stale.nodes.append(b)
+stale.save()
+assert stored_revision(cycle) == revision + 1
+
+cycle.data = {'name': 'cycle'}
+cycle.save()
+assert stored_revision(cycle) == revision + 1  # nothing the revision covers changed
+
+ab.sinks = [c]
+ab.save()
+assert stored_revision(cycle) == revision + 2
+
+with Session():
+  bc.sources.append(a)
+  bc.save()
+  ca.data = {'weight': 1}
+  ca.save()
+
+assert stored_revision(cycle) == revision + 3
+
+ca.delete()
+assert stored_revision(cycle) == revision + 4
+
+# a link in several graphs changes all of them
+sharing = Graph(nodes=[b, c], links=[bc])
+sharing.save()
+sharing_revision = stored_revision(sharing)
+bc.sinks = [a]
+bc.save()
+assert stored_revision(cycle) == revision + 5 and stored_revision(sharing) == sharing_revision + 1
+
+# the revision in memory only goes up once the write went through
+Graph.collection().update_one({'_id': cycle._id}, {'$set': {'revision': 'not a number'}})
+memory_revision = cycle.revision
+cycle.nodes.pop()
+try:
+  cycle.save()
+  assert False, "incremented a string"
+except Exception:
+  pass
+
+assert cycle.revision == memory_revision
+Graph.collection().update_one({'_id': cycle._id}, {'$set': {'revision': memory_revision}})
+cycle.save()
+assert cycle.revision == stored_revision(cycle) == memory_revision + 1
+
+# in a Session, what was written before a later collection failed isn't written again by a retry
+stored_nodes = Graph.collection().find_one({'_id': cycle._id})['nodes']
+Graph.collection().update_one({'_id': cycle._id}, {'$set': {'revision': 'not a number'}})
+try:
+  with Session():
+    bc.sinks.append(c)
+    bc.save()
+    cycle.nodes.append(c)
+    cycle.save()
+  assert False, "incremented a string"
+except Exception:
+  pass
+
+assert not bc.changed() and cycle.changed()
+Graph.collection().update_one({'_id': cycle._id}, {'$set': {'revision': cycle.revision}})
+with Session():
+  bc.save()
+  cycle.save()
+
+assert Link.collection().find_one({'_id': bc._id})['sinks'] == [a.id, c.id]
+assert Graph.collection().find_one({'_id': cycle._id})['nodes'] == stored_nodes + [c.id]
+
+# ## Analytics
+# snapshots of a small graph, checked against what was worked out by hand:
+# p -> q -> r -> p is a cycle, s -> t is apart from it, and u has no links at all
+
+p, q, r, s, t, u = nodes = [Node() for name in 'pqrstu']
+for analyzed_node in nodes:
+  analyzed_node.save()
+
+analyzed_links = [Link(sources=[source], sinks=[sink]) for source, sink in [(p, q), (q, r), (r, p), (s, t)]]
+for analyzed_link in analyzed_links:
+  analyzed_link.save()
+
+analyzed = Graph(nodes=nodes, links=analyzed_links)
+analyzed.save()
+snapshot = analytics.snapshot(analyzed)
+
+assert snapshot.node_count == 6 and snapshot.edge_count == 4
+assert list(snapshot.degrees('out')) == [1, 1, 1, 1, 0, 0] and list(snapshot.degrees('in')) == [1, 1, 1, 0, 1, 0]
+assert list(snapshot.degrees('both')) == [2, 2, 2, 1, 1, 0]
+assert list(snapshot.degree_distribution('out')) == [2, 4]
+
+assert list(snapshot.shortest_path_lengths(p)) == [0, 1, 2, -1, -1, -1]
+assert list(snapshot.shortest_path_lengths(p, direction='in')) == [0, 2, 1, -1, -1, -1]
+assert list(snapshot.bfs(p, max_depth=1)[0]) == [0, 1, -1, -1, -1, -1]
+assert snapshot.shortest_path(r, q) == [r.id, p.id, q.id] and snapshot.shortest_path(p, t) is None
+assert snapshot.shortest_path(t, s, direction='both') == [t.id, s.id]
+
+count, labels = snapshot.connected_components()
+assert count == 3 and labels[0] == labels[1] == labels[2] and labels[3] == labels[4]
+assert len(set(labels[[0, 3, 5]])) == 3
+
+assert abs(snapshot.pagerank().sum() - 1) < 1e-6
+
+# a snapshot is reused until the graph's revision moves on, also through a link it shares
+assert analytics.snapshot(analyzed) is snapshot
+also_analyzed = Graph(nodes=[s, t, u], links=[analyzed_links[3]])
+also_analyzed.save()
+also_snapshot = analytics.snapshot(also_analyzed)
+
+analyzed_links[3].sinks = [u]
+analyzed_links[3].save()
+assert analytics.snapshot(analyzed) is not snapshot and list(analytics.snapshot(analyzed).degrees('in')) == [1, 1, 1, 0, 0, 1]
+assert list(analytics.snapshot(also_analyzed).degrees('in')) == [0, 0, 1] != list(also_snapshot.degrees('in'))
+
+# ## Importing
+# importing into a graph again adds what is new; rows with nothing but a known key change nothing
+
+importer = GraphImporter()
+importer.import_links([('x', 'y', {}), ('y', 'z', {})])
+imported = importer.finish()
+
+importer = GraphImporter(graph=imported)
+importer.import_nodes([('x', {}), ('x', {'name': 'x'})])
+assert importer.node_updates == []
+importer.import_nodes([('y', {'colour': 'red'})])
+importer.import_links([('x', 'y', {}), ('z', 'x', {})])
+importer.finish()
+
+MongoModel.identity_map.clear()
+imported = Graph.get_by_id(imported)
+names = {node.data['name']: node for node in imported.nodes}
+assert sorted(names) == ['x', 'y', 'z'] and len(imported.links) == 3
+assert names['y'].data == {'name': 'y', 'colour': 'red'} and names['x'].data == {'name': 'x'}
+assert imported.neighbors(names['x']) == [names['y'], names['z']]
+
+
+# ## Change logs
+# the writes made inside a ChangeLog become one revision of its owner, which changes_since() gathers
+class Notebook(MongoModel):
+  revision = IntegerField(default=0)
+
+
+notebook = Notebook()
+notebook.save()
+first_page, second_page = Node(), Node()
+
+with ChangeLog(Notebook, notebook.id) as log:
+  first_page.save()
+  second_page.save()
+  first_page.data = {'edited': True}
+  first_page.save()
+
+assert log.revision == 1
+assert changes_since(Notebook, notebook.id, 0) == (1, {('Node', second_page.id): False, ('Node', first_page.id): False})
+
+with ChangeLog(Notebook, notebook.id) as log:
+  with Session():
+    second_page.delete()
+    Node().save()
+
+assert log.revision == 2
+revision, objects = changes_since(Notebook, notebook.id, 1)
+assert revision == 2 and len(objects) == 2 and objects[('Node', second_page.id)] is True
+assert len(changes_since(Notebook, notebook.id, 0)[1]) == 3
+
+with ChangeLog(Notebook, notebook.id) as log:
+  pass
+
+assert log.revision is None and changes_since(Notebook, notebook.id, 2) == (2, {})
+
+# clients ahead of the log, or behind what it still has, start over
+assert changes_since(Notebook, notebook.id, 3) == (2, None)
+Change.collection().delete_many({'owner': notebook.id, 'revision': 1})
+assert changes_since(Notebook, notebook.id, 0) == (2, None) and changes_since(Notebook, notebook.id, 1)[1] is not None
+
+
+# ## Versions
+# with a VersionField, a save only applies to the version it was loaded at, so nobody's changes are lost
+class Versioned(MongoModel):
+  name = StringField()
+  version = VersionField()
+
+
+original = Versioned(name='original')
+original.save()
+assert original.version == 0
+
+original.name = 'first'
+original.save()
+assert original.version == 1 and Versioned.collection().find_one({'_id': original._id})['version'] == 1
+
+MongoModel.identity_map.clear()
+copy = Versioned.get_by_id(original.id)
+copy.name = 'second'
+copy.save()
+
+original.name = 'lost'
+try:
+  original.save()
+  assert False, "overwrote a newer version"
+except ConflictError as e:
+  assert e.objects == [original]
+
+assert Versioned.collection().find_one({'_id': original._id})['name'] == 'second'
+assert original.changed() == {'name': 'lost'} and original.version == 1  # kept, to be merged and saved again
+
+# assigning the version says which one a save expects, e.g. the one a client last saw
+original.version = 2
+original.save()
+assert original.version == 3 and Versioned.collection().find_one({'_id': original._id})['name'] == 'lost'
+
+# in a Session, only the conflicting objects keep their changes; the rest is written
+bystander = Versioned(name='bystander')
+bystander.save()
+copy.name = 'stale'
+try:
+  with Session() as session:
+    copy.save()
+    bystander.name = 'written'
+    bystander.save()
+  assert False, "committed a stale version"
+except ConflictError as e:
+  assert e.objects == [copy]
+
+assert session.round_trips == 2  # the bulk_write, then the query for the versions it left
+
+assert copy.changed() == {'name': 'stale'} and not bystander.changed() and bystander.version == 1
+assert Versioned.collection().find_one({'_id': bystander._id})['name'] == 'written'
+
+# documents saved before the model had a version count as version 0
+Versioned.collection().update_one({'_id': bystander._id}, {'$unset': {'version': 1}})
+bystander.version = 0
+bystander.name = 'unversioned'
+bystander.save()
+assert Versioned.collection().find_one({'_id': bystander._id})['version'] == 1
+
+# ## The engine
+# graphstore.memory answers like mongod for what graphstore sends it
+
+engine = MemoryClient()['engine_test']['things']
+
+
+def ids(cursor):
+  return [doc['_id'] for doc in cursor]
+
+
+engine.insert_many([{'_id': 1, 'a': [5, 2]}, {'_id': 2, 'a': 3}, {'_id': 3, 'a': [4, 9]}, {'_id': 4, 'a': []}, {'_id': 5}])
+
+# arrays sort by their smallest element ascending and their largest descending; [] comes before a missing field
+assert ids(engine.find(sort=[('a', ASCENDING)])) == [4, 5, 1, 2, 3]
+assert ids(engine.find(sort=[('a', DESCENDING)])) == [3, 1, 2, 5, 4]
+assert ids(engine.find({'a': {'$gte': 3}}).sort('a', ASCENDING)) == [1, 2, 3]
+
+# equality and comparisons match array elements; $elemMatch needs one element to match it all
+assert ids(engine.find({'a': 2})) == [1] and ids(engine.find({'a': {'$in': [9, 3]}})) == [2, 3]
+assert ids(engine.find({'a': {'$elemMatch': {'$gt': 4, '$lt': 9}}})) == [1]
+assert ids(engine.find({'a': {'$size': 0}})) == [4] and ids(engine.find({'a': None})) == [5]
+assert ids(engine.find({'$or': [{'a': 5}, {'a': {'$exists': False}}]})) == [1, 5]
+
+# updates
+engine.update_one({'_id': 2}, {'$inc': {'b': 2}, '$set': {'c.d': 'x'}})
+engine.update_one({'_id': 1}, {'$push': {'a': {'$each': [0], '$position': 0}}})
+engine.update_one({'_id': 3}, {'$pull': {'a': 9}, '$unset': {'missing': 1}})
+assert engine.find_one({'_id': 2}) == {'_id': 2, 'a': 3, 'b': 2, 'c': {'d': 'x'}}
+assert engine.find_one({'_id': 1}, projection=['a']) == {'_id': 1, 'a': [0, 5, 2]}
+assert engine.find_one({'_id': 3})['a'] == [4]
+
+upserted = engine.update_one({'_id': 6}, {'$setOnInsert': {'a': 1}}, upsert=True)
+assert upserted.upserted_id == 6 and upserted.matched_count == 0 and engine.count_documents({}) == 6
+
+# indexes made either way are listed with their keys and options, and unique ones are enforced
+engine.create_index([('a', ASCENDING), ('b', DESCENDING)])
+keyed = engine.database['keyed']
+keyed.insert_one({'c': {'d': 'x'}})
+keyed.create_indexes([IndexModel({'c.d': DESCENDING}, name='cd', unique=True)])
+assert sorted(engine.index_information()) == ['_id_', 'a_1_b_-1']
+assert engine.index_information()['a_1_b_-1']['key'] == [('a', ASCENDING), ('b', DESCENDING)]
+assert keyed.index_information()['cd']['key'] == [('c.d', DESCENDING)] and keyed.index_information()['cd']['unique']
+
+try:
+  keyed.insert_one({'c': {'d': 'x'}})
+  assert False, "inserted a duplicate key"
+except DuplicateKeyError:
+  pass
+
+keyed.drop_index('cd')
+assert 'cd' not in keyed.index_information()
+
+# bulk writes count what they did, and an ordered one stops at the first error
+result = engine.bulk_write([InsertOne({'_id': 8}), UpdateOne({'_id': 8}, {'$set': {'a': 1}}), DeleteOne({'_id': 6})])
+assert (result.inserted_count, result.matched_count, result.modified_count, result.deleted_count) == (1, 1, 1, 1)
+
+try:
+  engine.bulk_write([InsertOne({'_id': 8}), InsertOne({'_id': 9})])
+  assert False, "inserted a duplicate id"
+except BulkWriteError as e:
+  assert e.details['nInserted'] == 0 and engine.find_one({'_id': 9}) is None
+
+
+# ## Index syncs
+# graphstore.indexes creates the declared MongoIndexes a collection lacks, and reports the ones that differ
+class Catalogued(MongoModel):
+  title = StringField()
+  year = IntegerField()
+
+  title_index = MongoIndex(['title'])
+  year_title_index = MongoIndex([('year', DESCENDING), 'title'])
+
+
+def statuses(report):
+  return dict((row['name'], row['status']) for row in report)
+
+
+assert statuses(sync_indexes([Catalogued], create=False)) == {'title_index': 'missing', 'year_title_index': 'missing'}
+assert statuses(sync_indexes([Catalogued])) == {'title_index': 'created', 'year_title_index': 'created'}
+assert statuses(sync_indexes([Catalogued])) == {'title_index': 'present', 'year_title_index': 'present'}
+assert Catalogued.collection().index_information()['year_title_index']['key'] == [('year', DESCENDING), ('title', ASCENDING)]
+
+Catalogued.collection().drop_index('year_title_index')
+Catalogued.collection().create_index([('year', ASCENDING), ('title', ASCENDING)], name='year_title_index')
+assert statuses(sync_indexes([Catalogued], create=False))['year_title_index'] == 'different'
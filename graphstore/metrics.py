@@ -0,0 +1,198 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import inspect
+
+import bson
+from pymongo import monitoring
+
+# the RequestMetrics the commands sent in this context are counted in; see measuring()
+current_metrics = ContextVar('graphstore_metrics', default=None)
+
+# the model method sending commands in this context, e.g. 'Vertex.find'; see operation()
+current_operation = ContextVar('graphstore_operation', default=None)
+
+OTHER = 'other'  # the operation of commands sent outside the model methods below, e.g. straight from collection()
+
+
+# ## Counting
+class QueryStats(object):
+  # what the commands of one collection, one operation or a whole request added up to
+  __slots__ = ('queries', 'documents', 'bytes_sent', 'bytes_received', 'seconds', 'failures')
+
+  def __init__(self):
+    self.queries = 0
+    self.documents = 0  # returned by reads
+    self.bytes_sent = 0
+    self.bytes_received = 0
+    self.seconds = 0.0
+    self.failures = 0
+
+  def add(self, other):
+    for name in self.__slots__:
+      setattr(self, name, getattr(self, name) + getattr(other, name))
+
+  def as_dict(self):
+    return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class RequestMetrics(object):
+  # The Mongo commands of one request (or any other block, see measuring()), in total, by collection and
+  # by operation. Only commands that finished are counted.
+  def __init__(self, count_bytes=True):
+    self.count_bytes = count_bytes
+    self.totals = QueryStats()
+    self.collections = {}  # collection name -> QueryStats
+    self.operations = {}  # operation -> QueryStats
+    self.pending = {}  # pymongo request id -> (collection, operation, bytes sent)
+
+  def started(self, event):
+    sent = len(bson.encode(event.command)) if self.count_bytes else 0
+    self.pending[event.request_id] = (command_collection(event), current_operation.get() or OTHER, sent)
+
+  def finished(self, event, reply=None):
+    started = self.pending.pop(event.request_id, None)
+    if started is None:
+      return
+
+    collection, operation, sent = started
+    for stats in (self.totals, self.stats(self.collections, collection), self.stats(self.operations, operation)):
+      stats.queries += 1
+      stats.seconds += event.duration_micros / 1e6
+      stats.bytes_sent += sent
+
+      if reply is None:
+        stats.failures += 1
+      else:
+        stats.documents += returned_documents(event.command_name, reply)
+        if self.count_bytes:
+          stats.bytes_received += len(bson.encode(reply))
+
+  @staticmethod
+  def stats(groups, name):
+    stats = groups.get(name)
+    if stats is None:
+      stats = groups[name] = QueryStats()
+
+    return stats
+
+  def as_dict(self):
+    return {
+      'totals': self.totals.as_dict(),
+      'collections': dict((name, stats.as_dict()) for name, stats in self.collections.items()),
+      'operations': dict((name, stats.as_dict()) for name, stats in self.operations.items()),
+    }
+
+
+def command_collection(event):
+  # the collection a command works on, or '-' for commands on none, like ping
+  value = event.command.get(event.command_name)
+  if event.command_name == 'getMore':
+    value = event.command.get('collection')
+
+  return value if isinstance(value, str) else '-'
+
+
+def returned_documents(command_name, reply):
+  cursor = reply.get('cursor')
+  if cursor is not None:
+    return len(cursor.get('firstBatch', cursor.get('nextBatch', ())))
+  elif command_name == 'findAndModify':
+    return 0 if reply.get('value') is None else 1
+
+  return 0
+
+
+class CommandMetrics(monitoring.CommandListener):
+  # Passes the command events of every client made by graphstore.connections to the RequestMetrics of the
+  # context they were sent from. pymongo calls listeners from the code running the command, so the context is
+  # the caller's; commands sent while nothing is being measured cost one ContextVar lookup.
+  def started(self, event):
+    metrics = current_metrics.get()
+    if metrics is not None:
+      metrics.started(event)
+
+  def succeeded(self, event):
+    metrics = current_metrics.get()
+    if metrics is not None:
+      metrics.finished(event, event.reply)
+
+  def failed(self, event):
+    metrics = current_metrics.get()
+    if metrics is not None:
+      metrics.finished(event)
+
+
+command_metrics = CommandMetrics()
+
+
+def begin(count_bytes=True):
+  # starts counting the commands of this context in a new RequestMetrics; returns (metrics, token for end())
+  metrics = RequestMetrics(count_bytes=count_bytes)
+  return metrics, current_metrics.set(metrics)
+
+
+def end(token):
+  if token is not None:
+    current_metrics.reset(token)
+
+
+@contextmanager
+def measuring(count_bytes=True):
+  # with measuring() as metrics: the commands sent in the block are counted in metrics
+  metrics, token = begin(count_bytes)
+  try:
+    yield metrics
+  finally:
+    end(token)
+
+
+# ## Operations
+def operation_name(owner, name):
+  return '{}.{}'.format((owner if isinstance(owner, type) else type(owner)).__name__, name)
+
+
+@contextmanager
+def operation(owner, name):
+  # counts the commands sent in the block under owner's model (or other class) name and name
+  if current_metrics.get() is None:
+    yield
+    return
+
+  token = current_operation.set(operation_name(owner, name))
+  try:
+    yield
+  finally:
+    current_operation.reset(token)
+
+
+def counted(method):
+  # Decorates a method (or classmethod, under @classmethod) so the commands it sends are counted under
+  # "<class name>.<method name>"; the innermost counted method wins.
+  name = method.__name__
+
+  if inspect.iscoroutinefunction(method):
+    @functools.wraps(method)
+    async def counted_method(owner, *args, **kwargs):
+      if current_metrics.get() is None:
+        return await method(owner, *args, **kwargs)
+
+      token = current_operation.set(operation_name(owner, name))
+      try:
+        return await method(owner, *args, **kwargs)
+      finally:
+        current_operation.reset(token)
+
+  else:
+    @functools.wraps(method)
+    def counted_method(owner, *args, **kwargs):
+      if current_metrics.get() is None:
+        return method(owner, *args, **kwargs)
+
+      token = current_operation.set(operation_name(owner, name))
+      try:
+        return method(owner, *args, **kwargs)
+      finally:
+        current_operation.reset(token)
+
+  return counted_method
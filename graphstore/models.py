@@ -1,48 +1,59 @@
 from bson import ObjectId
-from pymongo import MongoClient, ASCENDING
+from pymongo import ASCENDING, UpdateOne, UpdateMany
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from copy import copy
+import asyncio
 import json
+import logging
+import threading
 
-from . import MONGO_CLIENT, MONGO_DATABASE
+from .connections import DEFAULT, current_read_preference, get_connection, register_connection
+from .identity import IdentityMap
+from .metrics import counted, operation, operation_name, current_metrics, current_operation
+from .session import Session, current_session, record_change
+
+logger = logging.getLogger(__name__)
+index_sync_lock = threading.Lock()
+
+# the raw documents MongoModel.hydrate_refs fetched ahead of deserializing, by (model class, id); None for ids not found
+prefetched_docs = ContextVar('graphstore_prefetched_docs', default=None)
 
 
 # ## Base classes
 class MongoModelMeta(type):
+  def __new__(mcs, name, bases, dct):
+    # model instances keep their field values in the _values record declared on MongoModel
+    dct.setdefault('__slots__', ())
+    return super().__new__(mcs, name, bases, dct)
+
   def __init__(cls, name, bases, dct):
-    if not hasattr(cls, 'model_refs'):
-      # base class; create reference dictionary
+    if not hasattr(cls, 'model_name_map'):
+      # base class; create model name map and the default identity map
       cls.model_name_map = {}
-      cls.model_refs = {}
+      cls.identity_map = IdentityMap()
 
     else:
       cls.model_name_map[name] = cls
-      cls.model_refs[cls] = {}
 
       # Set each class' COLLECTION variable
       cls.COLLECTION = cls.default_collection_name()
 
       # initialize model class' fields variable and stuff it with the defined fields
       cls.fields = {}
+      cls.field_list = []
       cls.indexes = {}
       for attr_name in dir(cls):
         attr = getattr(cls, attr_name)
         if isinstance(attr, MongoField):
-          cls.fields[attr_name] = attr
+          cls.add_field(attr_name, attr)
 
         if isinstance(attr, MongoIndex):
+          attr.kwargs.setdefault('name', attr_name)
           cls.indexes[attr_name] = attr
 
-      index_info = cls.collection().index_information()
-      for index_name, index in cls.indexes.items():
-        if index_name not in index_info:
-          index.kwargs['name'] = index_name
-
-          for i, key in enumerate(index.keys):
-            if isinstance(key, str):
-              index.keys[i] = (key, ASCENDING)
-
-          print("Creating index {} with keys {} and kwargs {}...".format(index_name, index.keys, index.kwargs))
-          cls.collection().create_index(index.keys, **index.kwargs)
-          print("...done.")
+      # indexes are only declared here; sync_indexes() creates them, so defining a model needs no database
+      cls.indexes_checked = False
 
       if name in cls.dependencies:
         field_instances = cls.dependencies[name]
@@ -50,89 +61,292 @@ class MongoModelMeta(type):
         for field_instance in field_instances:
           field_instance.update_config('model_class', cls)
 
+      cls.compile_methods()
+
 
 class MongoModel(object, metaclass=MongoModelMeta):
+  __slots__ = ('_values', '_dirty', '_id', '_projection', '__dict__', '__weakref__')
+
   fields = {}
+  field_list = []
   indexes = {}
   dependencies = {}
-  CLIENT = MONGO_CLIENT
-  DATABASE = MONGO_DATABASE
+  CONNECTION = DEFAULT  # alias of the registered connection this model uses; see graphstore.connections
+  READ_PREFERENCE = None  # where find, find_one and load_tree read from, if not the connection's read preference
+  DATABASE = None  # if not the connection's database
   COLLECTION = None
   STRICT = True
   DEFAULT_EXCLUDE = []
-  _id = None
+  AUTO_SYNC_INDEXES = False  # whether a model's first collection() call syncs its indexes in the background
+  indexes_checked = False
+  version_field = None  # name of the model's VersionField, if it has one; see update_operations()
+  REF_BATCH_SIZE = 1000
 
   def __init__(self, _database=None, _collection=None, **kwargs):
-    self.fields = {}
-    for name, field in self.__class__.fields.items():
-      self.fields[name] = field.copy()
+    self._values = [field.default_value() for field in self.field_list]
+    self._dirty = 0  # bitmask of changed fields, see MongoField.mask
+    self._id = None
+    self._projection = None  # mask of the loaded fields of a partial object, see find()
 
-    self.DATABASE = _database or self.__class__.DATABASE
-    if not self.DATABASE:
-      raise ValueError("Either MongoModel.DATABASE or _database must not be None. Use MongoModel.connect_to_database.")
+    if _database:
+      self.DATABASE = _database
 
     if _collection:
       self.COLLECTION = _collection
 
     deserializing = kwargs.pop('deserializing', False)
     for key, value in kwargs.items():
-      self.__setattr__(key, value)
+      setattr(self, key, value)
 
-      if deserializing and key in self.__class__.fields.keys():
-        self.fields[key].dirty = False
+    if deserializing:
+      self._dirty = 0
 
   @classmethod
-  def connect_to_database(cls, database, uri, port, username=None, password=None, auth_source="admin", auth_mechanism="SCRAM-SHA-1"):
-    cls.DATABASE = database
+  def add_field(cls, name, field):
+    if field.owner is not None and field.owner is not cls:
+      field = field.copy()  # inherited from another model, which numbers its fields differently
+
+    field.bind(cls, name, len(cls.field_list))
+    setattr(cls, name, field)
+    cls.fields[name] = field
+    cls.field_list.append(field)
+
+  def value_list(self):
+    # fields added after this instance was made (see STRICT) get their defaults on first use
+    values = self._values
+    if len(values) < len(self.field_list):
+      values.extend(field.default_value() for field in self.field_list[len(values):])
+
+    return values
 
+  @classmethod
+  def connect_to_database(cls, database, uri, port, username=None, password=None, auth_source="admin", auth_mechanism="SCRAM-SHA-1", **settings):
+    # registers the connection this model uses (every model's, called on MongoModel); settings are Connection's
     if username and password:
-      cls.CLIENT = MongoClient(uri, port, username=username, password=password, authSource=auth_source, authMechanism=auth_mechanism)
-    else:
-      cls.CLIENT = MongoClient(uri, port)
+      settings.update(username=username, password=password, authSource=auth_source, authMechanism=auth_mechanism)
+
+    return register_connection(cls.CONNECTION, database=database, uri=uri, port=port, **settings)
+
+  @classmethod
+  def connection(cls):
+    return get_connection(cls.CONNECTION)
 
   @property
   def id(self):
     return str(self._id) if self._id else None
 
   @classmethod
-  def collection(cls):
-    return cls.CLIENT[cls.DATABASE][cls.COLLECTION]
+  def collection(cls, database=None):
+    # for writes, and for reads that have to see them: always through the connection's read preference
+    if cls.AUTO_SYNC_INDEXES and not cls.indexes_checked:
+      cls.start_index_sync()
 
-  def __getattribute__(self, name):
-    if name != "fields" and name in self.fields:
-      return self.fields[name].value
-    else:
-      return super().__getattribute__(name)
+    return cls.connection().collection(cls.COLLECTION, database or cls.DATABASE)
 
-  def __setattr__(self, name, new_value):
-    if name != "fields" and name in self.fields:
-      self.fields[name].value = new_value
-    else:
-      super().__setattr__(name, new_value)
+  @classmethod
+  def read_collection(cls):
+    # for find, find_one and load_tree, which read where reading_from() or READ_PREFERENCE send them
+    if cls.AUTO_SYNC_INDEXES and not cls.indexes_checked:
+      cls.start_index_sync()
+
+    read_preference = current_read_preference.get() or cls.READ_PREFERENCE
+    return cls.connection().collection(cls.COLLECTION, cls.DATABASE, read_preference=read_preference)
+
+  @classmethod
+  @counted
+  def sync_indexes(cls, create=True):
+    # Compares the declared MongoIndexes with the collection's, creating the missing ones unless create is False.
+    # Returns a report row per index: {'model', 'collection', 'name', 'keys', 'status'}, where status is
+    # 'present', 'created', 'missing' (not created), or 'different' (the name is taken by other keys).
+    collection = cls.connection().collection(cls.COLLECTION, cls.DATABASE)
+    index_info = collection.index_information()
+    report = []
+
+    for index_name, index in cls.indexes.items():
+      name = index.kwargs['name']
+      keys = index.key_list()
+
+      if name in index_info:
+        status = 'present' if [tuple(key) for key in index_info[name]['key']] == keys else 'different'
+      elif create:
+        collection.create_index(keys, **index.kwargs)
+        status = 'created'
+      else:
+        status = 'missing'
+
+      report.append({'model': cls.__name__, 'collection': cls.COLLECTION, 'name': name, 'keys': keys, 'status': status})
+
+    cls.indexes_checked = True
+    return report
+
+  @classmethod
+  def start_index_sync(cls):
+    # syncs this model's indexes on a background thread, once; used by collection() with AUTO_SYNC_INDEXES
+    with index_sync_lock:
+      if cls.indexes_checked:
+        return
+      cls.indexes_checked = True
+
+    def sync():
+      try:
+        for row in cls.sync_indexes():
+          if row['status'] != 'present':
+            level = logging.INFO if row['status'] == 'created' else logging.WARNING  # missing or different needs a look
+            logger.log(level, "Index %s on %s: %s", row['name'], row['collection'], row['status'])
+      except Exception:
+        cls.indexes_checked = False  # tried again on the next use
+        logger.exception("Syncing the indexes of %s failed", cls.__name__)
+
+    threading.Thread(target=sync, name='sync-indexes-{}'.format(cls.__name__), daemon=True).start()
 
   @classmethod
   def default_collection_name(cls):
     return str(cls).split('.')[-1][:-2].lower()  # the class name lowercased
 
   @classmethod
-  def get_or_make_ref(cls, model_class, id, data=None, obj=None, ignore_not_found=False):
-    key = str(id)
+  def set_identity_map(cls, identity_map):
+    # called on MongoModel this sets the policy for every model; on a subclass, only for that model
+    cls.identity_map = identity_map
 
+  @classmethod
+  def check_model_class(cls, model_class):
     if model_class is None:
       raise ValueError("model_class is None and it should not be.")
-    elif model_class not in cls.model_refs:
+    elif cls.model_name_map.get(model_class.__name__) is not model_class:
       raise ValueError("model_class {} is somehow unknown.".format(model_class))
 
-    if key in cls.model_refs[model_class]:
-      return cls.model_refs[model_class][key]
-    else:
-      if obj is None:
+  @classmethod
+  def get_or_make_ref(cls, model_class, id, data=None, obj=None, ignore_not_found=False, lazy=None):
+    key = str(id)
+    cls.check_model_class(model_class)
+
+    cached = model_class.identity_map.get(model_class, key)
+    if cached is not None:
+      return cached
+
+    if obj is None:
+      prefetched = prefetched_docs.get()
+      if data is None and prefetched is not None and (model_class, key) in prefetched:
+        data = prefetched[(model_class, key)]
         if data is None:
-          obj = model_class.get_by_id(id, ignore_not_found=ignore_not_found)
-        else:
-          obj = model_class.deserialize(data, ignore_not_found=ignore_not_found)
+          if ignore_not_found:
+            return None
+          raise ObjectNotFound("No {} was found with id {}.".format(model_class, id))
+
+      if data is None:
+        obj = model_class.get_by_id(id, ignore_not_found=ignore_not_found)
+      elif prefetched is None and lazy is not True:
+        return cls.hydrate_refs(model_class, [data], ignore_not_found=ignore_not_found, lazy=lazy)[0]
+      else:
+        obj = model_class.deserialize(data, ignore_not_found=ignore_not_found, lazy=lazy)
+
+    if obj is None:
+      return None
+
+    return model_class.identity_map.add(model_class, key, obj)
+
+  @classmethod
+  def get_or_make_refs(cls, model_class, ids, ignore_not_found=False, lazy=None):
+    # like get_or_make_ref, but resolves every cache miss with one $in query per REF_BATCH_SIZE ids
+    refs, missing = cls.cached_refs(model_class, ids)
+
+    if missing:
+      if prefetched_docs.get() is None:
+        objs = cls.hydrate_refs(model_class, cls.fetch_docs(model_class, missing), ignore_not_found=ignore_not_found, lazy=lazy)
+      else:
+        # within hydrate_refs, which has fetched these already
+        objs = [cls.get_or_make_ref(model_class, id, ignore_not_found=ignore_not_found, lazy=lazy) for id in missing]
+
+      for obj in objs:
+        if obj is not None:
+          refs[obj.id] = obj
+
+    return cls.aligned_refs(model_class, ids, refs, ignore_not_found)
+
+  @classmethod
+  def fetch_docs(cls, model_class, ids):
+    # the raw documents with these ids, with one $in query per REF_BATCH_SIZE of them
+    docs = []
+    with operation(model_class, 'find'):
+      for start in range(0, len(ids), cls.REF_BATCH_SIZE):
+        docs.extend(model_class.read_collection().find({'_id': {'$in': ids[start:start + cls.REF_BATCH_SIZE]}}))
+
+    return docs
+
+  @classmethod
+  def hydrate_refs(cls, model_class, docs, ignore_not_found=False, lazy=None):
+    # Makes objects of model_class from raw documents. Their eager references, and the references of those in
+    # turn, are fetched first like load_tree does, with a $in query per model class per level, so that making
+    # the objects needs no queries of its own; with lazy, references are left to load on first use.
+    prefetched = dict(((model_class, str(doc['_id'])), doc) for doc in docs)
+    token = prefetched_docs.set(prefetched)
+
+    try:
+      frontier = [] if lazy is True else [(model_class, doc) for doc in docs]
+      eager_only = lazy is None  # lazy=False loads every reference of docs, eagerly; further ones as declared
+
+      while frontier:
+        wanted = OrderedDict()
+        for doc_class, doc in frontier:
+          for ref_class, ref_id in doc_class.reference_ids(doc, eager_only=eager_only):
+            key = (ref_class, str(ref_id))
+            if key not in prefetched and ref_class.identity_map.get(ref_class, key[1]) is None:
+              prefetched[key] = None  # until it is found
+              wanted.setdefault(ref_class, []).append(ObjectId(ref_id) if isinstance(ref_id, str) else ref_id)
+
+        frontier = []
+        for ref_class, ids in wanted.items():
+          for doc in cls.fetch_docs(ref_class, ids):
+            prefetched[(ref_class, str(doc['_id']))] = doc
+            frontier.append((ref_class, doc))
+
+        eager_only = True
+
+      return [cls.get_or_make_ref(model_class, doc['_id'], data=doc, ignore_not_found=ignore_not_found, lazy=lazy) for doc in docs]
+    finally:
+      prefetched_docs.reset(token)
 
-      return cls.model_refs[model_class].setdefault(key, obj)
+  @classmethod
+  def cached_refs(cls, model_class, ids):
+    # returns ({id: object or None}, [ids of the objects that still need to be fetched])
+    cls.check_model_class(model_class)
+
+    refs = {}
+    missing = []
+    for id in ids:
+      key = str(id)
+      if key not in refs:
+        refs[key] = model_class.identity_map.get(model_class, key)
+        if refs[key] is None:
+          missing.append(ObjectId(id) if isinstance(id, str) else id)
+
+    return refs, missing
+
+  @classmethod
+  def aligned_refs(cls, model_class, ids, refs, ignore_not_found):
+    objs = []
+    for id in ids:
+      key = str(id)
+      if refs[key] is not None:
+        objs.append(refs[key])
+      elif ignore_not_found:
+        objs.append(None)
+      else:
+        raise ObjectNotFound("No {} was found with id {}.".format(model_class, id))
+
+    return objs
+
+  @classmethod
+  def get_lazy_ref(cls, model_class, id, ignore_not_found=False):
+    # an already loaded object is returned as is; anything else becomes a ModelRef that loads on first use
+    if id is None:
+      return None
+
+    obj = model_class.identity_map.get(model_class, str(id))
+    if obj is not None:
+      return obj
+    else:
+      return ModelRef(model_class, id, ignore_not_found=ignore_not_found)
 
   @classmethod
   def add_model_dependency(cls, name, field_instance):
@@ -145,19 +359,39 @@ class MongoModel(object, metaclass=MongoModelMeta):
 
     cls.dependencies[name].append(field_instance)
 
+  @counted
   def save(self):
-    if not self.CLIENT:
-      raise ValueError("Must be connected to Mongo.")
-
+    # invalid data is refused right away, also in a Session, where the write itself waits for commit()
     errors = self.validate()
-
     if errors:
       raise ValueError("Data error(s): {}".format(errors))
 
+    session = current_session.get()
+    if session is not None and not session.flushing:
+      session.add(self)
+      return
+
+    collection = self.collection(self.DATABASE)
+
     if isinstance(self._id, ObjectId):
-      changed = self.changed()
-      if changed:
-        result = self.CLIENT[self.DATABASE][self.COLLECTION].update_one({'_id': self._id}, {'$set': changed})
+      related = self.related_updates()
+      operations = self.update_operations()
+      if len(operations) == 1:
+        result = collection.update_one(*operations[0])
+      elif operations:
+        result = collection.bulk_write([UpdateOne(*operation) for operation in operations], ordered=True)
+
+      if operations:
+        if self.version_field is not None:
+          if result.matched_count < len(operations):
+            raise ConflictError([self])
+
+          self.bump_version(len(operations))
+
+        self.after_update()
+        for model_class, related_operation in related:
+          model_class.collection(model_class.DATABASE).bulk_write([related_operation])
+        record_change(self)
 
     else:
       serialized = self.serialize(include='all')
@@ -165,70 +399,198 @@ class MongoModel(object, metaclass=MongoModelMeta):
       if isinstance(self._id, str):
         serialized['_id'] = ObjectId(self._id)
 
-      result = self.CLIENT[self.DATABASE][self.COLLECTION].insert_one(serialized)
+      result = collection.insert_one(serialized)
       self._id = result.inserted_id
       self.get_or_make_ref(self.__class__, self._id, obj=self)
+      record_change(self)
 
     self.mark_clean()
 
+  @counted
   def delete(self):
-    if not self.CLIENT:
-      raise ValueError("Must be connected to Mongo.")
-
-    result = self.CLIENT[self.DATABASE][self.COLLECTION].delete_one({'_id': self._id})
+    session = current_session.get()
+    if session is not None and not session.flushing:
+      session.delete(self)
+      return None
+
+    result = self.collection(self.DATABASE).delete_one({'_id': self._id})
+    for model_class, related_operation in self.related_updates(deleted=True):
+      model_class.collection(model_class.DATABASE).bulk_write([related_operation])
+    self.identity_map.discard(self.__class__, self.id)
+    record_change(self, deleted=True)
     return result
 
+  @classmethod
+  def compile_methods(cls):
+    # validate(), serialize() and changed() run through functions generated for this class's fields
+    cls.compiled_validate = staticmethod(compile_validate(cls))
+    cls.compiled_serialize = staticmethod(compile_serialize(cls, [field for field in cls.field_list if not isinstance(field, RawField) and field.name not in cls.DEFAULT_EXCLUDE]))
+    cls.compiled_serialize_all = staticmethod(compile_serialize(cls, cls.field_list))
+    cls.compiled_changed = staticmethod(compile_changed(cls))
+    cls.list_fields = [field for field in cls.field_list if isinstance(field, ListField)]
+    cls.version_field = next((field.name for field in cls.field_list if isinstance(field, VersionField)), None)
+
   def validate(self):
+    errors = self.compiled_validate(self)
+
+    if self._projection is not None:
+      # a partial object only vouches for the fields it loaded, and can't save any of the others
+      errors = {name: error for name, error in errors.items() if self.fields[name].mask & self._projection}
+
+      for field in self.field_list:
+        if field.mask & self._dirty & ~self._projection:
+          errors[field.name] = "{} was not loaded, so it can't be saved.".format(field.name)
+
+    return errors
+
+  def validate_dynamic(self):
+    # the field-by-field equivalent of validate(); kept as the reference for benchmarks/compiled_models.py
     errors = {}
+    values = self.value_list()
 
-    for field_name, field in self.fields.items():
+    for field in self.field_list:
       try:
-        field.validate()
+        values[field.index] = field.validate(values[field.index])
       except ValueError as e:
-        errors[field_name] = e.args[0]
+        errors[field.name] = e.args[0]
 
     return errors
 
-  def changed(self):
+  def changed(self, **kwargs):
+    return self.compiled_changed(self, kwargs)
+
+  def changed_dynamic(self, **kwargs):
     dirty_fields = {}
+    values = self.value_list()
 
-    for field_name, field in self.fields.items():
+    for field in self.field_list:
       if isinstance(field, RawField):
         continue
 
-      dirty = field.is_dirty()
+      dirty = field.is_dirty(values[field.index], bool(self._dirty & field.mask))
       if dirty:
+        add_dirty_field(dirty_fields, field, values[field.index], dirty, kwargs)
 
-        if dirty is True:
-          dirty_fields[field_name] = field.serialize()
+    return dirty_fields
 
-        elif isinstance(dirty, dict):
-          for inner_field_name, inner_field_value in dirty.items():
-            dirty_fields[field_name + '.' + str(inner_field_name)] = inner_field_value
+  is_dirty = changed
 
-        elif isinstance(dirty, list):
-          for inner_field_path in dirty:
-            dirty_fields[field_name + '.' + str(inner_field_path)] = inner_field_value
+  def fields_changed(self, *names):
+    # whether any of the named fields has unsaved changes
+    values = self.value_list()
+    return any(self.fields[name].is_dirty(values[self.fields[name].index], bool(self._dirty & self.fields[name].mask))
+               for name in names)
 
-        else:
-          raise ValueError("Don't know what to do when dirty is {} and has value '{}'.".format(type(dirty), dirty))
+  def related_updates(self, deleted=False):
+    # [(model class, UpdateOne)] for other documents that change along with this object's update or deletion,
+    # written right after it, or in the same commit in a Session; models like Link override it
+    return []
 
-    return dirty_fields
-
-  is_dirty = changed
+  def after_update(self):
+    # called once this object's update has been written, before it is marked clean; models like Graph override it
+    pass
 
   def mark_clean(self):
-    for field_name, field in self.fields.items():
-      field.mark_clean()
+    self._dirty = 0
+
+    values = self.value_list()
+    for field in self.list_fields:
+      if isinstance(values[field.index], TrackedList):
+        values[field.index].mark_clean()
+
+  @staticmethod
+  def update_documents(changed):
+    # The update documents that write changed(), in order: fields are $set in the first one, and the n-th
+    # update of a ListDelta goes into the n-th, since two updates to the same list in one document conflict.
+    documents = [{}]
+
+    for name, value in changed.items():
+      if isinstance(value, ListDelta):
+        for n, (operator, argument) in enumerate(value.updates):
+          if n == len(documents):
+            documents.append({})
+
+          documents[n].setdefault(operator, {}).update(argument)
+      else:
+        documents[0].setdefault('$set', {})[name] = value
 
-  def serialize(self, **kwargs):
+    return [document for document in documents if document]
+
+  def update_operations(self, cascade=True, writer=None):
+    # (filter, update) pairs for update_one that write changed(). With a VersionField, the n-th one only matches
+    # the version this object was loaded at plus n, and increments it, so a write made in between by someone else
+    # leaves it unmatched instead of being overwritten. A writer id is stored along, for telling afterwards which
+    # of many updates in one bulk_write didn't match (see Session.find_conflicts).
+    changed = self.changed(cascade=cascade)
+
+    if self.version_field is None:
+      return [({'_id': self._id}, update) for update in self.update_documents(changed)]
+
+    field = self.fields[self.version_field]
+
+    changed.pop(field.name, None)  # assigning the version sets what is expected, it isn't written
+    version = self.value_list()[field.index] or 0
+
+    operations = []
+    for n, update in enumerate(self.update_documents(changed)):
+      update.setdefault('$inc', {})[field.name] = 1
+      if writer is not None:
+        update.setdefault('$set', {})[VersionField.WRITER] = writer
+      operations.append(({'_id': self._id, field.name: field.expected(version + n)}, update))
+
+    return operations
+
+  def bump_version(self, count):
+    index = self.fields[self.version_field].index
+    values = self.value_list()
+    values[index] = (values[index] or 0) + count
+
+  def iter_references(self, loaded_only=False, field_names=None):
+    # yields every object this one references through ModelField and ListField(ModelField);
+    # with loaded_only, unresolved ModelRefs are skipped instead of being loaded
+    field_values = self.value_list()
+
+    for field in self.field_list:
+      if field_names is not None and field.name not in field_names:
+        continue
+
+      field_value = field_values[field.index]
+      if isinstance(field, ModelField):
+        values = [field_value]
+      elif isinstance(field, ListField) and isinstance(field.field_class, ModelField) and field_value is not None:
+        if isinstance(field_value, ModelRefList) and not loaded_only:
+          field_value.resolve()  # one batch for the whole list rather than one query per item
+
+        values = raw_items(field_value)
+      else:
+        continue
+
+      for value in values:
+        if isinstance(value, ModelRef):
+          if not value.resolved and loaded_only:
+            continue
+          value = value.resolve()
+
+        if value is not None:
+          yield value
+
+  def serialized_field_names(self, **kwargs):
     include = kwargs.get('include', [])
     exclude = kwargs.get('exclude', []) + self.DEFAULT_EXCLUDE
 
-    output = {}
-    for field_name, field in self.fields.items():
-      if include == 'all' or not isinstance(field, RawField) and (field_name not in exclude or field_name in include):
-        output[field_name] = field.serialize(**kwargs)
+    return [field_name for field_name, field in self.fields.items()
+            if include == 'all' or not isinstance(field, RawField) and (field_name not in exclude or field_name in include)]
+
+  def serialize(self, **kwargs):
+    include = kwargs.get('include', [])
+    values = self.value_list()
+
+    if include == 'all':
+      output = self.compiled_serialize_all(values, kwargs)
+    elif not include and not kwargs.get('exclude', []):
+      output = self.compiled_serialize(values, kwargs)
+    else:
+      output = self.serialize_dynamic(values, kwargs)
 
     bundle = kwargs.get('bundle', None)
     if bundle is not None:
@@ -240,14 +602,70 @@ class MongoModel(object, metaclass=MongoModelMeta):
 
     return output
 
+  def serialize_dynamic(self, values, kwargs):
+    output = {}
+    for field_name in self.serialized_field_names(**kwargs):
+      field = self.fields[field_name]
+      output[field_name] = field.serialize(values[field.index], **kwargs)
+
+    return output
+
   def json(self, **kwargs):
-    kwargs.setdefault('bundle', {})
+    if kwargs.get('bundle', None) is None:
+      return ''.join(self.iter_json(**kwargs))
+
     kwargs.setdefault('include_id', True)
     self.serialize(**kwargs)
     return json.dumps(kwargs.get('bundle'))
 
+  def iter_bundle(self, **kwargs):
+    # every object reachable from this one through serialized fields, once each, grouped by model name
+    groups = OrderedDict()
+    seen = set()
+    stack = [self]
+
+    while stack:
+      obj = stack.pop()
+      key = (obj.__class__, obj.id)
+      if key in seen:
+        continue
+
+      seen.add(key)
+      groups.setdefault(obj.__class__.__name__, []).append(obj)
+      stack.extend(obj.iter_references(field_names=obj.serialized_field_names(**kwargs)))
+
+    return groups
+
+  def iter_json(self, chunk_size=65536, **kwargs):
+    # Yields the same {"Vertex": {id: {...}}, ...} bundle as json(), roughly chunk_size characters at a
+    # time; only one object is serialized at once, and nothing is saved along the way.
+    kwargs.pop('bundle', None)
+    kwargs.setdefault('include_id', True)
+    kwargs.setdefault('cascade', False)
+
+    pieces = ['{']
+    size = 1
+
+    for group_index, (model_name, objs) in enumerate(self.iter_bundle(**kwargs).items()):
+      pieces.append('{}{}: {{'.format(', ' if group_index else '', json.dumps(model_name)))
+
+      for obj_index, obj in enumerate(objs):
+        piece = '{}{}: {}'.format(', ' if obj_index else '', json.dumps(obj.id), json.dumps(obj.serialize(**kwargs)))
+        pieces.append(piece)
+        size += len(piece)
+
+        if size >= chunk_size:
+          yield ''.join(pieces)
+          pieces = []
+          size = 0
+
+      pieces.append('}')
+
+    pieces.append('}')
+    yield ''.join(pieces)
+
   @classmethod
-  def deserialize(cls, data, ignore_not_found=False):
+  def deserialize(cls, data, ignore_not_found=False, lazy=None):
     if not isinstance(data, dict):
       raise ValueError("Data ({}) for model {} must be a dict, not a {}".format(data, cls, type(data)))
 
@@ -263,10 +681,11 @@ class MongoModel(object, metaclass=MongoModelMeta):
           errors[key] = "{} is not a field on this model.".format(key)
           continue
         else:
-          cls.fields[key] = RawField()
+          cls.add_field(key, RawField())
+          cls.compile_methods()
 
       try:
-        deserialized_data[key] = cls.fields[key].deserialize(value, ignore_not_found=ignore_not_found)
+        deserialized_data[key] = cls.fields[key].deserialize(value, ignore_not_found=ignore_not_found, lazy=lazy)
       except ValueError as e:
         errors[key] = e.args[0]
 
@@ -280,38 +699,256 @@ class MongoModel(object, metaclass=MongoModelMeta):
     return obj
 
   @classmethod
-  def find(cls, query={}, ignore_not_found=False):
-    if not MONGO_CLIENT:
-      raise ValueError("Must be connected to Mongo.")
+  def find(cls, query={}, ignore_not_found=False, lazy=None, projection=None, sort=None, limit=0, skip=0, batch_size=0):
+    # Returns a ModelCursor, which fetches documents batch_size at a time and deserializes them a batch at a time
+    # as it is iterated. With a projection that leaves out fields, the objects are partial: see validate().
+    cursor = cls.read_collection().find(query, projection=projection, sort=sort, limit=limit, skip=skip, batch_size=batch_size)
+
+    return ModelCursor(cls, cursor, ignore_not_found=ignore_not_found, lazy=lazy, projection=cls.projection_mask(projection),
+                       batch_size=batch_size)
+
+  @classmethod
+  def projection_mask(cls, projection):
+    # the fields a find() projection loads in full, as a mask of MongoField.mask; None if that's all of them
+    if projection is None:
+      return None
 
-    docs = MONGO_CLIENT[MONGO_DATABASE][cls.COLLECTION].find(query)
+    if not isinstance(projection, dict):
+      projection = dict((name, 1) for name in projection)
 
-    return [cls.get_or_make_ref(cls, id=doc['_id'], data=doc, ignore_not_found=ignore_not_found) for doc in docs]
+    included = [name for name, value in projection.items() if value == 1]
+    if included:
+      names = included
+    else:
+      names = [name for name in cls.fields if name not in projection]  # everything except the excluded
+
+    mask = 0
+    for name in names:
+      if name in cls.fields:
+        mask |= cls.fields[name].mask
+
+    if mask == (1 << len(cls.field_list)) - 1:
+      return None
+
+    return mask
+
+  @classmethod
+  @counted
+  def find_one(cls, query, ignore_not_found=False, lazy=None):
+    doc = cls.read_collection().find_one(query)
+    if doc is None:
+      if ignore_not_found:
+        return None
+      else:
+        raise ObjectNotFound("No {} was found with query {}.".format(cls, query))
+
+    return cls.get_or_make_ref(cls, id=doc['_id'], data=doc, ignore_not_found=ignore_not_found, lazy=lazy)
 
   @classmethod
-  def find_one(cls, query, ignore_not_found=False):
-    if not MONGO_CLIENT:
-      raise ValueError("Must be connected to Mongo.")
+  def get_by_id(cls, object_id, ignore_not_found=False, lazy=None):
+    if isinstance(object_id, str):
+      object_id = ObjectId(object_id)
 
-    doc = MONGO_CLIENT[MONGO_DATABASE][cls.COLLECTION].find_one(query)
+    return cls.find_one({'_id': object_id}, ignore_not_found=ignore_not_found, lazy=lazy)
+
+  @classmethod
+  def reference_ids(cls, data, eager_only=False):
+    # yields (model class, id) for every reference in a raw document of this model;
+    # with eager_only, references through lazy fields are skipped
+    for field_name, field in cls.fields.items():
+      value = data.get(field_name)
+      if value is None:
+        continue
+
+      if isinstance(field, ModelField):
+        if not (eager_only and field.lazy):
+          yield field.model_class, value
+      elif isinstance(field, ListField) and isinstance(field.field_class, ModelField):
+        if not (eager_only and field.field_class.lazy):
+          for item in value:
+            yield field.field_class.model_class, item
+
+  @classmethod
+  @counted
+  def load_tree(cls, root_id, depth=None, ignore_not_found=False):
+    # Fetches the object and everything reachable from it, one reference level at a time, with a single
+    # $in query per model class per level; the query count depends on nesting depth, not on graph size.
+    # References further than depth levels away are left as ModelRefs.
+    if isinstance(root_id, str):
+      root_id = ObjectId(root_id)
+
+    docs = []
+    seen = set([(cls, str(root_id))])
+    frontier = {cls: [root_id]}
+    level = 0
+
+    while frontier and (depth is None or level <= depth):
+      level_docs = [(model_class, model_class.read_collection().find({'_id': {'$in': ids}}))
+                    for model_class, ids in frontier.items()]
+      frontier = cls.expand_tree(level_docs, docs, seen)
+      level += 1
+
+    return cls.hydrate_tree(root_id, docs, ignore_not_found)
+
+  @classmethod
+  def expand_tree(cls, level_docs, docs, seen):
+    # records one level of load_tree's documents and returns the ids to fetch for the next level
+    next_frontier = {}
+
+    for model_class, model_docs in level_docs:
+      for doc in model_docs:
+        docs.append((model_class, doc))
+
+        for ref_class, ref_id in model_class.reference_ids(doc):
+          key = (ref_class, str(ref_id))
+          if key not in seen:
+            seen.add(key)
+            next_frontier.setdefault(ref_class, []).append(ObjectId(ref_id) if isinstance(ref_id, str) else ref_id)
+
+    return next_frontier
+
+  @classmethod
+  def hydrate_tree(cls, root_id, docs, ignore_not_found):
+    # hydrate deepest objects first so that most references bind straight to loaded objects;
+    # the rest are ModelRefs that resolve from the identity map without another query
+    for model_class, doc in reversed(docs):
+      model_class.get_or_make_ref(model_class, doc['_id'], data=doc, lazy=True)
+
+    root = cls.identity_map.get(cls, str(root_id))
+    if root is None and not ignore_not_found:
+      raise ObjectNotFound("No {} was found with id {}.".format(cls, root_id))
+
+    return root
+
+  # ## Asyncio API
+  # Counterparts of find, find_one, get_by_id, save and delete for code running on an event loop, going
+  # through the connection's async client. The non-lazy references of everything fetched are loaded along with it, one $in
+  # query per model class, all awaited together. Lazy and further references are ModelRefs that must
+  # be loaded with aresolve() (or aload_tree), since touching them would block the loop.
+  @classmethod
+  def async_collection(cls, database=None):
+    return cls.connection().async_collection(cls.COLLECTION, database or cls.DATABASE)
+
+  @classmethod
+  def async_read_collection(cls):
+    read_preference = current_read_preference.get() or cls.READ_PREFERENCE
+    return cls.connection().async_collection(cls.COLLECTION, cls.DATABASE, read_preference=read_preference)
+
+  @classmethod
+  @counted
+  async def afind(cls, query={}, ignore_not_found=False):
+    docs = await cls.async_read_collection().find(query).to_list(None)
+    return await cls.ahydrate(docs, ignore_not_found=ignore_not_found)
+
+  @classmethod
+  @counted
+  async def afind_one(cls, query, ignore_not_found=False):
+    doc = await cls.async_read_collection().find_one(query)
     if doc is None:
       if ignore_not_found:
         return None
       else:
         raise ObjectNotFound("No {} was found with query {}.".format(cls, query))
 
-    return cls.get_or_make_ref(cls, id=doc['_id'], data=doc, ignore_not_found=ignore_not_found)
+    objs = await cls.ahydrate([doc], ignore_not_found=ignore_not_found)
+    return objs[0]
 
   @classmethod
-  def get_by_id(cls, object_id, ignore_not_found=False):
+  async def aget_by_id(cls, object_id, ignore_not_found=False):
     if isinstance(object_id, str):
       object_id = ObjectId(object_id)
 
-    return cls.find_one({'_id': object_id}, ignore_not_found=ignore_not_found)
+    return await cls.afind_one({'_id': object_id}, ignore_not_found=ignore_not_found)
+
+  @classmethod
+  async def ahydrate(cls, docs, ignore_not_found=False):
+    ref_ids = OrderedDict()
+    for doc in docs:
+      for ref_class, ref_id in cls.reference_ids(doc, eager_only=True):
+        ref_ids.setdefault(ref_class, []).append(ref_id)
+
+    await asyncio.gather(*[cls.aget_or_make_refs(ref_class, ids, ignore_not_found=ignore_not_found)
+                           for ref_class, ids in ref_ids.items()])
+
+    # the references are loaded now, so lazy deserializing binds them from the identity map
+    return [cls.get_or_make_ref(cls, doc['_id'], data=doc, lazy=True) for doc in docs]
+
+  @classmethod
+  async def aget_or_make_refs(cls, model_class, ids, ignore_not_found=False):
+    # get_or_make_refs for an event loop; the $in chunks are all in flight at once, and the objects
+    # come back with their own references as ModelRefs
+    refs, missing = cls.cached_refs(model_class, ids)
+
+    chunks = [missing[start:start + cls.REF_BATCH_SIZE] for start in range(0, len(missing), cls.REF_BATCH_SIZE)]
+    with operation(model_class, 'find'):
+      results = await asyncio.gather(*[model_class.async_read_collection().find({'_id': {'$in': chunk}}).to_list(None) for chunk in chunks])
+
+    for docs in results:
+      for doc in docs:
+        obj = cls.get_or_make_ref(model_class, doc['_id'], data=doc, lazy=True)
+        refs[obj.id] = obj
+
+    return cls.aligned_refs(model_class, ids, refs, ignore_not_found)
+
+  @classmethod
+  @counted
+  async def aload_tree(cls, root_id, depth=None, ignore_not_found=False):
+    # load_tree for an event loop; the queries of each level, one per model class, run concurrently
+    if isinstance(root_id, str):
+      root_id = ObjectId(root_id)
+
+    docs = []
+    seen = set([(cls, str(root_id))])
+    frontier = {cls: [root_id]}
+    level = 0
+
+    while frontier and (depth is None or level <= depth):
+      model_classes = list(frontier)
+      results = await asyncio.gather(*[model_class.async_read_collection().find({'_id': {'$in': frontier[model_class]}}).to_list(None)
+                                       for model_class in model_classes])
+      frontier = cls.expand_tree(zip(model_classes, results), docs, seen)
+      level += 1
+
+    return cls.hydrate_tree(root_id, docs, ignore_not_found)
+
+  @counted
+  async def asave(self):
+    session = current_session.get()
+    if session is not None and not session.flushing:
+      errors = self.validate()
+      if errors:
+        raise ValueError("Data error(s): {}".format(errors))
+
+      session.add(self)
+      return
+
+    # saved like a one-object Session: together with the new or changed objects it references,
+    # with one bulk_write per collection and all collections written concurrently
+    batch = Session()
+    batch.add(self)
+    await batch.acommit()
+
+  @counted
+  async def adelete(self):
+    session = current_session.get()
+    if session is not None and not session.flushing:
+      session.delete(self)
+      return None
+
+    result = await self.async_collection(self.DATABASE).delete_one({'_id': self._id})
+    for model_class, related_operation in self.related_updates(deleted=True):
+      await model_class.async_collection(model_class.DATABASE).bulk_write([related_operation])
+    self.identity_map.discard(self.__class__, self.id)
+    record_change(self, deleted=True)
+    return result
 
 
 class MongoField:
   config = None
+  owner = None
+  name = None
+  index = None
+  mask = 0
 
   def __init__(self, **kwargs):
     kwargs.setdefault('default', None)
@@ -321,14 +958,26 @@ class MongoField:
     for key, value in kwargs.items():
       setattr(self, key, value)
 
-    self.value = self.config['default']
-    self.dirty = False
+  # A field is a descriptor shared by every instance of its model; the value itself lives at
+  # position `index` of the instance's _values record, and `mask` is its bit in _dirty.
+  def bind(self, owner, name, index):
+    self.owner = owner
+    self.name = name
+    self.index = index
+    self.mask = 1 << index
 
-  def __setattr__(self, name, new_value):
-    if name == "value":
-      self.dirty = True
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+
+    try:
+      return instance._values[self.index]
+    except IndexError:
+      return self.default_value()
 
-    super().__setattr__(name, new_value)
+  def __set__(self, instance, new_value):
+    instance.value_list()[self.index] = new_value
+    instance._dirty |= self.mask
 
   def copy(self):
     return self.__class__(**self.config.copy())
@@ -340,41 +989,55 @@ class MongoField:
     self.config[key] = new_value
     setattr(self, key, new_value)
 
-  def set(self, new_value):
-    self.value = self.clean(new_value)
-    self.validate()
+  def default_value(self):
+    # mutable defaults are copied so instances never share them
+    return copy(self.default) if isinstance(self.default, (list, dict)) else self.default
 
-  def validate(self):
-    if not self.nullable and self.value is None:
+  def validate(self, value):
+    if not self.nullable and value is None:
       raise ValueError("This instance of {} cannot be None.".format(type(self)))
 
+    return value
+
+  # The *_source methods return Python source equivalent to validate() and serialize(), which
+  # compile_validate and friends splice into each model's generated methods. validate_source lines
+  # work on a local named `value`; constants go into ns under the given prefix.
+  def validate_source(self, ns, prefix):
+    if self.nullable:
+      return []
+
+    ns[prefix + 'type'] = type(self)
+    return [
+      'if value is None:',
+      '  raise ValueError("This instance of {} cannot be None.".format(' + prefix + 'type))',
+    ]
+
+  def serialize_source(self, expr, ns, prefix):
+    return expr
+
   @classmethod
   def clean(cls, new_value):
     return new_value
 
-  def is_dirty(self):
-    return self.dirty
-
-  def mark_clean(self):
-    self.dirty = False
+  def is_dirty(self, value, dirty):
+    return dirty
 
-  def serialize(self, **kwargs):
-    return self.value
+  def serialize(self, value, **kwargs):
+    return value
 
-  def deserialize(self, data, ignore_not_found=False):
-    self.dirty = False
+  def deserialize(self, data, ignore_not_found=False, lazy=None):
     return data
-    # ret = cls(default=cls.clean(data))
-    # ret.validate()
-    # return ret
 
 
 class RawField(MongoField):
-  def validate(self):
-    pass
+  def validate(self, value):
+    return value
 
-  def serialize(self, **kwargs):
-    return self.value
+  def validate_source(self, ns, prefix):
+    return []
+
+  def serialize(self, value, **kwargs):
+    return value
 
 
 # ## Specialized fields
@@ -384,20 +1047,44 @@ class IntegerField(MongoField):
     kwargs.setdefault('max_value', None)
     super().__init__(**kwargs)
 
-  def validate(self):
-    super().validate()
+  def validate(self, value):
+    value = super().validate(value)
 
-    if self.value is None:
-      return
+    if value is None:
+      return value
+
+    if not isinstance(value, int):
+      raise ValueError("Value must be {}, not {}.".format(int, type(value)))
+
+    if self.min_value and value < self.min_value:
+      raise ValueError("Minimum value is {}; actual value is {}.".format(self.min_value, value))
+
+    if self.max_value and value > self.max_value:
+      raise ValueError("Maximum value is {}; actual value is {}.".format(self.max_value, value))
 
-    if not isinstance(self.value, int):
-      raise ValueError("Value must be {}, not {}.".format(int, type(self.value)))
+    return value
 
-    if self.min_value and self.value < self.min_value:
-      raise ValueError("Minimum value is {}; actual value is {}.".format(self.min_value, self.value))
+  def validate_source(self, ns, prefix):
+    return super().validate_source(ns, prefix) + [
+      'if value is not None:',
+      '  if not isinstance(value, int):',
+      '    raise ValueError("Value must be {}, not {}.".format(int, type(value)))',
+    ] + bounds_source(self, ns, prefix)
 
-    if self.max_value and self.value > self.max_value:
-      raise ValueError("Maximum value is {}; actual value is {}.".format(self.max_value, self.value))
+
+class VersionField(IntegerField):
+  # Makes saves conditional: see MongoModel.update_operations. The stored version only ever changes with $inc;
+  # assigning one instead sets the version a save expects to find, e.g. the one a client last saw.
+  WRITER = '_writer'  # where sessions note who wrote a version last; underscored, so it's never loaded
+
+  def __init__(self, **kwargs):
+    kwargs.setdefault('default', 0)
+    super().__init__(**kwargs)
+
+  @staticmethod
+  def expected(version):
+    # documents written before the model had a version field count as version 0
+    return version if version else {'$in': [0, None]}
 
 
 class FloatField(MongoField):
@@ -407,42 +1094,68 @@ class FloatField(MongoField):
     kwargs.setdefault('step', None)
     super().__init__(**kwargs)
 
-  def validate(self):
-    super().validate()
+  def validate(self, value):
+    value = super().validate(value)
 
-    if self.value is None:
-      return
+    if value is None:
+      return value
 
-    if not isinstance(self.value, float):
-      if isinstance(self.value, int):
-        self.value = float(self.value)
+    if not isinstance(value, float):
+      if isinstance(value, int):
+        value = float(value)
       else:
-        raise ValueError("Value {} must be {}, not {}.".format(self.value, float, type(self.value)))
+        raise ValueError("Value {} must be {}, not {}.".format(value, float, type(value)))
 
-    if self.min_value and self.value < self.min_value:
-      raise ValueError("Minimum value is {}; actual value is {}.".format(self.min_value, self.value))
+    if self.min_value and value < self.min_value:
+      raise ValueError("Minimum value is {}; actual value is {}.".format(self.min_value, value))
 
-    if self.max_value and self.value > self.max_value:
-      raise ValueError("Maximum value is {}; actual value is {}.".format(self.max_value, self.value))
+    if self.max_value and value > self.max_value:
+      raise ValueError("Maximum value is {}; actual value is {}.".format(self.max_value, value))
 
     # TODO: should I really always "round" the value?
     # TODO: handles negative values wrong
     if self.step:
-      self.value = self.value - ((self.value + self.step / 2) % self.step) + self.step / 2
+      value = value - ((value + self.step / 2) % self.step) + self.step / 2
+
+    return value
+
+  def validate_source(self, ns, prefix):
+    lines = super().validate_source(ns, prefix) + [
+      'if value is not None:',
+      '  if not isinstance(value, float):',
+      '    if isinstance(value, int):',
+      '      value = float(value)',
+      '    else:',
+      '      raise ValueError("Value {} must be {}, not {}.".format(value, float, type(value)))',
+    ] + bounds_source(self, ns, prefix)
+
+    if self.step:
+      ns[prefix + 'step'] = self.step
+      lines.append('  value = value - ((value + {0}step / 2) % {0}step) + {0}step / 2'.format(prefix))
+
+    return lines
 
 
 class BooleanField(MongoField):
   def __init__(self, **kwargs):
     super().__init__(**kwargs)
 
-  def validate(self):
-    super().validate()
+  def validate(self, value):
+    value = super().validate(value)
 
-    if self.value is None:
-      return
+    if value is None:
+      return value
+
+    if not isinstance(value, bool):
+      raise ValueError("Value must be {}, not {}.".format(bytes, type(value)))
 
-    if not isinstance(self.value, bool):
-      raise ValueError("Value must be {}, not {}.".format(bytes, type(self.value)))
+    return value
+
+  def validate_source(self, ns, prefix):
+    return super().validate_source(ns, prefix) + [
+      'if value is not None and not isinstance(value, bool):',
+      '  raise ValueError("Value must be {}, not {}.".format(bytes, type(value)))',
+    ]
 
 
 class StringField(MongoField):
@@ -450,17 +1163,26 @@ class StringField(MongoField):
     kwargs.setdefault('max_length', 0)
     super().__init__(**kwargs)
 
-  def validate(self):
-    super().validate()
+  def validate(self, value):
+    value = super().validate(value)
 
-    if self.value is None:
-      return
+    if value is None:
+      return value
+
+    if not isinstance(value, str):
+      raise ValueError("Value must be {}, not {}.".format(str, type(value)))
+
+    if self.max_length and len(value) > self.max_length:
+      raise ValueError("Maximum length is {}; actual length is {}.".format(self.max_length, len(value)))
 
-    if not isinstance(self.value, str):
-      raise ValueError("Value must be {}, not {}.".format(str, type(self.value)))
+    return value
 
-    if self.max_length and len(self.value) > self.max_length:
-      raise ValueError("Maximum length is {}; actual length is {}.".format(self.max_length, len(self.value)))
+  def validate_source(self, ns, prefix):
+    return super().validate_source(ns, prefix) + [
+      'if value is not None:',
+      '  if not isinstance(value, str):',
+      '    raise ValueError("Value must be {}, not {}.".format(str, type(value)))',
+    ] + max_length_source(self, ns, prefix)
 
 
 class BinaryField(MongoField):
@@ -468,17 +1190,26 @@ class BinaryField(MongoField):
     kwargs.setdefault('max_length', 0)
     super().__init__(**kwargs)
 
-  def validate(self):
-    super().validate()
+  def validate(self, value):
+    value = super().validate(value)
 
-    if self.value is None:
-      return
+    if value is None:
+      return value
+
+    if not isinstance(value, bytes):
+      raise ValueError("Value must be {}, not {}.".format(bytes, type(value)))
+
+    if self.max_length and len(value) > self.max_length:
+      raise ValueError("Maximum length is {}; actual length is {}.".format(self.max_length, len(value)))
 
-    if not isinstance(self.value, bytes):
-      raise ValueError("Value must be {}, not {}.".format(bytes, type(self.value)))
+    return value
 
-    if self.max_length and len(self.value) > self.max_length:
-      raise ValueError("Maximum length is {}; actual length is {}.".format(self.max_length, len(self.value)))
+  def validate_source(self, ns, prefix):
+    return super().validate_source(ns, prefix) + [
+      'if value is not None:',
+      '  if not isinstance(value, bytes):',
+      '    raise ValueError("Value must be {}, not {}.".format(bytes, type(value)))',
+    ] + max_length_source(self, ns, prefix)
 
 
 class ListField(MongoField):
@@ -491,76 +1222,168 @@ class ListField(MongoField):
     kwargs.setdefault('default', [])
     super().__init__(**kwargs)
 
-  def __getitem__(self, index):
-    return self.value[index]
-
-  def __setitem__(self, index, new_value):
-    self.value[index] = new_value
-    self.dirty = True
+  def validate(self, value):
+    value = super().validate(value)
 
-  def __add__(self, *args, **kwargs):
-    self.dirty = True
-    super().__add__(*args, **kwargs)
+    if value is None:
+      return value
 
-  def __delitem__(self, *args, **kwargs):
-    self.dirty = True
-    super().__delitem__(*args, **kwargs)
+    if self.max_length and len(value) > self.max_length:
+      raise ValueError("Maximum length is {}; actual length is {}.".format(self.max_length, len(value)))
 
-  def validate(self):
-    super().validate()
+    errors = []
 
-    if self.value is None:
-      return
+    if isinstance(self.field_class, ModelField):
+      model_class = self.field_class.model_class
 
-    if self.max_length and len(self.value) > self.max_length:
-      raise ValueError("Maximum length is {}; actual length is {}.".format(self.max_length, len(self.value)))
+      for idx, val in enumerate(raw_items(value)):
+        if isinstance(val, ModelRef):
+          if not issubclass(val.model_class, model_class):
+            errors.append((idx, type(val), val))
+        elif not isinstance(val, model_class):
+          errors.append((idx, type(val), val))
 
-    errors = []
-
-    for idx, val in enumerate(self.value):
-      if not isinstance(val, self.field_class.model_class if isinstance(self.field_class, ModelField) else self.field_class):
-        errors.append((idx, type(val), val))
+    else:
+      for idx, val in enumerate(value):
+        try:
+          self.field_class.validate(val)
+        except ValueError:
+          errors.append((idx, type(val), val))
 
     if errors:
       raise ValueError("Not all elements were {}; bad elements: {}".format(self.field_class, errors))
 
-  def is_dirty(self):
-    if self.dirty is True:
-      if isinstance(self.field_class, ModelField):
-        return dict([(index, element.id) for index, element in enumerate(self.value) if element is not None])
-      else:
-        return True
+    return value
 
-    dirty_fields = {}
+  def validate_source(self, ns, prefix):
+    ns[prefix + 'field'] = self
+    lines = super().validate_source(ns, prefix) + ['if value is not None:'] + max_length_source(self, ns, prefix)
 
-    for index, element in enumerate(self.value):
-      dirty = element.is_dirty()
+    if isinstance(self.field_class, ModelField):
+      ns['raw_items'] = raw_items
+      lines += [
+        '  model_class = {}field.field_class.model_class'.format(prefix),
+        '  bad = [(idx, type(val), val) for idx, val in enumerate(raw_items(value))',
+        '            if not (issubclass(val.model_class, model_class) if isinstance(val, ModelRef) else isinstance(val, model_class))]',
+      ]
+    else:
+      lines += [
+        '  bad = []',
+        '  for idx, val in enumerate(value):',
+        '    try:',
+        '      {}field.field_class.validate(val)'.format(prefix),
+        '    except ValueError:',
+        '      bad.append((idx, type(val), val))',
+      ]
+
+    return lines + [
+      '  if bad:',
+      '    raise ValueError("Not all elements were {}; bad elements: {}".format(' + prefix + 'field.field_class, bad))',
+    ]
+
+  def default_value(self):
+    return TrackedList(self.default) if isinstance(self.default, list) else self.default
+
+  def __set__(self, instance, new_value):
+    if new_value is instance.value_list()[self.index]:
+      return  # e.g. `obj.items += [item]`, which the TrackedList has already recorded
+
+    if type(new_value) is list:
+      new_value = TrackedList(new_value)
+
+    super().__set__(instance, new_value)
+
+  def is_dirty(self, value, dirty):
+    # an assigned list is saved whole; one changed in place returns its recorded operations
+    if dirty or not isinstance(value, TrackedList):
+      return dirty
+
+    if value.ops is None:
+      return True
+
+    return value.ops
+
+  def delta(self, value, ops, **kwargs):
+    # Turns TrackedList operations into a ListDelta of $push, $pop, $pull and positional $set updates,
+    # merging runs of the same kind; None when rewriting the list would be as cheap, or the only way.
+    updates = []
+    length = len(value) - sum(1 if op[0] == 'insert' else -1 if op[0] == 'delete' else 0 for op in ops)
+
+    if len(ops) >= len(value):
+      return None
+
+    for op in ops:
+      kind, index, item = op[:3]
+      last_operator, last_argument = updates[-1] if updates else (None, None)
+
+      if kind == 'insert':
+        push = last_argument[self.name] if last_operator == '$push' else None
+        element = self.field_class.serialize(item, **kwargs)
+
+        if push is not None and index == push.get('$position', length - len(push['$each'])) + len(push['$each']):
+          push['$each'].append(element)
+        elif index == length:
+          updates.append(('$push', {self.name: {'$each': [element]}}))
+        else:
+          updates.append(('$push', {self.name: {'$each': [element], '$position': index}}))
+
+        length += 1
+
+      elif kind == 'delete':
+        if index == length - 1:
+          updates.append(('$pop', {self.name: 1}))
+        elif index == 0:
+          updates.append(('$pop', {self.name: -1}))
+        elif op[3]:  # the only copy of item in the list, so pulling it by value removes just this one
+          element = self.field_class.serialize(item, **dict(kwargs, cascade=False))
+
+          if last_operator == '$pull':
+            last_argument[self.name]['$in'].append(element)
+          else:
+            updates.append(('$pull', {self.name: {'$in': [element]}}))
+        else:
+          return None
 
-      if dirty:
-        if dirty is True:
-          dirty_fields[str(index)] = element.value
-        elif isinstance(self.field_class, ModelField):
-          dirty_fields[str(index)] = element.id
+        length -= 1
 
-    return dirty_fields
+      else:
+        path = '{}.{}'.format(self.name, index)
+        element = self.field_class.serialize(item, **kwargs)
 
-  def mark_clean(self):
-    for index, element in enumerate(self.value):
-      if element is not None:
-        element.mark_clean()
+        if last_operator == '$set':
+          last_argument[path] = element
+        else:
+          updates.append(('$set', {path: element}))
 
-  def serialize(self, **kwargs):
+    return ListDelta(updates)
+
+  def serialize(self, value, **kwargs):
     if isinstance(self.field_class, ModelField):
+      if kwargs.get('bundle', None) is not None and isinstance(value, ModelRefList):
+        value.resolve()  # the bundle needs every item, so load them in one batch
+
+      if kwargs.get('bundle', None) is None and not kwargs.get('cascade', True):
+        return [item.id for item in raw_items(value) if item is not None and item.id is not None]
+
       kwargs['include_id'] = True
-      return list(filter(lambda x: x is not None, [item.serialize(**kwargs)['id'] for item in self.value if item is not None]))
+      return list(filter(lambda x: x is not None, [item.serialize(**kwargs)['id'] for item in raw_items(value) if item is not None]))
     else:
-      return [item.serialize(**kwargs) for item in self.value]
+      return [self.field_class.serialize(item, **kwargs) for item in value]
 
-  def deserialize(self, data, ignore_not_found=False):
+  def deserialize(self, data, ignore_not_found=False, lazy=None):
     if isinstance(self.field_class, ModelField):
-      return list(filter(lambda x: x is not None, [self.field_class.model_class.get_or_make_ref(self.field_class.model_class, item, ignore_not_found=ignore_not_found) for item in data]))
+      model_class = self.field_class.model_class
+
+      if self.field_class.lazy if lazy is None else lazy:
+        return ModelRefList(model_class, [MongoModel.get_lazy_ref(model_class, item, ignore_not_found=ignore_not_found) for item in data], ignore_not_found=ignore_not_found)
+
+      objs = TrackedList(obj for obj in model_class.get_or_make_refs(model_class, data, ignore_not_found=ignore_not_found) if obj is not None)
+      if len(objs) < len(data):
+        objs.rewrite()  # missing objects were left out, so the stored list no longer lines up
+
+      return objs
     else:
-      return [self.field_class(item) for item in data]
+      return TrackedList(self.field_class.deserialize(item, ignore_not_found=ignore_not_found, lazy=lazy) for item in data)
 
 
 class EnumField(MongoField):
@@ -568,14 +1391,23 @@ class EnumField(MongoField):
     kwargs.setdefault('allowed', allowed)
     super().__init__(**kwargs)
 
-  def validate(self):
-    super().validate()
+  def validate(self, value):
+    value = super().validate(value)
 
-    if self.value is None:
-      return
+    if value is None:
+      return value
+
+    if value not in self.allowed:
+      raise ValueError("Value is {} but it must be one of {}.".format(value, self.allowed))
 
-    if self.value not in self.allowed:
-      raise ValueError("Value is {} but it must be one of {}.".format(self.value, self.allowed))
+    return value
+
+  def validate_source(self, ns, prefix):
+    ns[prefix + 'allowed'] = self.allowed
+    return super().validate_source(ns, prefix) + [
+      'if value is not None and value not in {}allowed:'.format(prefix),
+      '  raise ValueError("Value is {} but it must be one of {}.".format(value, ' + prefix + 'allowed))',
+    ]
 
 
 class DictField(MongoField):
@@ -583,31 +1415,61 @@ class DictField(MongoField):
     kwargs.setdefault('default', {})
     super().__init__(**kwargs)
 
-  def validate(self):
-    super().validate()
+  def validate(self, value):
+    value = super().validate(value)
 
-    if self.value is None:
-      return
+    if value is None:
+      return value
+
+    if not isinstance(value, dict):
+      raise ValueError("Value {} is a {} but must be a {}.".format(value, type(value), type(dict)))
 
-    if not isinstance(self.value, dict):
-      raise ValueError("Value {} is a {} but must be a {}.".format(self.value, type(self.value), type(dict)))
+    return value
+
+  def validate_source(self, ns, prefix):
+    return super().validate_source(ns, prefix) + [
+      'if value is not None and not isinstance(value, dict):',
+      '  raise ValueError("Value {} is a {} but must be a {}.".format(value, type(value), type(dict)))',
+    ]
 
 
 class ModelField(MongoField):
   def __init__(self, model_class, **kwargs):
+    kwargs.setdefault('model_class', model_class)
+    kwargs.setdefault('lazy', False)
+    super().__init__(**kwargs)
+
     if isinstance(model_class, str):
       MongoModel.add_model_dependency(model_class, self)
-    else:
-      kwargs.setdefault('model_class', model_class)
 
-    super().__init__(**kwargs)
+  def validate(self, value):
+    value = super().validate(value)
 
-  def serialize(self, **kwargs):
-    self.value.save()
-    self.value.serialize(**kwargs)
-    return self.value.id
+    if isinstance(value, ModelRef) and not issubclass(value.model_class, self.model_class):
+      raise ValueError("Reference must be to {}, not {}.".format(self.model_class, value.model_class))
+
+    return value
+
+  def validate_source(self, ns, prefix):
+    ns[prefix + 'field'] = self  # model_class may only be filled in once the referenced model is defined
+    return super().validate_source(ns, prefix) + [
+      'if isinstance(value, ModelRef) and not issubclass(value.model_class, {}field.model_class):'.format(prefix),
+      '  raise ValueError("Reference must be to {}, not {}.".format(' + prefix + 'field.model_class, value.model_class))',
+    ]
+
+  def serialize(self, value, **kwargs):
+    if kwargs.get('cascade', True):
+      value.save()
+
+    if kwargs.get('cascade', True) or kwargs.get('bundle', None) is not None:
+      value.serialize(**kwargs)
+
+    return value.id
+
+  def deserialize(self, data, ignore_not_found=False, lazy=None):
+    if self.lazy if lazy is None else lazy:
+      return MongoModel.get_lazy_ref(self.model_class, data, ignore_not_found=ignore_not_found)
 
-  def deserialize(self, data, ignore_not_found=False):
     return MongoModel.get_or_make_ref(self.model_class, data, ignore_not_found=ignore_not_found)
 
 
@@ -616,42 +1478,529 @@ class NestedField(MongoField):
     kwargs.setdefault('fields', fields)
     super().__init__(**kwargs)
 
-    self._fields = {}
-    for name, field in self.config['fields'].items():
-      self._fields[name] = field.copy()
+  def default_value(self):
+    return {name: field.default_value() for name, field in self.fields.items()}
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+
+    return dict(super().__get__(instance, owner))  # a copy, so only assignment changes the stored value
+
+  def __set__(self, instance, new_value):
+    # assigning a partial dict only updates the named inner fields
+    value = super().__get__(instance, type(instance))
+
+    if new_value is not None:
+      value = dict(value)
+      for key, val in new_value.items():
+        self.fields[key]  # unknown keys are an error
+        value[key] = val
+
+    super().__set__(instance, value)
+
+  def serialize(self, value, **kwargs):
+    return {name: field.serialize(value[name], **kwargs) for name, field in self.fields.items()}
+
+  def serialize_source(self, expr, ns, prefix):
+    items = []
+    for name, field in self.fields.items():
+      if not has_source(field, 'serialize'):
+        return None
+
+      inner = field.serialize_source('{}[{!r}]'.format(expr, name), ns, '{}{}_'.format(prefix, name))
+      if inner is None:
+        return None
+
+      items.append('{!r}: {}'.format(name, inner))
+
+    return '{' + ', '.join(items) + '}'
+
+  def deserialize(self, data, **kwargs):
+    return {name: self.fields[name].deserialize(value, **kwargs) for name, value in data.items()}
+
+
+# ## Compiled model methods
+# MongoModelMeta generates these once per model class: every field gets its own unrolled lines,
+# so validating, serializing or diffing an instance never loops over fields or checks field types.
+def add_dirty_field(dirty_fields, field, value, dirty, kwargs):
+  if dirty is True:
+    dirty_fields[field.name] = field.serialize(value, **kwargs)
+
+  elif isinstance(dirty, list):
+    delta = field.delta(value, dirty, **kwargs)
+    dirty_fields[field.name] = delta if delta is not None else field.serialize(value, **kwargs)
+
+  else:
+    raise ValueError("Don't know what to do when dirty is {} and has value '{}'.".format(type(dirty), dirty))
+
+
+def bounds_source(field, ns, prefix):
+  lines = []
+
+  if field.min_value:
+    ns[prefix + 'min_value'] = field.min_value
+    lines += [
+      '  if value < {}min_value:'.format(prefix),
+      '    raise ValueError("Minimum value is {}; actual value is {}.".format(' + prefix + 'min_value, value))',
+    ]
+
+  if field.max_value:
+    ns[prefix + 'max_value'] = field.max_value
+    lines += [
+      '  if value > {}max_value:'.format(prefix),
+      '    raise ValueError("Maximum value is {}; actual value is {}.".format(' + prefix + 'max_value, value))',
+    ]
+
+  return lines
 
-  def __getattribute__(self, name):
-    if name == 'value':
-      return {key: self._fields[key].value for key in self._fields.keys()}
 
+def max_length_source(field, ns, prefix):
+  if not field.max_length:
+    return []
+
+  ns[prefix + 'max_length'] = field.max_length
+  return [
+    '  if len(value) > {}max_length:'.format(prefix),
+    '    raise ValueError("Maximum length is {}; actual length is {}.".format(' + prefix + 'max_length, len(value)))',
+  ]
+
+
+def defining_class(field, name):
+  for klass in type(field).__mro__:
+    if name in klass.__dict__:
+      return klass
+
+
+def has_source(field, method_name):
+  # a field subclass that overrides validate or serialize without matching source falls back to calling it
+  return defining_class(field, method_name) is defining_class(field, method_name + '_source')
+
+
+def serialize_expression(field, ns):
+  expr = 'values[{}]'.format(field.index)
+  prefix = 'f{}_'.format(field.index)
+
+  source = field.serialize_source(expr, ns, prefix) if has_source(field, 'serialize') else None
+  if source is not None:
+    return source
+
+  ns[prefix + 'serialize'] = field.serialize
+  return '{}serialize({}, **kwargs)'.format(prefix, expr)
+
+
+def build_function(cls, name, lines, ns):
+  ns.update(ValueError=ValueError, ModelRef=ModelRef)
+  code = compile('\n'.join(lines) + '\n', '<{} {}>'.format(cls.__name__, name), 'exec')
+  exec(code, ns)
+  return ns[name]
+
+
+def compile_validate(cls):
+  ns = {}
+  lines = ['def validate(self):', '  errors = {}', '  values = self.value_list()']
+
+  for field in cls.field_list:
+    prefix = 'f{}_'.format(field.index)
+
+    if has_source(field, 'validate'):
+      body = field.validate_source(ns, prefix)
+      if not body:
+        continue
     else:
-      return super().__getattribute__(name)
+      ns[prefix + 'validate'] = field.validate
+      body = ['value = {}validate(value)'.format(prefix)]
 
-  def __setattr__(self, name, new_value):
-    if name == 'value':
-      self.dirty = True
+    lines += ['  try:', '    value = values[{}]'.format(field.index)]
+    lines += ['    ' + line for line in body]
+    lines += [
+      '    values[{}] = value'.format(field.index),
+      '  except ValueError as e:',
+      '    errors[{!r}] = e.args[0]'.format(field.name),
+    ]
 
-      if new_value is None:
-        return
+  lines.append('  return errors')
+  return build_function(cls, 'validate', lines, ns)
 
-      for key, val in new_value.items():
-        self._fields[key].value = val
+
+def compile_serialize(cls, fields):
+  ns = {}
+  lines = ['def serialize(values, kwargs):', '  return {']
+
+  for field in fields:
+    lines.append('    {!r}: {},'.format(field.name, serialize_expression(field, ns)))
+
+  lines.append('  }')
+  return build_function(cls, 'serialize', lines, ns)
+
+
+def compile_changed(cls):
+  fields = [field for field in cls.field_list if not isinstance(field, RawField)]
+  ns = {'add_dirty_field': add_dirty_field}
+  lines = ['def changed(self, kwargs):', '  mask = self._dirty']
+
+  # fields that only track assignment are clean unless their bit is set
+  if all(type(field).is_dirty is MongoField.is_dirty for field in fields):
+    lines += ['  if not mask:', '    return {}']
+
+  lines += ['  values = self.value_list()', '  dirty_fields = {}']
+
+  for field in fields:
+    if type(field).is_dirty is MongoField.is_dirty:
+      lines += [
+        '  if mask & {}:'.format(field.mask),
+        '    dirty_fields[{!r}] = {}'.format(field.name, serialize_expression(field, ns)),
+      ]
 
     else:
-      super().__setattr__(name, new_value)
+      ns['field_{}'.format(field.index)] = field
+      lines += [
+        '  dirty = field_{0}.is_dirty(values[{0}], bool(mask & {1}))'.format(field.index, field.mask),
+        '  if dirty:',
+        '    add_dirty_field(dirty_fields, field_{0}, values[{0}], dirty, kwargs)'.format(field.index),
+      ]
+
+  lines.append('  return dirty_fields')
+  return build_function(cls, 'changed', lines, ns)
+
+
+# ## Tracked lists
+class TrackedList(list):
+  # The value of a ListField. It records changes made in place as ('insert', index, item),
+  # ('delete', index, item, unique) and ('set', index, item), which ListField.delta replays with
+  # $push, $pop, $pull and positional $set, so saving costs as much as the change, not the list.
+  # ops becomes None after a change that can't be replayed (slices, sort, ...); the list is then saved whole.
+  def __init__(self, items=()):
+    super().__init__(items)
+    self.ops = []
+
+  def record(self, *op):
+    if self.ops is not None:
+      self.ops.append(op)
+
+  def rewrite(self):
+    self.ops = None
+
+  def mark_clean(self):
+    self.ops = []
+
+  def position(self, index, insert=False):
+    length = list.__len__(self)
+    if index < 0:
+      index += length
+
+    if insert:
+      return min(max(index, 0), length)
+    elif not 0 <= index < length:
+      raise IndexError("list index out of range")
+
+    return index
+
+  def append(self, item):
+    self.record('insert', list.__len__(self), item)
+    list.append(self, item)
+
+  def extend(self, items):
+    for item in list(items):
+      self.append(item)
+
+  def __iadd__(self, items):
+    self.extend(items)
+    return self
+
+  def insert(self, index, item):
+    index = self.position(index, insert=True)
+    self.record('insert', index, item)
+    list.insert(self, index, item)
+
+  def delete(self, index):
+    item = list.__getitem__(self, index)
+    self.record('delete', index, item, list.count(self, item) == 1)
+    list.__delitem__(self, index)
+    return item
+
+  def remove(self, item):
+    self.delete(list.index(self, item))
+
+  def pop(self, index=-1):
+    if not list.__len__(self):
+      raise IndexError("pop from empty list")
+
+    return self.delete(self.position(index))
+
+  def __delitem__(self, index):
+    if isinstance(index, slice):
+      self.rewrite()
+      list.__delitem__(self, index)
+    else:
+      self.delete(self.position(index))
+
+  def __setitem__(self, index, item):
+    if isinstance(index, slice):
+      self.rewrite()
+      list.__setitem__(self, index, item)
+    else:
+      index = self.position(index)
+      self.record('set', index, item)
+      list.__setitem__(self, index, item)
+
+  def clear(self):
+    self.rewrite()
+    list.clear(self)
+
+  def sort(self, *args, **kwargs):
+    self.rewrite()
+    list.sort(self, *args, **kwargs)
+
+  def reverse(self):
+    self.rewrite()
+    list.reverse(self)
+
+  def __imul__(self, count):
+    self.rewrite()
+    return list.__imul__(self, count)
+
+
+class ListDelta(object):
+  # what changed() reports for a list changed in place: [(operator, {path: argument}), ...] to apply in order
+  def __init__(self, updates):
+    self.updates = updates
+
+  def __eq__(self, other):
+    return isinstance(other, ListDelta) and self.updates == other.updates
+
+  def __repr__(self):
+    return "<ListDelta {}>".format(self.updates)
+
+
+# ## Lazy references
+def raw_items(value):
+  # iterate a list field's value without resolving any ModelRefs in it
+  return list.__iter__(value)
+
+
+class ModelRef(object):
+  __slots__ = ('model_class', 'ref_id', 'ignore_not_found', 'obj')
+
+  def __init__(self, model_class, ref_id, ignore_not_found=False):
+    object.__setattr__(self, 'model_class', model_class)
+    object.__setattr__(self, 'ref_id', ref_id)
+    object.__setattr__(self, 'ignore_not_found', ignore_not_found)
+    object.__setattr__(self, 'obj', None)
+
+  @property
+  def id(self):
+    return str(self.ref_id)
+
+  @property
+  def resolved(self):
+    return self.obj is not None
+
+  def resolve(self):
+    if self.obj is None:
+      object.__setattr__(self, 'obj', MongoModel.get_or_make_ref(self.model_class, self.ref_id, ignore_not_found=self.ignore_not_found))
+
+    return self.obj
+
+  async def aresolve(self):
+    if self.obj is None:
+      objs = await MongoModel.aget_or_make_refs(self.model_class, [self.ref_id], ignore_not_found=self.ignore_not_found)
+      object.__setattr__(self, 'obj', objs[0])
+
+    return self.obj
+
+  def bind(self, obj):
+    object.__setattr__(self, 'obj', obj)
+
+  def __getattr__(self, name):
+    return getattr(self.resolve(), name)
+
+  def __setattr__(self, name, new_value):
+    setattr(self.resolve(), name, new_value)
+
+  def __eq__(self, other):
+    if isinstance(other, ModelRef):
+      return self.model_class is other.model_class and self.id == other.id
+    elif isinstance(other, MongoModel):
+      return isinstance(other, self.model_class) and self.id == other.id
+    else:
+      return NotImplemented
+
+  def __hash__(self):
+    return hash((self.model_class, self.id))
+
+  def __repr__(self):
+    return "<ModelRef {} {}{}>".format(self.model_class.__name__, self.id, "" if self.resolved else " (unresolved)")
+
+  # referencing an unloaded object never needs to load it
+  def save(self):
+    if self.resolved:
+      self.obj.save()
+
+  def changed(self):
+    return self.obj.changed() if self.resolved else {}
+
+  is_dirty = changed
+
+  def mark_clean(self):
+    if self.resolved:
+      self.obj.mark_clean()
 
   def serialize(self, **kwargs):
-    return {name: self._fields[name].serialize(**kwargs) for name in self._fields.keys()}
+    if self.resolved or kwargs.get('bundle', None) is not None:
+      return self.resolve().serialize(**kwargs)
 
-  def deserialize(self, data, **kwargs):
-    return {name: self._fields[name].deserialize(value, **kwargs) for name, value in data.items()}
+    return {'id': self.id} if kwargs.get('include_id', False) else {}
+
+
+class ModelRefList(TrackedList):
+  # a list of ModelRefs that loads all of them with get_or_make_refs on first iteration or indexing
+  def __init__(self, model_class, items, ignore_not_found=False):
+    super().__init__(items)
+    self.model_class = model_class
+    self.ignore_not_found = ignore_not_found
+    self.resolved = False
+
+  def resolve(self):
+    if self.resolved:
+      return self
+
+    pending = self.pending_refs()
+    objs = MongoModel.get_or_make_refs(self.model_class, [ref.ref_id for ref in pending], ignore_not_found=self.ignore_not_found) if pending else []
+    return self.bind(pending, objs)
+
+  async def aresolve(self):
+    if self.resolved:
+      return self
+
+    pending = self.pending_refs()
+    objs = await MongoModel.aget_or_make_refs(self.model_class, [ref.ref_id for ref in pending], ignore_not_found=self.ignore_not_found) if pending else []
+    return self.bind(pending, objs)
+
+  def pending_refs(self):
+    return [item for item in raw_items(self) if isinstance(item, ModelRef) and not item.resolved]
+
+  def bind(self, pending, objs):
+    self.resolved = True
+    for ref, obj in zip(pending, objs):
+      ref.bind(obj)
+
+    resolved_items = [item.obj if isinstance(item, ModelRef) else item for item in raw_items(self)]
+    found_items = [item for item in resolved_items if item is not None]
+    if len(found_items) < len(resolved_items):
+      self.rewrite()  # missing objects were left out, so the stored list no longer lines up
+
+    list.__setitem__(self, slice(None), found_items)
+    return self
+
+  def __iter__(self):
+    return list.__iter__(self.resolve())
+
+  def __reversed__(self):
+    return list.__reversed__(self.resolve())
+
+  def __getitem__(self, index):
+    return list.__getitem__(self.resolve(), index)
+
+  def __contains__(self, item):
+    return list.__contains__(self.resolve(), item)
+
+  def index(self, *args):
+    return list.index(self.resolve(), *args)
+
+  def count(self, item):
+    return list.count(self.resolve(), item)
+
+
+class ModelCursor(object):
+  # What MongoModel.find returns; only the current batch of documents is held in memory. Complete objects are
+  # made a batch at a time, so the references of the whole batch load together, like load_tree's levels.
+  HYDRATE_BATCH_SIZE = 101  # documents per batch without a batch_size, like mongod's first batch
+
+  def __init__(self, model_class, cursor, ignore_not_found=False, lazy=None, projection=None, batch_size=0):
+    self.model_class = model_class
+    self.cursor = cursor
+    self.ignore_not_found = ignore_not_found
+    self.lazy = lazy
+    self.projection = projection
+    self.batch_size = batch_size or self.HYDRATE_BATCH_SIZE
+    self.hydrated = deque()
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    model_class = self.model_class
+
+    if self.projection is None:
+      if not self.hydrated:
+        self.hydrated.extend(self.hydrate(self.next_docs(self.batch_size)))
+
+      return self.hydrated.popleft()
+
+    # partial objects stay out of the identity map, where they would pass for complete ones
+    doc = self.next_docs(1)[0]
+    obj = model_class.identity_map.get(model_class, str(doc['_id']))
+    if obj is None:
+      obj = model_class.deserialize(doc, ignore_not_found=self.ignore_not_found, lazy=self.lazy)
+      obj._projection = self.projection
+
+    return obj
+
+  def next_docs(self, count):
+    # up to count documents from the cursor; StopIteration if there are none left
+    docs = []
+    token = None
+    if current_metrics.get() is not None:
+      # the cursor sends its commands from here, a batch at a time, rather than from find()
+      token = current_operation.set(operation_name(self.model_class, 'find'))
+
+    try:
+      while len(docs) < count:
+        try:
+          docs.append(next(self.cursor))
+        except StopIteration:
+          break
+    finally:
+      if token is not None:
+        current_operation.reset(token)
+
+    if not docs:
+      raise StopIteration
+
+    return docs
+
+  def hydrate(self, docs):
+    # objects for docs, in order; the ones not in the identity map yet are made together by hydrate_refs
+    model_class = self.model_class
+    objs = [model_class.identity_map.get(model_class, str(doc['_id'])) for doc in docs]
+
+    missing = [doc for doc, obj in zip(docs, objs) if obj is None]
+    if missing:
+      made = iter(model_class.hydrate_refs(model_class, missing, ignore_not_found=self.ignore_not_found, lazy=self.lazy))
+      objs = [obj if obj is not None else next(made) for obj in objs]
+
+    return objs
+
+  def close(self):
+    self.cursor.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
 
 
 # ## index stuff
 class MongoIndex(object):
   def __init__(self, keys, **kwargs):
     self.keys = keys
-    self.kwargs = kwargs
+    self.kwargs = kwargs  # for create_index; the name defaults to the attribute's
+
+  def key_list(self):
+    # [(field, direction)], with plain field names ascending
+    return [(key, ASCENDING) if isinstance(key, str) else tuple(key) for key in self.keys]
 
 
 # ## Custom error classes
@@ -659,19 +2008,115 @@ class ObjectNotFound(ValueError):
   pass
 
 
+class ConflictError(ValueError):
+  # a versioned save matched nothing, because the stored version had moved on (or the object is gone)
+  def __init__(self, objects):
+    self.objects = list(objects)
+    super().__init__("Changed by someone else since it was loaded: {}.".format(
+      ', '.join('{} {}'.format(obj.__class__.__name__, obj.id) for obj in self.objects)))
+
+
 # ## Node-related models
 class Node(MongoModel):
   subgraphs = ListField(ModelField('Graph'))
   data = DictField()
 
+  # links are found through Link's multikey indexes on sources and sinks
+  def out_links(self, **kwargs):
+    return Link.find({'sources': self.id}, **kwargs)
+
+  def in_links(self, **kwargs):
+    return Link.find({'sinks': self.id}, **kwargs)
+
 
 class Link(MongoModel):
   sources = ListField(ModelField(Node))
   sinks = ListField(ModelField(Node))
   data = DictField()
 
+  sources_index = MongoIndex(['sources'])
+  sinks_index = MongoIndex(['sinks'])
+
+  def related_updates(self, deleted=False):
+    # a link that is deleted or connects other nodes changes every graph holding it, whose revisions go up with it
+    if deleted or self.fields_changed('sources', 'sinks'):
+      return [(Graph, UpdateMany({'links': self.id}, {'$inc': {'revision': 1}}))]
+
+    return []
+
 
 class Graph(MongoModel):
   links = ListField(ModelField(Link))
   nodes = ListField(ModelField(Node))
   data = DictField()
+  revision = IntegerField(default=0)  # goes up whenever links or nodes change; keys graphstore.analytics snapshots
+
+  links_index = MongoIndex(['links'])  # for finding the graphs that hold a link
+
+  def update_operations(self, cascade=True, writer=None):
+    # The revision goes up with $inc whenever links or nodes change, so saves made at the same time each count.
+    operations = super().update_operations(cascade=cascade, writer=writer)
+
+    if operations and self.fields_changed('links', 'nodes'):
+      update = operations[0][1]
+      update.get('$set', {}).pop('revision', None)
+      if '$set' in update and not update['$set']:
+        del update['$set']
+
+      update.setdefault('$inc', {})['revision'] = 1
+
+    return operations
+
+  def after_update(self):
+    # the revision in memory goes up along once the write went through, without becoming a change of its own
+    if self.fields_changed('links', 'nodes'):
+      self.value_list()[self.fields['revision'].index] = (self.revision or 0) + 1
+
+  def link_ids(self):
+    # The ids of the graph's links as a set. It is kept while the revision in memory stays the same, which
+    # every save of changed links moves on; links changed but not saved yet get a fresh set.
+    values = self.value_list()
+    field = self.fields['links']
+    if field.is_dirty(values[field.index], bool(self._dirty & field.mask)):
+      return set(link.id for link in raw_items(values[field.index]) if link is not None and link.id is not None)
+
+    cached = self.__dict__.get('cached_link_ids')
+    if cached is None or cached[0] != self.revision:
+      cached = self.cached_link_ids = (self.revision, set(link.id for link in raw_items(values[field.index])
+                                                          if link is not None and link.id is not None))
+
+    return cached[1]
+
+  def incident_links(self, node, direction='both'):
+    # Raw {'_id', 'sources', 'sinks'} documents of this graph's links going out of ('out'), into ('in') or
+    # either way ('both') of node. They are looked up by node in Link's indexes, then kept if they are in this graph.
+    node_id = node if isinstance(node, str) else node.id
+
+    if direction == 'out':
+      query = {'sources': node_id}
+    elif direction == 'in':
+      query = {'sinks': node_id}
+    elif direction == 'both':
+      query = {'$or': [{'sources': node_id}, {'sinks': node_id}]}
+    else:
+      raise ValueError("Direction must be 'out', 'in' or 'both', not {}.".format(direction))
+
+    link_ids = self.link_ids()
+    return [doc for doc in Link.read_collection().find(query, projection=['sources', 'sinks']) if str(doc['_id']) in link_ids]
+
+  def neighbors(self, node, direction='both'):
+    node_id = node if isinstance(node, str) else node.id
+
+    neighbor_ids = OrderedDict()
+    for doc in self.incident_links(node_id, direction):
+      if direction != 'in' and node_id in doc.get('sources', []):
+        neighbor_ids.update((sink_id, None) for sink_id in doc.get('sinks', []))
+      if direction != 'out' and node_id in doc.get('sinks', []):
+        neighbor_ids.update((source_id, None) for source_id in doc.get('sources', []))
+
+    neighbor_ids.pop(node_id, None)
+    return [neighbor for neighbor in Node.get_or_make_refs(Node, list(neighbor_ids), ignore_not_found=True) if neighbor is not None]
+
+  def degree(self, node, direction='both'):
+    # the number of this graph's links at node; a link that both starts and ends there counts once
+    return len(self.incident_links(node, direction))
@@ -0,0 +1,365 @@
+from collections import OrderedDict
+from contextvars import ContextVar
+import asyncio
+
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
+
+from .metrics import counted
+
+current_session = ContextVar('graphstore_session', default=None)
+current_change_log = ContextVar('graphstore_change_log', default=None)  # see graphstore.changes
+
+
+def record_change(obj, deleted=False):
+  # called after every write, so an active ChangeLog can note which objects it touched
+  log = current_change_log.get()
+  if log is not None:
+    log.record(obj, deleted)
+
+
+# ## Unit of work
+# While a Session is active, MongoModel.save() and delete() only record the object here.
+# commit() then writes everything with one bulk_write per collection, referenced objects first.
+# A commit that fails drops whatever it had queued; the objects keep their unsaved changes.
+class Session(object):
+  def __init__(self):
+    self.pending = OrderedDict()  # id(obj) -> obj, for new and dirty objects
+    self.new = {}  # id(obj) -> (obj, the _id it had: None or a str) for objects that still need to be inserted
+    self.deleted = OrderedDict()
+    self.round_trips = 0
+    self.flushing = False
+    self.failed = False  # whether the last commit raised; leaving the block doesn't try it again
+    self.token = None
+    self.expected_matches = {}
+    self.versioned = {}
+    self.queued = {}
+    self.done = set()
+    self.unknown_matches = set()
+    self.writer = None
+
+  @staticmethod
+  def current():
+    return current_session.get()
+
+  def __enter__(self):
+    self.token = current_session.set(self)
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    try:
+      if exc_type is not None:
+        self.rollback()
+      elif self.has_changes():
+        self.commit()
+    finally:
+      current_session.reset(self.token)
+      self.token = None
+
+  # `async with Session():` does the same, but commits through the models' async clients
+  async def __aenter__(self):
+    return self.__enter__()
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    try:
+      if exc_type is not None:
+        self.rollback()
+      elif self.has_changes():
+        await self.acommit()
+    finally:
+      current_session.reset(self.token)
+      self.token = None
+
+  def add(self, obj):
+    key = id(obj)
+    if key in self.pending:
+      return obj
+
+    if not isinstance(obj._id, ObjectId):
+      # ids are assigned up front so other objects can reference this one before it is inserted;
+      # the one it had is kept, so a rollback can make it unsaved again
+      self.new[key] = (obj, obj._id)
+      obj._id = ObjectId(obj._id) if isinstance(obj._id, str) else ObjectId()
+
+    self.deleted.pop(key, None)
+    self.pending[key] = obj
+    return obj
+
+  def delete(self, obj):
+    key = id(obj)
+    self.pending.pop(key, None)
+
+    if key in self.new:
+      obj._id = self.new.pop(key)[1]  # never written, so there is nothing to delete
+    else:
+      self.deleted[key] = obj
+
+  def has_changes(self):
+    # the saves and deletes leaving the block commits: none once a commit has failed
+    return not self.failed and bool(self.pending or self.deleted)
+
+  def rollback(self):
+    # objects that were never inserted get their old _id back, so a later save() inserts them
+    for obj, old_id in self.new.values():
+      obj._id = old_id
+
+    self.pending.clear()
+    self.new.clear()
+    self.deleted.clear()
+
+  def ordered(self):
+    # depth-first, post-order walk so referenced objects come before the objects referencing them;
+    # new or changed objects reachable from tracked ones are saved too, like ModelField.serialize does
+    ordered = OrderedDict()
+    visiting = set()
+
+    def visit(obj):
+      key = id(obj)
+      if key in ordered or key in visiting:
+        return
+
+      visiting.add(key)
+      for ref in obj.iter_references(loaded_only=True):
+        if id(ref) in self.pending or not isinstance(ref._id, ObjectId) or ref.changed(cascade=False):
+          self.add(ref)
+          visit(ref)
+
+      ordered[key] = obj
+
+    for obj in list(self.pending.values()):
+      visit(obj)
+
+    return list(ordered.values())
+
+  @counted
+  def commit(self):
+    # Each collection's objects are marked clean as soon as its bulk_write went through, so if a later
+    # collection fails, a retry doesn't apply their $push or $inc updates a second time.
+    self.failed = False
+    round_trips = self.round_trips
+    try:
+      objs, operations = self.prepare()
+
+      self.flushing = True
+      try:
+        conflicts = []
+        for key, (obj, collection_operations) in operations.items():
+          collection = obj.collection(obj.DATABASE)
+          self.round_trips += 1
+          try:
+            result = collection.bulk_write(collection_operations, ordered=True)
+          except BulkWriteError as error:
+            self.written(key, count=error.details['writeErrors'][0]['index'])
+            raise
+
+          collection_conflicts = []
+          if self.may_conflict(key, result):
+            self.round_trips += 1
+            collection_conflicts = self.find_conflicts(key, collection.find(*self.version_query(key)))
+
+          self.written(key, conflicts=collection_conflicts)
+          conflicts.extend(collection_conflicts)
+      finally:
+        self.flushing = False
+
+      self.finish(objs, conflicts)
+      return self.round_trips - round_trips
+    except Exception:
+      self.failed = True
+      self.rollback()
+      raise
+
+  @counted
+  async def acommit(self):
+    # ids are assigned before anything is written, so the collections don't depend on each other's
+    # writes and all their bulk_writes can be in flight at once
+    self.failed = False
+    round_trips = self.round_trips
+    try:
+      objs, operations = self.prepare()
+
+      self.flushing = True
+      try:
+        keys = list(operations)
+        results = await asyncio.gather(*[obj.async_collection(obj.DATABASE).bulk_write(collection_operations, ordered=True)
+                                         for obj, collection_operations in operations.values()], return_exceptions=True)
+        self.round_trips += len(keys)
+
+        # every collection's writes are done before raising the first error, so what was written is known
+        conflicts = []
+        for key, result in zip(keys, results):
+          if isinstance(result, BulkWriteError):
+            self.written(key, count=result.details['writeErrors'][0]['index'])
+          elif not isinstance(result, BaseException):
+            collection_conflicts = []
+            if self.may_conflict(key, result):
+              obj = operations[key][0]
+              self.round_trips += 1
+              docs = await obj.async_collection(obj.DATABASE).find(*self.version_query(key)).to_list()
+              collection_conflicts = self.find_conflicts(key, docs)
+
+            self.written(key, conflicts=collection_conflicts)
+            conflicts.extend(collection_conflicts)
+
+        for result in results:
+          if isinstance(result, BaseException):
+            raise result
+      finally:
+        self.flushing = False
+
+      self.finish(objs, conflicts)
+      return self.round_trips - round_trips
+    except Exception:
+      self.failed = True
+      self.rollback()
+      raise
+
+  def prepare(self):
+    # validates everything and returns (objects, {(connection, database, collection): (an object, [operations])})
+    objs = self.ordered()
+
+    errors = {}
+    for obj in objs:
+      obj_errors = obj.validate()
+      if obj_errors:
+        errors['{} {}'.format(obj.__class__.__name__, obj.id)] = obj_errors
+
+    if errors:
+      raise ValueError("Data error(s): {}".format(errors))
+
+    operations = OrderedDict()
+    self.expected_matches = {}  # (connection, database, collection) -> number of updates, which should each match a document
+    self.versioned = {}  # (connection, database, collection) -> [(object, updates queued for it)] for objects with a VersionField
+    self.writer = ObjectId()  # stored with versioned updates, so the ones that matched can be told apart
+    self.queued = {}  # (connection, database, collection) -> [(index after the object's last operation, object)]
+    self.done = set()  # id(obj) of objects whose writes went through
+    self.unknown_matches = set()  # (connection, database, collection) written to with updates of many documents
+
+    def queue(obj, operation):
+      collection_key = (obj.CONNECTION, obj.DATABASE, obj.COLLECTION)
+      if collection_key not in operations:
+        operations[collection_key] = (obj, [])
+        self.expected_matches[collection_key] = 0
+
+      operations[collection_key][1].append(operation)
+      if not isinstance(obj, type):
+        self.queued.setdefault(collection_key, []).append((len(operations[collection_key][1]), obj))
+
+    def queue_related(related):
+      # queued under the model class, whose collection methods work like an object's; an UpdateMany can match
+      # any number of documents, so a collection with one is always checked for conflicts
+      for model_class, operation in related:
+        queue(model_class, operation)
+        collection_key = (model_class.CONNECTION, model_class.DATABASE, model_class.COLLECTION)
+        if isinstance(operation, UpdateOne):
+          self.expected_matches[collection_key] += 1
+        else:
+          self.unknown_matches.add(collection_key)
+
+    self.flushing = True
+    try:
+      for obj in objs:
+        if id(obj) in self.new:
+          serialized = obj.serialize(include='all', cascade=False)
+          serialized['_id'] = obj._id
+          queue(obj, InsertOne(serialized))
+        else:
+          update_operations = obj.update_operations(cascade=False, writer=self.writer)
+          for update_operation in update_operations:
+            queue(obj, UpdateOne(*update_operation))
+
+          if update_operations:
+            collection_key = (obj.CONNECTION, obj.DATABASE, obj.COLLECTION)
+            self.expected_matches[collection_key] += len(update_operations)
+
+            if obj.version_field is not None:
+              self.versioned.setdefault(collection_key, []).append((obj, len(update_operations)))
+
+            queue_related(obj.related_updates())
+
+      for obj in self.deleted.values():
+        queue(obj, DeleteOne({'_id': obj._id}))
+        queue_related(obj.related_updates(deleted=True))
+
+    finally:
+      self.flushing = False
+
+    return objs, operations
+
+  def written(self, collection_key, count=None, conflicts=()):
+    # Finishes the objects whose operations are among the first count written to a collection (all of them by
+    # default): they are in the database now, so they are marked clean and a rollback leaves their ids alone.
+    # Conflicting objects keep their changes and old version.
+    conflicting = set(id(obj) for obj in conflicts)
+    counts = dict((id(obj), n) for obj, n in self.versioned.get(collection_key, []))
+
+    # an object with several updates is listed once per update; only its last one says whether it's all written
+    last = OrderedDict()
+    for end, obj in self.queued.get(collection_key, []):
+      last[id(obj)] = (end, obj)
+
+    for end, obj in last.values():
+      if (count is not None and end > count) or id(obj) in conflicting or id(obj) in self.done:
+        continue
+
+      self.done.add(id(obj))
+      if id(obj) in self.deleted:
+        obj.identity_map.discard(obj.__class__, obj.id)
+        record_change(obj, deleted=True)
+        continue
+
+      if id(obj) in self.new:
+        self.new.pop(id(obj))
+        obj.get_or_make_ref(obj.__class__, obj._id, obj=obj)
+      else:
+        obj.after_update()
+
+      if id(obj) in counts:
+        obj.bump_version(counts[id(obj)])
+
+      obj.mark_clean()
+      record_change(obj)
+
+  def may_conflict(self, collection_key, result):
+    # whether a collection's versioned updates need checking: fewer matches than updates means one of them missed
+    if collection_key not in self.versioned:
+      return False
+
+    return collection_key in self.unknown_matches or result.matched_count < self.expected_matches[collection_key]
+
+  def version_query(self, collection_key):
+    # (filter, projection) for the current versions of the versioned objects written to a collection
+    objs = [obj for obj, count in self.versioned[collection_key]]
+    field = objs[0].fields[objs[0].version_field]
+    return {'_id': {'$in': [obj._id for obj in objs]}}, [field.name, field.WRITER]
+
+  def find_conflicts(self, collection_key, docs):
+    # the versioned objects whose documents weren't left at the version their updates make by this session;
+    # fewer matches than updates can also just mean unversioned objects that were deleted meanwhile
+    versioned = self.versioned[collection_key]
+    field = versioned[0][0].fields[versioned[0][0].version_field]
+    versions = {doc['_id']: (doc.get(field.name) or 0, doc.get(field.WRITER)) for doc in docs}
+    conflicts = []
+
+    for obj, count in versioned:
+      expected = (getattr(obj, obj.version_field) or 0) + count
+      if versions.get(obj._id) != (expected, self.writer):
+        conflicts.append(obj)
+
+    return conflicts
+
+  def finish(self, objs, conflicts=()):
+    # The objects that had nothing to write are marked clean too. A ConflictError naming the conflicting
+    # objects is raised once the rest is done.
+    conflicting = set(id(obj) for obj in conflicts)
+    for obj in objs:
+      if id(obj) not in conflicting and id(obj) not in self.done:
+        obj.mark_clean()
+        record_change(obj)
+
+    self.rollback()
+
+    if conflicts:
+      from .models import ConflictError  # models imports this module, so not at the top
+      raise ConflictError(conflicts)
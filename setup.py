@@ -2,14 +2,21 @@ from setuptools import setup
 
 setup(
     name='IdeaGrapher',
-    packages=['webviz', 'graphstore'],
+    packages=['webviz', 'graphstore', 'graphstore.importers'],
     include_package_data=True,
     install_requires=[
         'flask',
-        'pymongo',
+        'pymongo>=4.13',  # AsyncMongoClient
         'bcrypt',
         'wtforms',
         'flask-shell-ipython',
         'docopt',
+        'numpy',
     ],
+    entry_points={
+        'console_scripts': [
+            'graphstore-import=graphstore.importers.__main__:main',
+            'graphstore-sync-indexes=graphstore.indexes:main',
+        ],
+    },
 )
@@ -1,9 +1,8 @@
 # all the imports
 import os
-from flask import Flask
+from flask import Flask, g
 
-import graphstore
-from pymongo import MongoClient
+from graphstore.connections import register_connection
 
 app = Flask(__name__)  # create the application instance :)
 app.config.from_object(__name__)  # load config from this file , flaskr.py
@@ -20,23 +19,48 @@ os.environ.setdefault('WEBVIZ_SETTINGS', 'settings.py')
 app.config.from_envvar('WEBVIZ_SETTINGS')
 
 
+# One connection for the whole app, registered before anything is read or written; its clients are made by
+# each worker process when it first needs them, so pre-fork servers don't share pools across fork().
 if app.config.get('MONGO_DATABASE'):
-  mongo_args = dict(
+  register_connection(
     database=app.config.get('MONGO_DATABASE', 'ideagrapher_test'),
     uri=app.config.get('MONGO_URI', 'localhost'),
     port=app.config.get('MONGO_PORT', 27017),
+    username=app.config.get('MONGO_USERNAME', None),
+    password=app.config.get('MONGO_PASSWORD', None),
+    max_pool_size=app.config.get('MONGO_MAX_POOL_SIZE', 100),
+    min_pool_size=app.config.get('MONGO_MIN_POOL_SIZE', 0),
+    connect_timeout_ms=app.config.get('MONGO_CONNECT_TIMEOUT_MS', 20000),
+    server_selection_timeout_ms=app.config.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 30000),
+    socket_timeout_ms=app.config.get('MONGO_SOCKET_TIMEOUT_MS', None),
+    wait_queue_timeout_ms=app.config.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', None),
+    read_preference=app.config.get('MONGO_READ_PREFERENCE', 'primary'),
+    engine=app.config.get('MONGO_ENGINE', 'mongo'),
   )
-  graphstore.MONGO_DATABASE = mongo_args['database']
 
-  if app.config.get('MONGO_USERNAME'):
-    mongo_args.update(dict(
-      username=app.config.get('MONGO_USERNAME', None),
-      password=app.config.get('MONGO_PASSWORD', None),
-    ))
-    graphstore.MONGO_CLIENT = MongoClient(mongo_args['uri'], mongo_args['port'], username=mongo_args['username'], password=mongo_args['password'])
 
-  else:
-    graphstore.MONGO_CLIENT = MongoClient(mongo_args['uri'], mongo_args['port'])
+# Every request gets its own identity map, so objects never leak between requests or threads;
+# scripts and shells outside a request share a bounded process-wide map instead.
+from graphstore.models import MongoModel  # noqa
+from graphstore.identity import ScopedIdentityMap, LRUIdentityMap  # noqa
+
+MongoModel.AUTO_SYNC_INDEXES = app.config.get('AUTO_SYNC_INDEXES', False)
+
+MongoModel.set_identity_map(ScopedIdentityMap(fallback=LRUIdentityMap(
+  max_size=app.config.get('IDENTITY_MAP_SIZE', 10000),
+  ttl=app.config.get('IDENTITY_MAP_TTL', None),
+)))
+
+
+@app.before_request
+def begin_identity_scope():
+  g.identity_scope = MongoModel.identity_map.begin()
+
+
+@app.teardown_request
+def end_identity_scope(exception=None):
+  MongoModel.identity_map.end(g.pop('identity_scope', None))
 
 
 import webviz.views  # noqa
+import webviz.metrics  # noqa
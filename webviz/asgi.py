@@ -0,0 +1,114 @@
+"""
+Serves the document endpoints from an asyncio event loop, so a slow document load doesn't hold a
+whole worker and many concurrent clients share one process. Run it with any ASGI server next to the
+Flask app and route /api/document/ to it, e.g.
+
+  uvicorn webviz.asgi:app
+
+Sessions are read from the Flask session cookie, so logins carry over.
+"""
+from http.cookies import SimpleCookie
+from itsdangerous import BadSignature
+import re
+import time
+
+from graphstore.connections import adisconnect
+from graphstore.metrics import measuring
+from graphstore.models import MongoModel
+
+from . import app as flask_app
+from . import metrics
+from .auth import aget_user
+from .models import Document
+
+DOCUMENT_API_PATH = re.compile(r'^/api/document/(?P<docid>[0-9a-fA-F]{24})$')
+DOCUMENT_API_ROUTE = '/api/document/<docid>'  # as the Flask app names it in its metrics
+
+
+def load_session(scope):
+  cookies = SimpleCookie()
+  for name, value in scope.get('headers', []):
+    if name == b'cookie':
+      cookies.load(value.decode('latin-1'))
+
+  morsel = cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+  if morsel is None:
+    return {}
+
+  serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+  try:
+    return serializer.loads(morsel.value, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+  except BadSignature:
+    return {}
+
+
+async def send_status(send, status, body=b''):
+  await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'text/plain')]})
+  await send({'type': 'http.response.body', 'body': body})
+
+
+async def document_api(scope, send, docid):
+  account = await aget_user(load_session(scope))
+
+  # the document alone first; webs are lazy, so nothing else is loaded before the visibility check
+  doc = await Document.aload_tree(docid, depth=0, ignore_not_found=True)
+  if doc is None or doc.visibility == 'private' and (account is None or doc.owner != account.genid):
+    return await send_status(send, 404, b'Not Found')
+
+  await Document.aload_tree(docid)
+
+  await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'application/json')]})
+  for chunk in doc.iter_json():
+    await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+
+  await send({'type': 'http.response.body', 'body': b''})
+
+
+async def lifespan(receive, send):
+  while True:
+    message = await receive()
+
+    if message['type'] == 'lifespan.startup':
+      await send({'type': 'lifespan.startup.complete'})
+
+    elif message['type'] == 'lifespan.shutdown':
+      await adisconnect()
+
+      await send({'type': 'lifespan.shutdown.complete'})
+      return
+
+
+async def app(scope, receive, send):
+  if scope['type'] == 'lifespan':
+    return await lifespan(receive, send)
+
+  if scope['type'] != 'http':
+    return
+
+  if scope['path'] == '/metrics' and flask_app.config.get('METRICS_ENDPOINT', True):
+    # this process' own metrics; it is scraped separately from the Flask workers
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/plain; version=0.0.4; charset=utf-8')]})
+    return await send({'type': 'http.response.body', 'body': metrics.render().encode('utf-8')})
+
+  match = DOCUMENT_API_PATH.match(scope['path'])
+  if match is None:
+    return await send_status(send, 404, b'Not Found')
+
+  if scope['method'] != 'GET':
+    return await send_status(send, 405, b'Method Not Allowed')
+
+  start = time.perf_counter()
+  statuses = []
+
+  async def send_noting_status(message):
+    if message['type'] == 'http.response.start':
+      statuses.append(message['status'])
+    await send(message)
+
+  # every request runs in its own task, so it gets its own identity map scope, like the Flask app's requests
+  with MongoModel.identity_map.scope(), measuring(flask_app.config.get('DB_METRICS_COUNT_BYTES', True)) as db_metrics:
+    try:
+      await document_api(scope, send_noting_status, match.group('docid'))
+    finally:
+      metrics.record(DOCUMENT_API_ROUTE, 'GET', statuses[0] if statuses else 500, time.perf_counter() - start, db_metrics)
@@ -1,10 +1,17 @@
-from .models import Account, ObjectNotFound
+from .models import Account
+
+import threading
+import time
 
 SESSION_KEY = '_auth_user_id'
 HASH_SESSION_KEY = '_auth_user_hash'
 LANGUAGE_SESSION_KEY = '_language'
 REDIRECT_FIELD_NAME = 'next'
 
+PRINCIPAL_TTL = 30  # seconds a verified session is trusted without looking at its account again
+PRINCIPAL_CACHE_SIZE = 10000  # most sessions kept; expired ones are dropped first when it's full
+PRINCIPAL_FIELDS = ['genid', 'username', 'session_auth_hash']
+
 
 # from django.utils.crypto import constant_time_compare
 # TODO: find replacement/actual implementation
@@ -41,6 +48,7 @@ def login(session, user, backend=None):
   session[HASH_SESSION_KEY] = session_auth_hash
 
   session['user'] = user.serialize(exclude=['_id', 'password'])
+  cache_principal(Principal(user.genid, user.username, session_auth_hash))
 
   pass
   # rotate_token(request)
@@ -70,30 +78,113 @@ def logout(session):
   flush(session)
 
 
+class Principal(object):
+  """
+  The part of an Account that identifies a logged in user: enough for checking
+  sessions and ownership, without the account's webs or password.
+  """
+  def __init__(self, genid, username='', session_auth_hash=''):
+    self.genid = genid
+    self.username = username
+    self.session_auth_hash = session_auth_hash
+
+  @classmethod
+  def from_document(cls, doc):
+    return cls(doc['genid'], doc.get('username', ''), doc.get('session_auth_hash', ''))
+
+  def get_session_auth_hash(self):
+    return self.session_auth_hash
+
+
+# (genid, session hash) -> (expiry time, Principal), for sessions that were verified recently
+principals = {}
+principals_lock = threading.Lock()  # for whatever iterates over principals, which requests share between threads
+
+
+def cached_principal(user_id, session_hash):
+  entry = principals.get((user_id, session_hash))
+  if entry is None:
+    return None
+
+  expires, principal = entry
+  if expires < time.monotonic():
+    principals.pop((user_id, session_hash), None)
+    return None
+
+  return principal
+
+
+def cache_principal(principal):
+  now = time.monotonic()
+
+  with principals_lock:
+    if len(principals) >= PRINCIPAL_CACHE_SIZE:
+      for key, (expires, _) in list(principals.items()):
+        if expires < now:
+          principals.pop(key, None)
+
+      if len(principals) >= PRINCIPAL_CACHE_SIZE:
+        principals.clear()
+
+    principals[(principal.genid, principal.get_session_auth_hash())] = (now + PRINCIPAL_TTL, principal)
+
+
+def forget_user(user_id):
+  """
+  Drop the cached sessions of a user, e.g. because their password or session
+  hash changed. Other processes keep theirs for up to PRINCIPAL_TTL seconds.
+  """
+  with principals_lock:
+    for key in [key for key in principals if key[0] == user_id]:
+      principals.pop(key, None)
+
+
+def verify_principal(session, principal):
+  # Verify the session
+  session_hash = session.get(HASH_SESSION_KEY, None)
+  session_hash_verified = principal is not None and session_hash is not None and constant_time_compare(session_hash, principal.get_session_auth_hash())
+
+  if not session_hash_verified:
+    if principal is not None:
+      flush(session)
+    return None
+
+  cache_principal(principal)
+  return principal
+
+
 def get_user(session):
   """
-  Return the user model instance associated with the given request session.
-  If no user is retrieved, return None.
+  Return the Principal of the user the given request session belongs to, or
+  None. Sessions verified in the last PRINCIPAL_TTL seconds are trusted without
+  a query; otherwise only the fields of PRINCIPAL_FIELDS are read.
   """
-  user = None
   user_id = session.get(SESSION_KEY, None)
+  if not user_id:
+    return None
 
-  if user_id:
-    try:
-      user = Account.find_one({'genid': user_id})
+  principal = cached_principal(user_id, session.get(HASH_SESSION_KEY, None))
+  if principal is not None:
+    return principal
 
-    except ObjectNotFound:
-      return None
+  doc = Account.collection().find_one({'genid': user_id}, projection=PRINCIPAL_FIELDS)
+  return verify_principal(session, None if doc is None else Principal.from_document(doc))
 
-    # Verify the session
-    session_hash = session.get(HASH_SESSION_KEY, None)
-    session_hash_verified = session_hash is not None and constant_time_compare(session_hash, user.get_session_auth_hash())
 
-    if not session_hash_verified:
-      flush(session)
-      user = None
+async def aget_user(session):
+  """
+  Like get_user, for code running on an event loop.
+  """
+  user_id = session.get(SESSION_KEY, None)
+  if not user_id:
+    return None
+
+  principal = cached_principal(user_id, session.get(HASH_SESSION_KEY, None))
+  if principal is not None:
+    return principal
 
-  return user
+  doc = await Account.async_collection().find_one({'genid': user_id}, projection=PRINCIPAL_FIELDS)
+  return verify_principal(session, None if doc is None else Principal.from_document(doc))
 
 
 def flush(session):
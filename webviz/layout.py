@@ -0,0 +1,167 @@
+from graphstore.session import Session
+import numpy as np
+import time
+
+MAX_DEPTH = 16  # quadtree levels; positions are quantized to a 2^16 x 2^16 grid
+
+
+# ## Barnes-Hut quadtree
+def spread_bits(values):
+  # puts a zero bit between each of the low 16 bits, so x and y codes can be interleaved
+  values = values & np.uint64(0xFFFF)
+  values = (values | (values << np.uint64(8))) & np.uint64(0x00FF00FF)
+  values = (values | (values << np.uint64(4))) & np.uint64(0x0F0F0F0F)
+  values = (values | (values << np.uint64(2))) & np.uint64(0x33333333)
+  values = (values | (values << np.uint64(1))) & np.uint64(0x55555555)
+  return values
+
+
+class QuadTree(object):
+  # A linear quadtree: points are sorted by Morton code, so the cells of each level are runs of equal
+  # code prefixes, and a cell's children are the cells at the next level with keys 4 * key + 0..3.
+  # Every level keeps its cell keys, point counts, masses and centers of mass as arrays.
+  def __init__(self, positions, masses, depth=MAX_DEPTH):
+    low = positions.min(axis=0)
+    self.size = max(float((positions.max(axis=0) - low).max()), 1e-9) * (1 + 1e-9)
+
+    grid = ((positions - low) / self.size * (1 << depth)).astype(np.uint64)
+    codes = spread_bits(grid[:, 0]) | (spread_bits(grid[:, 1]) << np.uint64(1))
+
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    masses = masses[order]
+    weighted = positions[order] * masses[:, None]
+
+    self.levels = []
+    for level in range(depth + 1):
+      prefixes = codes >> np.uint64(2 * (depth - level))
+      starts = np.flatnonzero(np.concatenate([[True], prefixes[1:] != prefixes[:-1]]))
+
+      mass = np.add.reduceat(masses, starts)
+      centers = np.add.reduceat(weighted, starts, axis=0) / mass[:, None]
+      counts = np.diff(np.append(starts, len(codes)))
+      self.levels.append((prefixes[starts], counts, mass, centers))
+
+      if counts.max() == 1:
+        break  # every cell holds one point, so deeper levels would only repeat this one
+
+  def repulsion(self, positions, strength, theta=1.0, softening=1.0):
+    # Force on every point from all the others, each pushing with strength * mass / distance. A cell
+    # far enough away (size < theta * distance) acts as one body at its center of mass; anything else
+    # is opened, so all (point, cell) pairs of a level are handled at once.
+    forces = np.zeros_like(positions)
+    points = np.arange(len(positions))
+    cells = np.zeros(len(positions), dtype=np.int64)
+
+    for level, (keys, counts, mass, centers) in enumerate(self.levels):
+      delta = positions[points] - centers[cells]
+      distance2 = (delta ** 2).sum(axis=1) + softening
+      size = self.size / (1 << level)
+
+      accepted = (counts[cells] == 1) | (size * size < theta * theta * distance2)
+      if level == len(self.levels) - 1:
+        accepted[:] = True
+
+      push = delta[accepted] * (strength * mass[cells[accepted]] / distance2[accepted])[:, None]
+      forces[:, 0] += np.bincount(points[accepted], weights=push[:, 0], minlength=len(positions))
+      forces[:, 1] += np.bincount(points[accepted], weights=push[:, 1], minlength=len(positions))
+
+      points = points[~accepted]
+      cells = cells[~accepted]
+      if not len(points):
+        break
+
+      next_keys = self.levels[level + 1][0]
+      children = (keys[cells][:, None] << np.uint64(2)) + np.arange(4, dtype=np.uint64)
+      found = np.minimum(np.searchsorted(next_keys, children), len(next_keys) - 1)
+      exists = next_keys[found] == children
+
+      points = np.repeat(points, 4)[exists.ravel()]
+      cells = found.ravel()[exists.ravel()]
+
+    return forces
+
+
+# ## Force-directed layout
+def settle(positions, velocities, sources, sinks, length=200.0, iterations=1000, theta=1.0, damping=0.8,
+           step=0.1, gravity=0.005, tolerance=0.05, seed=0, deadline=None):
+  # Fruchterman-Reingold style forces (repulsion length^2 / d through the quadtree, attraction d^2 / length
+  # along edges, plus a weak pull to the centroid that keeps separate pieces from drifting apart), integrated
+  # into the velocities with damping until vertices move less than tolerance * length per step on average.
+  # Stops early once time.perf_counter() passes deadline, if there is one.
+  # Returns (positions, velocities, iterations run, whether it converged).
+  positions = np.array(positions, dtype=np.float64).reshape(-1, 2)
+  velocities = np.array(velocities, dtype=np.float64).reshape(-1, 2)
+  n = len(positions)
+
+  if n < 2:
+    return positions, np.zeros_like(velocities), 0, True
+
+  # vertices stacked on one spot (new ones all start at 0, 0) feel no force from each other
+  _, first, counts = np.unique(positions, axis=0, return_index=True, return_counts=True)
+  if counts.max() > 1:
+    stacked = np.ones(n, dtype=bool)
+    stacked[first] = False
+    spread = length * np.sqrt(stacked.sum()) / 4  # about one length apart, so the first steps aren't explosions
+    positions[stacked] += np.random.default_rng(seed).normal(scale=spread, size=(stacked.sum(), 2))
+
+  sources = np.asarray(sources, dtype=np.int64)
+  sinks = np.asarray(sinks, dtype=np.int64)
+  masses = np.ones(n)
+  # well-connected vertices are slowed down in proportion, or the pull of all their edges makes them overshoot
+  inertia = 1.0 + np.bincount(sources, minlength=n) + np.bincount(sinks, minlength=n)
+  max_speed = length
+
+  for iteration in range(1, iterations + 1):
+    forces = QuadTree(positions, masses).repulsion(positions, length * length, theta=theta)
+
+    delta = positions[sinks] - positions[sources]
+    pull = delta * (np.sqrt((delta ** 2).sum(axis=1)) / length)[:, None]
+    for axis in (0, 1):
+      forces[:, axis] += np.bincount(sources, weights=pull[:, axis], minlength=n)
+      forces[:, axis] -= np.bincount(sinks, weights=pull[:, axis], minlength=n)
+
+    forces -= gravity * (positions - positions.mean(axis=0))
+
+    velocities = (velocities + forces * (step / inertia)[:, None]) * damping
+    speeds = np.sqrt((velocities ** 2).sum(axis=1))
+    too_fast = speeds > max_speed
+    velocities[too_fast] *= (max_speed / speeds[too_fast])[:, None]
+
+    positions += velocities
+    if speeds.mean() < tolerance * length:
+      return positions, velocities, iteration, True
+
+    if deadline is not None and time.perf_counter() > deadline:
+      return positions, velocities, iteration, False
+
+  return positions, velocities, iterations, False
+
+
+def layout_web(web, **kwargs):
+  # Settles the web's vertices, connected by its edges, from where they are now, and saves their
+  # screen.x/y/xv/yv with one bulk_write. Returns (iterations run, whether it converged).
+  vertices = list(web.vertices)
+  index = {vertex.id: i for i, vertex in enumerate(vertices)}
+
+  sources = []
+  sinks = []
+  for edge in web.edges:
+    for start in edge.start_vertices:
+      for end in edge.end_vertices:
+        if start.id in index and end.id in index and start.id != end.id:
+          sources.append(index[start.id])
+          sinks.append(index[end.id])
+
+  screens = [vertex.screen for vertex in vertices]
+  positions = [(screen['x'], screen['y']) for screen in screens]
+  velocities = [(screen['xv'], screen['yv']) for screen in screens]
+
+  positions, velocities, iterations, converged = settle(positions, velocities, sources, sinks, **kwargs)
+
+  with Session():
+    for vertex, (x, y), (xv, yv) in zip(vertices, positions.tolist(), velocities.tolist()):
+      vertex.screen = dict(x=x, y=y, xv=xv, yv=yv)
+      vertex.save()
+
+  return iterations, converged
@@ -0,0 +1,239 @@
+"""
+Request metrics: how long each route takes, and the Mongo commands each
+request sends (counted by graphstore.metrics). They are added up for the
+process and served at /metrics in Prometheus' text format, so every worker
+process is scraped on its own. With DB_METRICS_HEADERS (on in debug mode),
+every response also carries its own command counts in X-DB-* headers and a
+Server-Timing header the browser's developer tools show.
+"""
+from flask import g, request, abort, Response
+import threading
+import time
+
+from graphstore import metrics as db_metrics
+from graphstore.connections import pool_stats
+
+from . import app
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+UNMATCHED_ROUTE = '<unmatched>'
+
+
+class Counter(object):
+  def __init__(self, name, help, labels):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self.values = {}  # label values -> value
+
+  def inc(self, label_values, amount=1):
+    self.values[label_values] = self.values.get(label_values, 0) + amount
+
+  def lines(self):
+    yield '# HELP {} {}'.format(self.name, self.help)
+    yield '# TYPE {} counter'.format(self.name)
+    for label_values, value in sorted(self.values.items()):
+      yield '{}{} {}'.format(self.name, label_text(self.labels, label_values), format_value(value))
+
+
+class Histogram(object):
+  def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self.buckets = buckets
+    self.values = {}  # label values -> [count per bucket..., sum, count]
+
+  def observe(self, label_values, value):
+    series = self.values.get(label_values)
+    if series is None:
+      series = self.values[label_values] = [0] * (len(self.buckets) + 2)
+
+    for index, bound in enumerate(self.buckets):
+      if value <= bound:
+        series[index] += 1
+    series[-2] += value
+    series[-1] += 1
+
+  def lines(self):
+    yield '# HELP {} {}'.format(self.name, self.help)
+    yield '# TYPE {} histogram'.format(self.name)
+    for label_values, series in sorted(self.values.items()):
+      for bound, count in zip(self.buckets + ('+Inf',), series[:len(self.buckets)] + [series[-1]]):
+        le = bound if bound == '+Inf' else format_value(bound)
+        yield '{}_bucket{} {}'.format(self.name, label_text(self.labels + ('le',), label_values + (le,)), count)
+      yield '{}_sum{} {}'.format(self.name, label_text(self.labels, label_values), format_value(series[-2]))
+      yield '{}_count{} {}'.format(self.name, label_text(self.labels, label_values), series[-1])
+
+
+def label_text(names, values):
+  if not names:
+    return ''
+
+  escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+  return '{' + ','.join('{}="{}"'.format(name, value) for name, value in zip(names, escaped)) + '}'
+
+
+def format_value(value):
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# ## The process' totals
+lock = threading.Lock()
+
+request_seconds = Histogram('webviz_request_duration_seconds', 'Time taken to handle requests.', ('route', 'method'))
+requests = Counter('webviz_requests_total', 'Requests handled.', ('route', 'method', 'status'))
+route_commands = Counter('webviz_request_db_commands_total', 'Mongo commands sent by requests.', ('route',))
+route_command_seconds = Counter('webviz_request_db_seconds_total', 'Time spent on the Mongo commands of requests.', ('route',))
+
+collection_counters = [
+  ('queries', Counter('graphstore_commands_total', 'Mongo commands sent by requests.', ('collection',))),
+  ('documents', Counter('graphstore_documents_returned_total', 'Documents returned by reads.', ('collection',))),
+  ('bytes_sent', Counter('graphstore_bytes_sent_total', 'BSON bytes of the commands sent.', ('collection',))),
+  ('bytes_received', Counter('graphstore_bytes_received_total', 'BSON bytes of the replies received.', ('collection',))),
+  ('seconds', Counter('graphstore_command_seconds_total', 'Time spent on commands.', ('collection',))),
+  ('failures', Counter('graphstore_command_failures_total', 'Commands that failed.', ('collection',))),
+]
+operation_counters = [
+  ('queries', Counter('graphstore_operation_commands_total', 'Mongo commands sent, by model method.', ('operation',))),
+  ('documents', Counter('graphstore_operation_documents_returned_total', 'Documents returned, by model method.', ('operation',))),
+  ('seconds', Counter('graphstore_operation_seconds_total', 'Time spent on commands, by model method.', ('operation',))),
+]
+
+
+def record(route, method, status, seconds, metrics):
+  # adds one request, and the RequestMetrics of its commands, to the process' totals
+  with lock:
+    request_seconds.observe((route, method), seconds)
+    requests.inc((route, method, str(status)))
+    route_commands.inc((route,), metrics.totals.queries)
+    route_command_seconds.inc((route,), metrics.totals.seconds)
+
+    for groups, counters in ((metrics.collections, collection_counters), (metrics.operations, operation_counters)):
+      for name, stats in groups.items():
+        for attribute, counter in counters:
+          counter.inc((name,), getattr(stats, attribute))
+
+
+def pool_lines():
+  # gauges and counters from the connection pools of graphstore.connections
+  stats = [((alias, client), snapshot) for alias, clients in sorted(pool_stats().items())
+           for client, snapshot in sorted(clients.items())]
+
+  for name, kind, help, key in (
+    ('graphstore_pool_connections_open', 'gauge', 'Connections open in the pool.', 'open'),
+    ('graphstore_pool_connections_in_use', 'gauge', 'Connections checked out of the pool.', 'in_use'),
+    ('graphstore_pool_checkouts_total', 'counter', 'Connections checked out of the pool.', 'checked_out'),
+    ('graphstore_pool_checkout_failures_total', 'counter', 'Failed checkouts, e.g. timeouts waiting for a connection.', 'checkout_failures'),
+    ('graphstore_pool_clears_total', 'counter', 'Times the pool was cleared.', 'clears'),
+  ):
+    yield '# HELP {} {}'.format(name, help)
+    yield '# TYPE {} {}'.format(name, kind)
+    for labels, snapshot in stats:
+      yield '{}{} {}'.format(name, label_text(('connection', 'client'), labels), snapshot[key])
+
+
+def render():
+  with lock:
+    lines = []
+    for metric in [request_seconds, requests, route_commands, route_command_seconds] + \
+                  [counter for name, counter in collection_counters + operation_counters]:
+      lines.extend(metric.lines())
+
+  lines.extend(pool_lines())
+  return '\n'.join(lines) + '\n'
+
+
+def headers(metrics):
+  # the X-DB-* and Server-Timing headers of one request
+  totals = metrics.totals
+  milliseconds = totals.seconds * 1000
+  return {
+    'X-DB-Queries': str(totals.queries),
+    'X-DB-Documents': str(totals.documents),
+    'X-DB-Bytes-Sent': str(totals.bytes_sent),
+    'X-DB-Bytes-Received': str(totals.bytes_received),
+    'X-DB-Time-Ms': '{:.2f}'.format(milliseconds),
+    'X-DB-Collections': ', '.join('{}={}'.format(name, stats.queries) for name, stats in sorted(metrics.collections.items())),
+    'X-DB-Operations': ', '.join('{}={}'.format(name, stats.queries) for name, stats in sorted(metrics.operations.items())),
+    'Server-Timing': 'db;dur={:.2f};desc="{} queries"'.format(milliseconds, totals.queries),
+  }
+
+
+# ## Flask hooks
+# Flask tears a request down as soon as the view returns, before a streamed body is sent, and the body
+# runs outside the request's context. So the request is recorded when its response is closed, and a
+# streamed body counts the commands it sends in the request's metrics itself.
+class MeasuredBody(object):
+  def __init__(self, body, metrics):
+    self.body = body
+    self.iterator = iter(body)
+    self.metrics = metrics
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    token = db_metrics.current_metrics.set(self.metrics)
+    try:
+      return next(self.iterator)
+    finally:
+      db_metrics.end(token)
+
+  def close(self):
+    # closing a generator runs what is left of it, e.g. a with block that closes a cursor
+    if hasattr(self.body, 'close'):
+      token = db_metrics.current_metrics.set(self.metrics)
+      try:
+        self.body.close()
+      finally:
+        db_metrics.end(token)
+
+
+@app.before_request
+def begin_request_metrics():
+  g.request_start = time.perf_counter()
+  g.db_metrics, g.db_metrics_token = db_metrics.begin(count_bytes=app.config.get('DB_METRICS_COUNT_BYTES', True))
+
+
+def current_route():
+  return request.url_rule.rule if request.url_rule is not None else UNMATCHED_ROUTE
+
+
+@app.after_request
+def add_metrics_headers(response):
+  metrics = g.pop('db_metrics', None)
+  if metrics is None:
+    return response
+
+  show = app.config.get('DB_METRICS_HEADERS')
+  if app.debug if show is None else show:
+    response.headers.update(headers(metrics))  # a streamed body's commands come after these are sent
+
+  if response.is_streamed:
+    response.response = MeasuredBody(response.response, metrics)
+
+  route, method, status, start = current_route(), request.method, response.status_code, g.pop('request_start')
+  response.call_on_close(lambda: record(route, method, status, time.perf_counter() - start, metrics))
+  return response
+
+
+@app.teardown_request
+def end_request_metrics(exception=None):
+  # stops counting in the request's context; with stream_with_context this runs again after the body
+  db_metrics.end(g.pop('db_metrics_token', None))
+
+  metrics = g.pop('db_metrics', None)
+  if metrics is not None:
+    # there was no response to record it with, e.g. an exception propagated past Flask's handlers
+    record(current_route(), request.method, 500, time.perf_counter() - g.pop('request_start'), metrics)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view(**kwargs):
+  if not app.config.get('METRICS_ENDPOINT', True):
+    abort(404)
+
+  return Response(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
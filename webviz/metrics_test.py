@@ -0,0 +1,110 @@
+from flask import Response, stream_with_context
+from types import SimpleNamespace
+import itertools
+
+from graphstore.metrics import command_metrics, measuring
+from graphstore.models import MongoModel
+
+from . import app
+from . import metrics
+
+# like graphstore/memory_test.py, on the in-memory engine; it sends no real commands, so they are made up here
+MongoModel.connect_to_database("test", "localhost", 27017, engine='memory')
+request_ids = itertools.count()
+
+
+def command(collection, documents=1, fail=False):
+  # the events pymongo's listeners get for one find
+  request_id = next(request_ids)
+  command_metrics.started(SimpleNamespace(request_id=request_id, command={'find': collection}, command_name='find'))
+  if fail:
+    command_metrics.failed(SimpleNamespace(request_id=request_id, command_name='find', duration_micros=1000))
+  else:
+    reply = {'cursor': {'firstBatch': [{}] * documents, 'id': 0}, 'ok': 1}
+    command_metrics.succeeded(SimpleNamespace(request_id=request_id, command_name='find', duration_micros=1000, reply=reply))
+
+
+# ## Counting
+# the commands sent inside measuring() are added up in total, by collection and by operation
+command('outside')
+with measuring() as counted:
+  command('things', documents=3)
+  command('things', fail=True)
+  command('others')
+
+assert counted.totals.queries == 3 and counted.totals.documents == 4 and counted.totals.failures == 1
+assert sorted(counted.collections) == ['others', 'things'] and counted.collections['things'].queries == 2
+assert counted.operations['other'].queries == 3  # not sent by a model method
+assert abs(counted.totals.seconds - 0.003) < 1e-9
+
+
+# ## Requests
+@app.route('/metrics-test/plain')
+def plain_test_view():
+  command('things')
+  return 'plain'
+
+
+@app.route('/metrics-test/streamed')
+def streamed_test_view():
+  command('things')
+
+  def generate():
+    # runs after the view has returned and the request has been torn down
+    for n in range(3):
+      command('streamed')
+      yield str(n)
+
+  return Response(stream_with_context(generate()))
+
+
+@app.route('/metrics-test/failing')
+def failing_test_view():
+  command('things')
+  raise RuntimeError("failed on purpose")
+
+
+def recorded(route):
+  return metrics.requests.values.get((route, 'GET', '200'), 0), metrics.route_commands.values.get((route,), 0)
+
+
+app.config['DB_METRICS_HEADERS'] = True
+client = app.test_client()
+
+# a request is recorded once its response is closed, which WSGI servers do after sending it
+response = client.get('/metrics-test/plain')
+assert response.headers['X-DB-Queries'] == '1' and recorded('/metrics-test/plain') == (0, 0)
+response.close()
+assert recorded('/metrics-test/plain') == (1, 1)
+
+# the commands a streamed body sends count too, though they come after its headers
+with client.get('/metrics-test/streamed') as response:
+  assert response.get_data(as_text=True) == '012' and response.headers['X-DB-Queries'] == '1'
+
+assert recorded('/metrics-test/streamed') == (1, 4)
+assert metrics.collection_counters[0][1].values[('streamed',)] == 3
+assert metrics.request_seconds.values[('/metrics-test/streamed', 'GET')][-1] == 1
+
+# requests that end in an exception are recorded as 500s
+app.logger.disabled = True  # which would print the exception's traceback
+app.config['PROPAGATE_EXCEPTIONS'] = False
+with client.get('/metrics-test/failing') as response:
+  assert response.status_code == 500
+
+assert metrics.requests.values[('/metrics-test/failing', 'GET', '500')] == 1
+assert metrics.route_commands.values[('/metrics-test/failing',)] == 1
+
+app.config['PROPAGATE_EXCEPTIONS'] = True
+try:
+  client.get('/metrics-test/failing')
+  assert False, "the exception wasn't propagated"
+except RuntimeError:
+  pass
+
+assert metrics.requests.values[('/metrics-test/failing', 'GET', '500')] == 2
+app.logger.disabled = False
+
+# the process' totals are served at /metrics
+text = client.get('/metrics').get_data(as_text=True)
+assert 'webviz_request_db_commands_total{route="/metrics-test/streamed"} 4' in text
+assert 'graphstore_commands_total{collection="streamed"} 3' in text
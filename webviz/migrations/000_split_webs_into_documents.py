@@ -16,14 +16,18 @@ from webviz.models import Document, Web
 # from bson import ObjectId
 
 
+BATCH_SIZE = 500
+
+
 def run(args):
-  docs = list(Document.collection().find({}))
-  webs = list(Web.collection().find({}))
+  # both collections are streamed a batch at a time; only the ids of covered webs are kept around
+  covered_webs = set()
+  for doc in Document.collection().find({}, projection=['webs'], batch_size=BATCH_SIZE):
+    covered_webs.update(str(web_id) for web_id in doc.get('webs', []))
 
-  covered_webs = [doc.web.id for doc in docs]
   update_web_query = {'$unset': {'owner': 1, 'visibility': 1, 'rules': 1}}
 
-  for web in webs:
+  for web in Web.collection().find({}, batch_size=BATCH_SIZE):
     web_id = str(web['_id'])
     if web_id in covered_webs:
       continue
@@ -44,7 +48,7 @@ def run(args):
       doc = Document(**new_doc_data)
       doc.save()
 
-      Web.collection().update({'_id': web['_id']}, update_web_query)
+      Web.collection().update_one({'_id': web['_id']}, update_web_query)
 
 
 if __name__ == '__main__':
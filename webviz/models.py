@@ -1,5 +1,5 @@
-from graphstore.models import MongoModel, MongoIndex, ObjectNotFound, Graph, Node, Link, ModelField, StringField, BinaryField, ListField, EnumField, DictField, NestedField, FloatField, IntegerField, BooleanField
-import bcrypt
+from graphstore.models import MongoModel, MongoIndex, ObjectNotFound, Graph, Node, Link, ModelField, StringField, BinaryField, ListField, EnumField, DictField, NestedField, FloatField, IntegerField, BooleanField, VersionField
+from .passwords import hash_password, check_password, needs_rehash
 import random
 import string
 
@@ -11,7 +11,7 @@ class Account(MongoModel):
   username = StringField(max_length=50)
   password = BinaryField()
   email = StringField()
-  webs = ListField(ModelField('Web'))
+  webs = ListField(ModelField('Web', lazy=True))
   session_auth_hash = StringField(default='')
   genid = StringField()
 
@@ -21,7 +21,7 @@ class Account(MongoModel):
 
   def __init__(self, **kwargs):
     if isinstance(kwargs['password'], str):
-      kwargs['password'] = bcrypt.hashpw(bytes(kwargs['password'], encoding='utf-8'), bcrypt.gensalt())  # hash it pronto!
+      kwargs['password'] = hash_password(kwargs['password'])  # hash it pronto!
 
     super().__init__(**kwargs)
 
@@ -32,21 +32,27 @@ class Account(MongoModel):
     if self.session_auth_hash is None:
       self.session_auth_hash = ''.join([random.choice(string.ascii_letters) for i in range(20)])
 
+    if self.genid and self.fields_changed('password', 'session_auth_hash'):
+      from .auth import forget_user  # auth imports this module, so not at the top
+      forget_user(self.genid)
+
     super().save()
 
   @classmethod
   def authenticate(cls, username, password):
-    if isinstance(password, str):
-      password = bytes(password, encoding='utf-8')
-
     try:
       account = cls.find_one({'username': username})
 
-      if bcrypt.hashpw(password, account.password) == account.password:
-        return account
-      else:
+      if not check_password(password, account.password):
         return None
 
+      # hashes made with another cost than BCRYPT_ROUNDS are replaced while the password is at hand
+      if needs_rehash(account.password):
+        account.password = hash_password(password)
+        account.save()
+
+      return account
+
     except ObjectNotFound:
       return None
 
@@ -62,9 +68,11 @@ class Document(MongoModel):
   owner = StringField()  # Account.genid
   visibility = EnumField(['private', 'shared', 'public'], default='private')
 
-  webs = ListField(ModelField('Web'))
-  rules = ListField(ModelField('Rule'))
+  webs = ListField(ModelField('Web', lazy=True))
+  rules = ListField(ModelField('Rule', lazy=True))
   data = DictField()
+  revision = IntegerField(default=0)  # goes up with every ChangeLog commit; see /changes/<docid>
+  version = VersionField()
 
   visibility_index = MongoIndex(['visibility'])
   owner_index = MongoIndex(['owner'])
@@ -83,6 +91,7 @@ class Vertex(MongoModel):
   labels = ListField(ModelField('Prop'))
   subwebs = ListField(ModelField('Web'))
   data = DictField()
+  version = VersionField()
 
 
 class Edge(MongoModel):
@@ -95,6 +104,7 @@ class Edge(MongoModel):
     thickness=FloatField(default=3),
   ))
   data = DictField()
+  version = VersionField()
 
 
 class Web(MongoModel):
@@ -108,6 +118,7 @@ class Web(MongoModel):
     scale=FloatField(default=3),
   ))
   data = DictField()
+  version = VersionField()
 
 
 class Rule(MongoModel):
@@ -119,6 +130,7 @@ class Rule(MongoModel):
   filter_func = StringField(nullable=True)
   transform_func = StringField(nullable=True)
   data = DictField()
+  version = VersionField()
 
 
 class Prop(MongoModel):
@@ -126,3 +138,4 @@ class Prop(MongoModel):
   value = StringField()
   value_binary = BinaryField()
   data = DictField()
+  version = VersionField()
@@ -0,0 +1,74 @@
+"""
+Password hashing with bcrypt, capped to a small pool of worker threads.
+
+A request still waits for its own hash, but however many logins arrive at
+once, no more than PASSWORD_HASHING_WORKERS hashes use the CPU at a time, so
+a burst of logins can't take every core from the other requests. The cost of
+new hashes is BCRYPT_ROUNDS from the settings; hashes made with another cost
+are replaced on the next successful login (see Account.authenticate).
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import bcrypt
+
+from . import app
+
+DEFAULT_ROUNDS = 12
+DEFAULT_WORKERS = 4
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def get_pool():
+  global pool
+
+  if pool is None:
+    with pool_lock:
+      if pool is None:
+        pool = ThreadPoolExecutor(max_workers=app.config.get('PASSWORD_HASHING_WORKERS', DEFAULT_WORKERS),
+                                  thread_name_prefix='bcrypt')
+
+  return pool
+
+
+def configured_rounds():
+  return app.config.get('BCRYPT_ROUNDS', DEFAULT_ROUNDS)
+
+
+def hash_rounds(hashed):
+  """
+  The cost a bcrypt hash was made with, e.g. 12 for b'$2b$12$...'.
+  """
+  try:
+    return int(hashed.split(b'$')[2])
+  except (IndexError, ValueError):
+    return None
+
+
+def needs_rehash(hashed, rounds=None):
+  return hash_rounds(hashed) != (rounds or configured_rounds())
+
+
+def as_bytes(password):
+  return bytes(password, encoding='utf-8') if isinstance(password, str) else password
+
+
+def hash_password_inline(password, rounds=None):
+  return bcrypt.hashpw(as_bytes(password), bcrypt.gensalt(rounds or configured_rounds()))
+
+
+def check_password_inline(password, hashed):
+  try:
+    return bcrypt.checkpw(as_bytes(password), hashed)
+  except ValueError:
+    return False  # not a bcrypt hash at all
+
+
+def hash_password(password, rounds=None):
+  return get_pool().submit(hash_password_inline, password, rounds).result()
+
+
+def check_password(password, hashed):
+  return get_pool().submit(check_password_inline, password, hashed).result()
@@ -14,3 +14,31 @@ LANGUAGE_CODE = 'en-us'
 TIME_ZONE = 'US/Eastern'
 
 MONGO_DATABASE = 'ideagrapher'
+# 'memory' keeps everything in the process (see graphstore.memory), for tests and benchmarks without a server
+MONGO_ENGINE = 'mongo'
+# Connection pool of each worker process; the timeouts are in milliseconds, None for pymongo's defaults
+MONGO_MAX_POOL_SIZE = 100
+MONGO_MIN_POOL_SIZE = 0
+MONGO_CONNECT_TIMEOUT_MS = 20000
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 30000
+MONGO_SOCKET_TIMEOUT_MS = None
+MONGO_WAIT_QUEUE_TIMEOUT_MS = None
+MONGO_READ_PREFERENCE = 'primary'
+# Where read-only pages (/render/<docid>) read from; 'secondaryPreferred' takes load off the primary of a replica set
+RENDER_READ_PREFERENCE = 'primary'
+# Whether each model creates its missing indexes in the background when first used; otherwise run
+# graphstore-sync-indexes --models=webviz.models when deploying
+AUTO_SYNC_INDEXES = True
+
+# Mongo command counts of each request in X-DB-* response headers; None for only in debug mode
+DB_METRICS_HEADERS = None
+DB_METRICS_COUNT_BYTES = True  # the BSON size of every command and reply; costs an encode of each
+METRICS_ENDPOINT = True  # Prometheus metrics at /metrics
+
+# Identity map used outside of requests (shells, scripts); each request gets its own
+IDENTITY_MAP_SIZE = 10000
+IDENTITY_MAP_TTL = 60  # seconds
+
+# Cost of new password hashes (bcrypt's log2 rounds); stored hashes with another cost are redone on login
+BCRYPT_ROUNDS = 12
+PASSWORD_HASHING_WORKERS = 4  # threads hashing at once, however many logins arrive together
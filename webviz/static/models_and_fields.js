@@ -721,6 +721,7 @@ class BaseModel {
     }
 
     this.id = id;
+    this._version = data.version;  // sent back with updates, so the server can refuse to overwrite newer changes
     this._fields = this._getFields();
 
     for (let fieldName in this._fields) {
@@ -1728,6 +1729,7 @@ function saveDirtyModels() {
         modelCommands.push({
           '$model': model._modelName(),
           '$id': model.id,
+          '$version': model._version,
           '$update': updateData,
         });
       }
@@ -1753,7 +1755,7 @@ function saveDirtyModels() {
 
   $.ajax('/updatedata', {
     method: 'PUT',
-    data: {'data': JSON.stringify(modelCommands)},
+    data: {'data': JSON.stringify(modelCommands), 'docid': $('#data').attr('data-docid')},
     success: function(responseData) {
       console.log('SUCCESS ', responseData);
       responseData = responseData['return_data'];
@@ -1763,6 +1765,9 @@ function saveDirtyModels() {
           let command = modelCommands[index];
           let model = modelRefs[command['$model']][command['$id']];
           model._markClean();
+          if (responseData[index]['version'] !== undefined) {
+            model._version = responseData[index]['version'];
+          }
 
           let dirtyModelIndex = dirtyModelIds.indexOf(command['$id']);
           if (dirtyModelIndex > -1) {
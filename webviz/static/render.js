@@ -97,13 +97,21 @@ var width, height,  // of the whole SVG
     selected = [],  // things that are currently selected
     currentWebs = [];  // stack of webs currently in
 
-$(document).ready(function(){ init(); });
+$(document).ready(function(){
+  $.ajax($('#data').data('url'), {
+    dataType: 'json',
+    success: function(data) { init(data); },
+    error: function(responseData) {
+      console.log('ERROR ', responseData);
+    },
+  });
+});
 
 var startTime, loopTimer; // noqa
-function init() {
+function init(data) {
   startTime = Date.now();
 
-  loadData();
+  loadData(data);
 
   let rootWeb = models['Document'].index(0)['webs'].value[0];
   currentWebs.push({'web': rootWeb, 'parent': null, 'scale': 1});
@@ -301,8 +309,7 @@ function initDocuments(data) {
   }
 }
 
-function loadData() {
-  let data = JSON.parse($('#data > p').html());
+function loadData(data) {
   initNodes(data);
   initVertices(data);
   initLinks(data);
@@ -654,15 +661,20 @@ function saveDocname() {
       data: {'data': JSON.stringify([{
         '$model': 'Document',
         '$id': doc.id,
+        '$version': doc._version,
         '$update': [{
           '$action': 'overwrite',
           '$type': 'string',
           '$key': 'name',
           '$value': inputName,
         }],
-      }])},
+      }]), 'docid': $('#data').attr('data-docid')},
       success: function(responseData) {
         console.log('SUCCESS ', responseData);
+        let result = responseData['return_data'][0];
+        if (result['version'] !== undefined) {
+          doc._version = result['version'];
+        }
       },
       error: function(responseData) {
         console.log('ERROR ', responseData);
@@ -1,14 +1,20 @@
-from flask import request, session, render_template, redirect, abort, url_for, jsonify
-from graphstore.models import Graph, Link, Node
+from flask import request, session, render_template, redirect, abort, url_for, jsonify, Response, stream_with_context
+from graphstore.models import MongoModel, Graph, Link, Node, ConflictError, raw_items
+from graphstore.session import Session
+from graphstore.changes import ChangeLog, changes_since
+from graphstore.connections import reading_from
+from graphstore.exporters import ExportSource, FORMATS, graph_source
 from bson import ObjectId
 
 from . import app
 from .models import Account, Document, Web, Edge, Vertex, Rule, Prop
 from .forms import LoginForm, RegisterForm
 from .auth import login, logout, get_user
+from .layout import layout_web
 
+from contextlib import nullcontext
 import json
-import traceback
+import time
 
 MODEL_MAP = {
   'Document': Document,
@@ -17,6 +23,9 @@ MODEL_MAP = {
   'Rule': Rule, 'Prop': Prop,
 }
 
+LAYOUT_ITERATIONS = 300  # most layout steps one request may run
+LAYOUT_SECONDS = 5.0  # and the time they may take; steps on big webs are slow, so this is usually reached first
+
 
 # Create your views here.
 @app.route('/', methods=['GET'])
@@ -27,9 +36,7 @@ def home_view(**kwargs):
 
   context['docs'] = []
   if account:
-    for doc in Document.collection().find({'owner': account.genid}, projection=['name']):
-      doc['id'] = str(doc['_id'])
-      context['docs'].append(doc)
+    context['docs'] = list(Document.find({'owner': account.genid}, projection=['name']))
 
   return render_template('home.html', **context)
 
@@ -50,19 +57,132 @@ def new_doc_view(**kwargs):
   return redirect(url_for('render_view', docid=doc.id))
 
 
+def get_visible_document(docid):
+  account = get_user(session)
+
+  doc = Document.get_by_id(docid, ignore_not_found=True)
+  if doc is None:
+    abort(404)
+
+  # webs are lazy, so checking visibility first avoids loading anything we won't show
+  if doc.visibility == 'private' and (account is None or doc.owner != account.genid):
+    abort(404)
+
+  return doc
+
+
 @app.route('/render/<docid>', methods=['GET'])
 def render_view(docid, **kwargs):
   context = {'docid': docid}
+
+  # nothing is written here, so the reads can go to a secondary
+  with reading_from(app.config.get('RENDER_READ_PREFERENCE')):
+    context['doc'] = get_visible_document(docid)
+
+  return render_template('render.html', **context)
+
+
+@app.route('/api/document/<docid>', methods=['GET'])
+def document_api_view(docid, **kwargs):
+  get_visible_document(docid)
+
+  def generate():
+    # The body is sent after teardown_request has closed the request's identity map scope, so it opens
+    # its own; load_tree pulls in everything the bundle contains with a handful of queries, not one per object.
+    with MongoModel.identity_map.scope():
+      yield from Document.load_tree(docid).iter_json()
+
+  return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+@app.route('/api/document/<docid>/layout', methods=['POST'])
+def document_layout_view(docid, **kwargs):
+  # settles every web of the document on the server and saves the positions, so it opens already laid out;
+  # each call carries on from the saved positions and velocities, for webs too big to settle in one request
+  doc = get_visible_document(docid)
+
   account = get_user(session)
+  if account is None or doc.owner != account.genid:
+    abort(403)
 
-  doc = Document.get_by_id(docid, ignore_not_found=True)
-  context['doc'] = doc
-  context['pretty_json'] = json.dumps(json.loads(doc.json()), indent=2)
+  iterations = min(int(request.values.get('iterations', LAYOUT_ITERATIONS)), LAYOUT_ITERATIONS)
+  deadline = time.perf_counter() + app.config.get('LAYOUT_SECONDS', LAYOUT_SECONDS)
+
+  Document.load_tree(docid)
+
+  result = {}
+  with ChangeLog(Document, docid):
+    for web in doc.iter_bundle().get('Web', []):
+      try:
+        steps, converged = layout_web(web, iterations=iterations, deadline=deadline)
+      except ConflictError:
+        abort(409)  # vertices were edited while the layout ran
+
+      result[web.id] = {'iterations': steps, 'converged': converged}
 
-  if doc.visibility == 'private' and doc.owner != account.genid:
+  return jsonify(result)
+
+
+@app.route('/changes/<docid>', methods=['GET'])
+def changes_view(docid, **kwargs):
+  # The objects of the document written since revision ?since=, for clients that have it up to there:
+  # {"revision", "objects": {model: {id: {...}}}, "deleted": {model: [ids]}}. "reset" is true instead when
+  # the change log doesn't go back that far, and the whole document has to be loaded again.
+  get_visible_document(docid)
+
+  try:
+    since = int(request.args.get('since', 0))
+  except ValueError:
+    abort(400)
+
+  revision, objects = changes_since(Document, docid, since)
+  if objects is None:
+    return jsonify({'revision': revision, 'reset': True})
+
+  saved = {}
+  deleted = {}
+  for (model_name, obj_id), was_deleted in objects.items():
+    (deleted if was_deleted else saved).setdefault(model_name, []).append(obj_id)
+
+  found = {}
+  for model_name, ids in saved.items():
+    model = MODEL_MAP.get(model_name)
+    if model is None:
+      continue
+
+    found[model_name] = {}
+    for obj in model.find({'_id': {'$in': [ObjectId(obj_id) for obj_id in ids]}}, lazy=True):
+      found[model_name][obj.id] = obj.serialize(include_id=True, cascade=False)
+
+    # deleted since, without a ChangeLog to say so
+    missing = [obj_id for obj_id in ids if obj_id not in found[model_name]]
+    if missing:
+      deleted.setdefault(model_name, []).extend(missing)
+
+  return jsonify({'revision': revision, 'reset': False, 'objects': found, 'deleted': deleted})
+
+
+@app.route('/api/document/<docid>/export/<webid>', methods=['GET'])
+def document_export_view(docid, webid, **kwargs):
+  # streams one of the document's webs, or with ?graph=1 the graph under it, as ?format=graphml, gexf, csv or ndjson
+  doc = get_visible_document(docid)
+  if webid not in [web.id for web in raw_items(doc.webs) if web is not None]:  # the refs' ids, without loading the webs
     abort(404)
 
-  return render_template('render.html', **context)
+  export_format = request.args.get('format', 'graphml')
+  if export_format not in FORMATS:
+    abort(400)
+
+  if request.args.get('graph'):
+    web = Web.collection().find_one({'_id': ObjectId(webid)}, projection=['graph'])
+    source = graph_source(web['graph'])
+  else:
+    source = ExportSource(Web, webid, nodes='vertices', edges='edges', sources='start_vertices', sinks='end_vertices')
+
+  iter_format, mimetype, extension = FORMATS[export_format]
+  response = Response(stream_with_context(iter_format(source)), mimetype=mimetype)
+  response.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(webid, extension)
+  return response
 
 
 @app.route('/favicon')
@@ -76,7 +196,6 @@ def register_view(**kwargs):
 
   if request.method == 'POST':
     form = RegisterForm(request.form)
-    print("Form:", form)
 
     if form.validate():
       username = form.username.data
@@ -94,14 +213,13 @@ def register_view(**kwargs):
 
       if not form_errors:
         user = Account.authenticate(username, form.password.data)
-        print("user:", user)
 
         if user is not None:
           login(session, user)
           return redirect('/')
 
     else:
-      print("Errors:", form.errors)
+      app.logger.debug("Registration form errors: %s", form.errors)
 
   else:
     form = RegisterForm()
@@ -116,15 +234,12 @@ def login_view(**kwargs):
 
   if request.method == 'POST':
     form = LoginForm(request.form)
-    print("Form:", form)
 
     if form.validate():
       username = form.username.data
       password = form.password.data
 
       user = Account.authenticate(username, password)
-      print("user:", user)
-      print("accounts:", [a.json() for a in Account.find({})])
 
       if user is None:
         # TODO: return 'invalid login' error message
@@ -136,7 +251,7 @@ def login_view(**kwargs):
         return redirect('/')
 
     else:
-      print("Errors:", form.errors)
+      app.logger.debug("Login form errors: %s", form.errors)
 
   else:
     form = LoginForm()
@@ -191,7 +306,6 @@ def create_model(data, id_map):
   instance = model(**create_data)
   instance.save()
   id_map[data['$id']] = instance
-  print(instance.json())
   return instance.json()
 
 
@@ -202,6 +316,12 @@ def update_model(data, id_map):
   if instance is None:
     return
 
+  if '$version' in data and model.version_field is not None:
+    # the version the client last saw; if the stored one has moved on since, the save is a conflict
+    setattr(instance, model.version_field, data['$version'])
+
+  id_map[data['$id']] = instance
+
   for item in data['$update']:
     element = resolve_typed_value(item, id_map)
 
@@ -209,6 +329,7 @@ def update_model(data, id_map):
       instance.__setattr__(item['$key'], element)
 
     elif item['$action'] == 'append':
+      # saved as a $push of just this element
       instance.__getattribute__(item['$key']).append(element)
 
   instance.save()
@@ -222,31 +343,54 @@ def delete_model(data, id_map):
 
 @app.route('/updatedata', methods=['PUT'])
 def update_data(**kwargs):
-  import pprint
   data = json.loads(request.form.to_dict().get('data'))
   return_data = []
   id_map = {}
 
-  print()
-  for datum in data:
-    pprint.pprint(datum)
+  # saves and deletes are collected by the session and written in one bulk_write per collection
+  session = Session()
 
-    try:
-      if '$create' in datum:
-        ret = create_model(datum, id_map)
-      elif '$update' in datum:
-        ret = update_model(datum, id_map)
-      elif '$delete' in datum:
-        ret = delete_model(datum, id_map)
+  # and when the client says which document it is editing, they become one revision of it, for /changes/<docid>
+  docid = request.form.get('docid')
+  change_log = ChangeLog(Document, docid) if docid and ObjectId.is_valid(docid) else nullcontext()
+
+  with change_log, session:
+    for datum in data:
+      app.logger.debug("Update: %s", datum)
+
+      try:
+        if '$create' in datum:
+          ret = create_model(datum, id_map)
+        elif '$update' in datum:
+          ret = update_model(datum, id_map)
+        elif '$delete' in datum:
+          ret = delete_model(datum, id_map)
 
-      return_data.append({'data': ret})
+        return_data.append({'data': ret})
 
-    except Exception as e:
-      traceback.print_exc()
-      return_data.append({'error': "Model create/update/delete failed!"})
+      except Exception:
+        app.logger.exception("Model create/update/delete failed: %s", datum)
+        return_data.append({'error': "Model create/update/delete failed!"})
 
-  print()
-  return jsonify({'success': 200, 'return_data': return_data})
+    try:
+      session.commit()
+    except ConflictError as e:
+      # everything else was saved; only the ops on objects someone else changed in the meantime failed
+      conflicts = set((obj.__class__.__name__, obj.id) for obj in e.objects)
+      for index, datum in enumerate(data):
+        if (datum.get('$model'), datum.get('$id')) in conflicts:
+          return_data[index] = {'error': "Changed by someone else since it was loaded!", 'conflict': True}
+    except Exception:
+      app.logger.exception("Saving changes failed")
+      return_data = [{'error': "Saving changes failed!"} for datum in data]
+
+    # the new versions, for the client to send with its next updates
+    for datum, result in zip(data, return_data):
+      instance = id_map.get(datum.get('$id'))
+      if 'data' in result and instance is not None and instance.version_field is not None:
+        result['version'] = getattr(instance, instance.version_field)
+
+  return jsonify({'success': 200, 'return_data': return_data, 'round_trips': session.round_trips})
 
 
 @app.route('/restockobjectids', methods=['GET'])